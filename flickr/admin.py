@@ -1,5 +1,5 @@
 from django.contrib import admin
-from flickr.models import Photo, FlickrUser, PhotoSet, Collection, PhotoDownload, PhotoSizeData
+from flickr.models import Photo, FlickrUser, PhotoSet, Collection, PhotoDownload, PhotoSizeData, DownloadBlob, DownloadTask
 
 
 class PhotoAdmin(admin.ModelAdmin):
@@ -46,15 +46,30 @@ admin.site.register(FlickrUser, FlickrUserAdmin)
 
 class DownloadAdmin(admin.ModelAdmin):
     date_hierarchy = 'date_downloaded'
-    list_display = ('photo', 'date_downloaded', 'size')
+    list_display = ('photo', 'date_downloaded', 'size', 'complete', 'bytes_received', 'content_length')
     list_display_links = ('photo', 'date_downloaded')
-    list_filter = ('date_downloaded',)
+    list_filter = ('date_downloaded', 'complete')
     #prepopulated_fields = {'slug': ('title',)}
     search_fields = ['photo__title', 'photo__flickr_id']
 
 admin.site.register(PhotoDownload, DownloadAdmin)
 
 
+class DownloadBlobAdmin(admin.ModelAdmin):
+    list_display = ('digest', 'size', 'refcount', 'date_created')
+    search_fields = ['digest', 'etag']
+
+admin.site.register(DownloadBlob, DownloadBlobAdmin)
+
+
+class DownloadTaskAdmin(admin.ModelAdmin):
+    list_display = ('photo', 'size', 'status', 'priority', 'attempts', 'next_retry', 'claimed_by')
+    list_filter = ('status', 'size')
+    search_fields = ['photo__title', 'photo__flickr_id', 'last_error']
+
+admin.site.register(DownloadTask, DownloadTaskAdmin)
+
+
 class PhotoSizeDataAdmin(admin.ModelAdmin):
     list_display = ('photo', 'size', 'source')
     list_filter = ('size',)
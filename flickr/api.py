@@ -2,9 +2,13 @@ from xml.dom import minidom
 import hashlib
 import urllib
 import json
+import time
+import httplib
+import socket
 from oauth2 import Consumer as OAuthConsumer, Token, Request as OAuthRequest, SignatureMethod_HMAC_SHA1
-from urllib2 import HTTPError
-import urllib2
+from urllib2 import HTTPError, URLError
+from flickr.instrumentation import record, record_retry
+from flickr.utils import WorkerPool
 
 
 class FlickrError(Exception):
@@ -25,25 +29,103 @@ class BaseFlickrApi(object):
 
     ENDPOINT = 'http://api.flickr.com/services/rest/'
 
-    def __init__(self, key, secret, token=None, fallback=True):
+    THROTTLE_CODES = (429, 503)
+
+    def __init__(self, key, secret, token=None, fallback=True, transport=None, rate_limiter=None, cache=None, retry_policy=None,
+                 instrumentation=None, endpoint=None):
         self.FLICKR_KEY = key
         self.FLICKR_SECRET = secret
         self.token = token
         self.fallback = fallback
+        self._transport = transport
+        self.rate_limiter = rate_limiter  # #shared flickr.ratelimit.RateLimiter, None for no limit
+        self.cache = cache  # #flickr.cache.ResponseCache, None for no caching
+        self.retry_policy = retry_policy  # #flickr.retry.RetryPolicy, None to not retry
+        self.instrumentation = instrumentation  # #flickr.instrumentation.Instrumentation, None to not measure calls
+        if endpoint:
+            self.ENDPOINT = endpoint  # #f.ex. a flickr.fakeserver.FakeFlickrServer
+
+    @property
+    def transport(self):
+        """By default the keep-alive connection pool shared by the process, as configured
+        by FLICKR_TRANSPORT, FLICKR_TRANSPORT_POOL_SIZE and FLICKR_TRANSPORT_TIMEOUT"""
+        if self._transport is None:
+            from flickr.shortcuts import get_transport  # #on first use, shortcuts imports this module
+            self._transport = get_transport()
+        return self._transport
 
     def _call_method(self, auth, **params):
         raise NotImplementedError
 
+    def _limited_call(self, **params):
+        if self.rate_limiter is None:
+            return self._call_method(**params)
+        self.rate_limiter.acquire()
+        try:
+            data = self._call_method(**params)
+        except HTTPError, e:
+            if e.code in self.THROTTLE_CODES:
+                self.rate_limiter.throttled(e.hdrs.get('retry-after') if e.hdrs else None)
+            raise
+        self.rate_limiter.success()
+        return data
+
+    def _retried_call(self, **params):
+        """Call again the transient failures, as long as retry_policy says so. When a
+        'stat': 'fail' answer still comes back after all the retries, it's returned as is."""
+        if self.retry_policy is None:
+            return self._limited_call(**params)
+        method = params['method']
+        attempt = 0
+        while True:
+            try:
+                data = self._limited_call(**params)
+            except Exception, e:
+                if not self.retry_policy.should_retry(method, attempt, error=e):
+                    raise
+            else:
+                if not self.retry_policy.should_retry(method, attempt, data=data):
+                    return data
+            record_retry()
+            self.retry_policy.wait(method, attempt)
+            attempt += 1
+
+    def _parse(self, body):
+        t1 = time.time()
+        data = json.loads(body)
+        record(bytes=len(body), parse_time=time.time() - t1, stat=data.get('stat') if isinstance(data, dict) else None)
+        return data
+
     def get(self, method, format='json', auth=True, **params):
+        if self.instrumentation is None:
+            return self._cached_get(method, format, auth, **params)
+        with self.instrumentation.measure(method):
+            return self._cached_get(method, format, auth, **params)
+
+    def _cached_get(self, method, format='json', auth=True, **params):
+        if self.cache is None:
+            return self._get(method, format, auth, **params)
+        token = self.token if auth else None
+        key_params = dict(params, format=format)
+        data = self.cache.get(method, key_params, token)
+        if data is None:
+            data = self._get(method, format, auth, **params)
+            self.cache.set(method, key_params, data, token)
+        else:
+            record(cached=True, stat=data.get('stat'))
+        return data
+
+    def _get(self, method, format='json', auth=True, **params):
         try:
-            return self._call_method(auth=auth, method=method, format=format, **params)
+            return self._retried_call(auth=auth, method=method, format=format, **params)
         except FlickrInvalidTokenAuth, e:
             # Fall back to old flickr auth.
             from warnings import warn
             warn("FlickrAuthApi is deprecated, update to OAuthFlickrApi redirecting your users to '/auth/'")
             if self.fallback:
-                old_api = FlickrAuthApi(self.FLICKR_KEY, self.FLICKR_SECRET, self.token)
-                return old_api.get(method, format, auth, **params)
+                old_api = FlickrAuthApi(self.FLICKR_KEY, self.FLICKR_SECRET, self.token, transport=self.transport,
+                                        rate_limiter=self.rate_limiter, retry_policy=self.retry_policy, endpoint=self.ENDPOINT)
+                return old_api._get(method, format, auth, **params)
             else:
                 raise FlickrError, 'No fall back to old Flickr Auth allowed.'
 
@@ -75,8 +157,7 @@ class OAuthFlickrApi(BaseFlickrApi):
         return request
 
     def get_response(self, request):
-        response = urllib2.urlopen(request.to_url())
-        return '\n'.join(response.readlines())
+        return self.transport.request(request.to_url())
 
     def _call_method(self, auth, **params):
         if params.get('format', 'json') == 'json':
@@ -88,13 +169,15 @@ class OAuthFlickrApi(BaseFlickrApi):
             request = self.get_oauth_request(token=self.get_token() if auth else None, **params)
             data = self.get_response(request)
         except HTTPError, e:
+            record(status=e.code)
             if e.code == 401:
                 raise FlickrUnauthorizedCall, e
             else:
                 raise
         except FlickrError:
             raise FlickrError, 'Error when calling flickr API:  %s' % e
-        return json.loads(data)
+        record(status=200)
+        return self._parse(data)
 
     """ Auth methods """
     REQUEST_TOKEN_URL = 'http://www.flickr.com/services/oauth/request_token'
@@ -138,8 +221,10 @@ class FlickrAuthApi(BaseFlickrApi):
 
     """Regular API call methods"""
 
-    def __init__(self, key, secret, token=None):
-        super(FlickrAuthApi, self).__init__(key, secret, token)
+    def __init__(self, key, secret, token=None, transport=None, rate_limiter=None, retry_policy=None, instrumentation=None,
+                 endpoint=None):
+        super(FlickrAuthApi, self).__init__(key, secret, token, transport=transport, rate_limiter=rate_limiter, retry_policy=retry_policy,
+                                            instrumentation=instrumentation, endpoint=endpoint)
         from warnings import warn
         warn("FlickrAuthApi is deprecated, use OAuthFlickrApi instead")
 
@@ -157,10 +242,16 @@ class FlickrAuthApi(BaseFlickrApi):
                 You can try calling your method with auth=False if you don\'t want to sign it.'
             url = '%s&api_sig=%s' % (url, hashlib.md5('%s%s' % (self.FLICKR_SECRET, ''.join(sorted(['%s%s' % (k, v) for k, v in params.iteritems()])))).hexdigest())
         try:
-            f = urllib.urlopen(url)
+            f = self.transport.open(url)
+        except (URLError, socket.error, httplib.HTTPException), e:
+            # #as is, for the retry policy and the rate limiter
+            record(status=getattr(e, 'code', None))
+            raise
         except Exception, e:
-            raise FlickrError, 'Can\'t open url (%s), urllib.urlopen() failed with %s' % (url, e)
-        return json.load(f)
+            record(status=getattr(e, 'code', None))
+            raise FlickrError, 'Can\'t open url (%s), transport failed with %s' % (url, e)
+        record(status=200)
+        return self._parse(f.read())
 
     """Auth methods"""
 
@@ -169,7 +260,7 @@ class FlickrAuthApi(BaseFlickrApi):
         return 'http://flickr.com/services/auth/?api_key=%s&perms=%s&api_sig=%s' % (self.FLICKR_KEY, perms, auth_sig)
 
     def _parse_xml(self, url):
-        xml = minidom.parse(urllib.urlopen(url))
+        xml = minidom.parse(self.transport.open(url))
         data = unmarshal(xml)
         if not data.rsp.stat == 'ok':
             msg = "ERROR [%s]: %s" % (data.rsp.err.code, data.rsp.err.msg)
@@ -188,6 +279,55 @@ class FlickrAuthApi(BaseFlickrApi):
 FlickrApi = OAuthFlickrApi
 
 
+class AsyncFlickrApi(OAuthFlickrApi):
+    """Same calls and signing as OAuthFlickrApi, but get() doesn't block: the call
+    runs in a pool of threads and a flickr.utils.Future is returned right away,
+    so many calls can be in flight at once (all still going through the rate
+    limiter and the transport connection pool).
+
+        api = AsyncFlickrApi(key, secret, token)
+        futures = [api.get('photos.getInfo', photo_id=id) for id in ids]
+        for future in as_completed(futures):
+            info = future.result()
+
+    The calls run in the pool given, or in a pool of workers threads of the api
+    (close() it, or use the api as a context manager), by default in the pool
+    shared by the process (shortcuts.get_async_pool(), FLICKR_ASYNC_WORKERS).
+    """
+
+    def __init__(self, key, secret, token=None, fallback=True, transport=None, rate_limiter=None, cache=None, retry_policy=None,
+                 instrumentation=None, endpoint=None, pool=None, workers=None):
+        super(AsyncFlickrApi, self).__init__(key, secret, token, fallback, transport, rate_limiter, cache, retry_policy,
+                                             instrumentation, endpoint)
+        self.own_pool = pool is None and workers is not None
+        self._pool = WorkerPool(workers) if self.own_pool else pool
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            from flickr.shortcuts import get_async_pool  # #on first use, shortcuts imports this module
+            self._pool = get_async_pool()
+        return self._pool
+
+    def close(self):
+        """Stop the threads of the api's own pool, a shared one is left running"""
+        if self.own_pool:
+            self._pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get(self, method, format='json', auth=True, **params):
+        return self.pool.submit(super(AsyncFlickrApi, self).get, method, format, auth, **params)
+
+    def get_sync(self, method, format='json', auth=True, **params):
+        """Blocking call, like OAuthFlickrApi.get"""
+        return self.get(method, format, auth, **params).result()
+
+
 """
 below is taken from
     flickr.py
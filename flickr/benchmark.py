@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+End-to-end benchmark of flickr_sync against the fake Flickr server.
+
+Every account size (1k, 10k, 100k photos...) gets its own fake account and
+user, the scenarios run on it in the order a user would run them: an initial
+sync, an incremental one after some uploads and edits, --update-photos, then
+photosets and collections. Each run records its wall time, API calls, SQL
+queries (the --stats-json figures of flickr_sync) and peak memory, along with
+the database vendor and the code revision, so results of two commits or two
+databases can be compared.
+
+    benchmark = Benchmark(sizes=(1000, 10000), per_page=500, workers=4)
+    results = benchmark.run()
+    print '\\n'.join(table(results, baseline=json.load(open('before.json'))))
+"""
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connections, reset_queries, DEFAULT_DB_ALIAS
+from flickr import VERSION, shortcuts
+from flickr.fakeserver import FakeAccount, FakeFlickr, FakeFlickrServer
+from flickr.instrumentation import reset_peak_rss
+from flickr.management.commands.flickr_fake_server import get_or_create_flickr_user
+from flickr.models import FlickrUser, Photo, PhotoSet, Collection, SyncCheckpoint
+import StringIO
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+
+ACCOUNT_SIZES = (1000, 10000, 100000)
+SCENARIOS = ('initial', 'incremental', 'update-photos', 'photosets', 'collections')
+SCENARIO_OPTIONS = {
+    'initial': {'initial': True, 'ils': True},
+    'incremental': {'incremental': True},
+    'update-photos': {'no_photos': True, 'update_photos': True},
+    'photosets': {'no_photos': True, 'photosets': True},
+    'collections': {'no_photos': True, 'collections': True},
+}
+CHANGED = 0.01  # #part of the photos uploaded, and modified, before the incremental and update-photos runs
+# #flickr_sync --stats-json figures kept for every run
+RESULT_FIELDS = ('time', 'photos', 'new', 'updated', 'unchanged', 'errors', 'photos_per_second', 'api_calls', 'api_time',
+                 'api_calls_per_photo', 'db_queries', 'db_time', 'db_queries_per_photo', 'peak_rss_mb', 'phases')
+
+
+def git_revision():
+    """Commit of the code being benchmarked, None outside of a git checkout"""
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=devnull,
+                                           cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@contextmanager
+def using_server(server, rate_limit=None):
+    """Point the API shortcuts (and so the commands) at a FakeFlickrServer, without
+    rate limiting unless rate_limit. The fake server takes any key."""
+    saved = dict((name, getattr(shortcuts, name)) for name in ('FLICKR_KEY', 'FLICKR_SECRET', 'FLICKR_API_ENDPOINT', 'FLICKR_RATE_LIMIT'))
+    saved_settings = dict((name, getattr(settings, name, None)) for name in ('FLICKR_KEY', 'FLICKR_SECRET'))
+    saved_limiter = shortcuts.get_rate_limiter()
+    for name in ('FLICKR_KEY', 'FLICKR_SECRET'):
+        value = saved_settings[name] or 'fake'
+        setattr(settings, name, value)
+        setattr(shortcuts, name, value)
+    shortcuts.FLICKR_API_ENDPOINT = server.endpoint
+    shortcuts.FLICKR_RATE_LIMIT = rate_limit
+    shortcuts.set_rate_limiter(None)
+    try:
+        yield server
+    finally:
+        for name, value in saved.items():
+            setattr(shortcuts, name, value)
+        for name, value in saved_settings.items():
+            setattr(settings, name, value)
+        shortcuts.set_rate_limiter(saved_limiter)
+
+
+@contextmanager
+def quiet(enabled=True):
+    """Swallow what the commands print"""
+    stdout = sys.stdout
+    if enabled:
+        sys.stdout = StringIO.StringIO()
+    try:
+        yield
+    finally:
+        sys.stdout = stdout
+
+
+class Benchmark(object):
+    """Runs the scenarios for every account size against a fake server started for them.
+
+    @params sizes: photos of the accounts
+    @params scenarios: names out of SCENARIOS, run in that order
+    @params latency, jitter, rate_limit: of the fake server, see FakeFlickr
+    @params sync_options: flickr_sync options of every run, f.ex. per_page=500, workers=4, info=True"""
+
+    def __init__(self, sizes=ACCOUNT_SIZES, scenarios=SCENARIOS, latency=0, jitter=0, rate_limit=None,
+                 verbosity=1, stdout=None, **sync_options):
+        unknown = set(scenarios) - set(SCENARIOS)
+        if unknown:
+            raise ValueError('Unknown scenarios: %s' % ', '.join(sorted(unknown)))
+        self.sizes = list(sizes)
+        self.scenarios = [scenario for scenario in SCENARIOS if scenario in scenarios]
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.verbosity = verbosity
+        self.stdout = stdout or sys.stdout
+        self.sync_options = sync_options
+        # #one account per size, the index keeps their ids (and users) apart
+        self.accounts = [FakeAccount(index, photos=size, sets=max(10, size // 100), collections=max(3, size // 2000))
+                         for index, size in enumerate(self.sizes)]
+        self.fake = FakeFlickr(self.accounts, latency=latency, jitter=jitter)
+
+    def v(self, message, level=1):
+        if level <= self.verbosity:
+            self.stdout.write(message + '\n')
+
+    def run(self):
+        """Results of all the runs, as written to the json file"""
+        connection = connections[DEFAULT_DB_ALIAS]
+        results = {
+            'version': '.'.join(str(part) for part in VERSION),
+            'revision': git_revision(),
+            'date': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'db_vendor': connection.vendor,
+            'db_engine': connection.settings_dict['ENGINE'],
+            'debug': settings.DEBUG,  # #with DEBUG, Django keeps every query in memory
+            'latency': self.latency,
+            'jitter': self.jitter,
+            'rate_limit': self.rate_limit,
+            'sync_options': self.sync_options,
+            'runs': [],
+        }
+        # #peak memory of each run on its own, not since the process started (Linux only)
+        results['peak_rss_per_run'] = reset_peak_rss()
+        server = FakeFlickrServer(self.fake).start()
+        try:
+            with using_server(server, self.rate_limit):
+                for account in self.accounts:
+                    results['runs'].extend(self.run_account(account))
+        finally:
+            server.stop()
+        return results
+
+    def run_account(self, account):
+        flickr_user = get_or_create_flickr_user(account)
+        self.v('%d photos, user %s' % (account.count, flickr_user.user), 1)
+        self.reset(flickr_user)
+        if 'initial' not in self.scenarios:
+            # #the other scenarios need the photos in db
+            self.sync(flickr_user, 'initial')
+        runs = []
+        for scenario in self.scenarios:
+            self.prepare(account, scenario)
+            run = self.sync(flickr_user, scenario)
+            run['size'] = account.initial
+            runs.append(run)
+            self.v('- %-14s %8.2fs %9s photos/s %7d API calls %8d queries %8.1f MB' % (scenario, run['wall_time'],
+                        run['photos_per_second'], run['api_calls'], run['db_queries'], run['peak_rss_mb']), 1)
+        return runs
+
+    def reset(self, flickr_user):
+        """Forget what a previous benchmark synced for the user"""
+        for model in (Collection, PhotoSet, Photo):
+            model.objects.filter(user=flickr_user).delete()
+        SyncCheckpoint.objects.filter(flickr_user=flickr_user).delete()
+        FlickrUser.objects.filter(pk=flickr_user.pk).update(last_sync=None)
+
+    def prepare(self, account, scenario):
+        """Changes on the Flickr side for the scenario to pick up"""
+        changed = max(1, int(account.initial * CHANGED))
+        step = max(1, account.initial // changed)
+        if scenario == 'incremental':
+            account.add_photos(changed)
+            account.touch(range(0, account.initial, step))
+        elif scenario == 'update-photos':
+            account.touch(range(step // 2, account.initial, step))
+
+    def sync(self, flickr_user, scenario):
+        """Run flickr_sync for the scenario, its figures"""
+        fd, path = tempfile.mkstemp(prefix='flickr-benchmark-', suffix='.json')
+        os.close(fd)
+        options = dict(self.sync_options, **SCENARIO_OPTIONS[scenario])
+        calls = sum(self.fake.calls.values())
+        reset_queries()
+        reset_peak_rss()
+        try:
+            t1 = time.time()
+            with quiet(self.verbosity < 2):
+                call_command('flickr_sync', user_id=flickr_user.user_id, stats_json=path,
+                             verbosity=max(0, self.verbosity - 2), **options)
+            wall_time = time.time() - t1
+            with open(path) as f:
+                stats = json.load(f)
+        finally:
+            os.remove(path)
+        run = dict((field, stats[field]) for field in RESULT_FIELDS)
+        run.update({'scenario': scenario, 'wall_time': wall_time, 'server_calls': sum(self.fake.calls.values()) - calls})
+        return run
+
+
+def table(results, baseline=None):
+    """Lines of text, one per run, with the change of wall time since the same run of baseline"""
+    previous = dict(((run['size'], run['scenario']), run) for run in (baseline or {}).get('runs', []))
+    lines = ['%-8s %-14s %9s %8s %10s %10s %10s %9s%s' % ('photos', 'scenario', 'time', 'synced', 'photos/s', 'API calls',
+                                                           'queries', 'MB', ' %9s' % 'change' if baseline else '')]
+    for run in results['runs']:
+        change = ''
+        old = previous.get((run['size'], run['scenario']))
+        if baseline:
+            change = ' %+8.1f%%' % (100 * (run['wall_time'] - old['wall_time']) / old['wall_time']) \
+                if old and old['wall_time'] else ' %9s' % '-'
+        lines.append('%-8d %-14s %8.2fs %8d %10s %10d %10d %9.1f%s' % (run['size'], run['scenario'], run['wall_time'],
+                     run['photos'], run['photos_per_second'], run['api_calls'], run['db_queries'], run['peak_rss_mb'], change))
+    return lines
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Cache of Flickr API responses.
+
+Read-only methods return the same thing when called again a few seconds later
+(f.ex. when a sync is re-run after a crash), so their responses can be kept
+for a while instead of spending API calls. The cache is opt-in
+(FLICKR_CACHE_BACKEND), every method has its own time to live and methods
+without one are never cached.
+"""
+from collections import OrderedDict
+import copy
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+DEFAULT_TTLS = {
+    'flickr.people.getInfo': 3600,
+    'flickr.people.getPhotos': 60,
+    'flickr.photos.recentlyUpdated': 60,
+    'flickr.photos.getInfo': 600,
+    'flickr.photos.getSizes': 86400,
+    'flickr.photos.getExif': 86400,
+    'flickr.photos.geo.getLocation': 3600,
+    'flickr.photosets.getList': 600,
+    'flickr.photosets.getPhotos': 600,
+    'flickr.collections.getTree': 600,
+    'flickr.collections.getInfo': 600,
+}
+
+# #only used to sign a call, different every time
+IGNORED_PARAMS = ('oauth_nonce', 'oauth_timestamp', 'oauth_signature', 'oauth_signature_method', 'api_sig')
+
+
+class MemoryCache(object):
+    """In process cache, the least recently used entries are dropped above max_entries."""
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                return None
+            if expires < time.time():
+                return None
+            self._data[key] = (expires, value)  # #most recently used go last
+        return copy.deepcopy(value)
+
+    def set(self, key, value, ttl):
+        value = copy.deepcopy(value)
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + ttl, value)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class DjangoCache(object):
+    """Django cache backend (settings.CACHES), f.ex. to share responses between processes with memcached."""
+
+    def __init__(self, alias='default'):
+        from django.core.cache import get_cache
+        self.cache = get_cache(alias)
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value, ttl):
+        self.cache.set(key, value, ttl)
+
+    def clear(self):
+        self.cache.clear()
+
+
+class FileCache(object):
+    """One json file per response in path, survives restarts."""
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _file(self, key):
+        return os.path.join(self.path, key)
+
+    def get(self, key):
+        try:
+            with open(self._file(key)) as f:
+                expires, value = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if expires < time.time():
+            return None
+        return value
+
+    def set(self, key, value, ttl):
+        # #write to a temp file and rename, so readers never see half a response
+        fd, tmp = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'w') as f:
+            json.dump([time.time() + ttl, value], f)
+        os.rename(tmp, self._file(key))
+
+    def clear(self):
+        for name in os.listdir(self.path):
+            os.remove(self._file(name))
+
+
+class ResponseCache(object):
+    """Keys responses by method, params (but the ones only used for signing) and token,
+    keeps them ttls[method] seconds in backend.
+
+    @params backend: MemoryCache, DjangoCache, FileCache or anything with get(key) and set(key, value, ttl)
+    @params ttls: {method: seconds}, updates DEFAULT_TTLS; 0 or None to not cache a method"""
+
+    def __init__(self, backend, ttls=None):
+        self.backend = backend
+        self.ttls = dict(DEFAULT_TTLS)
+        self.ttls.update(ttls or {})
+
+    @staticmethod
+    def normalize_method(method):
+        return method if method.startswith('flickr.') else 'flickr.%s' % method
+
+    def ttl(self, method):
+        return self.ttls.get(self.normalize_method(method))
+
+    def key(self, method, params, token=None):
+        params = sorted((k, unicode(v)) for k, v in params.items() if k not in IGNORED_PARAMS and v is not None)
+        # #the token itself is a secret, only its hash goes to the key
+        token = hashlib.sha1(token).hexdigest() if token else None
+        data = json.dumps([self.normalize_method(method), params, token])
+        return 'flickr-%s' % hashlib.sha1(data).hexdigest()
+
+    def get(self, method, params, token=None):
+        if not self.ttl(method):
+            return None
+        return self.backend.get(self.key(method, params, token))
+
+    def set(self, method, params, data, token=None):
+        """Only successful responses are kept"""
+        ttl = self.ttl(method)
+        if ttl and isinstance(data, dict) and data.get('stat') == 'ok':
+            self.backend.set(self.key(method, params, token), data, ttl)
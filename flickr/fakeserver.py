@@ -0,0 +1,670 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Local stand-in for the Flickr API, to benchmark and test syncs and downloads
+without hitting Flickr.
+
+FakeAccount generates a synthetic account of any size (photos, sets,
+collections, sizes, exif, geo) on the fly from the photo index, so even 100k
+photos cost next to no memory. FakeFlickr answers the REST methods used by
+flickr.shortcuts in Flickr's json format and FakeFlickrServer serves them over
+HTTP, along with the images (paths laid out like build_photo_source's, Range
+requests supported). Latency, errors, rate limiting and cut transfers can be
+injected.
+
+    server = FakeFlickrServer(FakeFlickr([FakeAccount(0, photos=10000)], latency=0.05))
+    server.start()
+    api = FlickrApi(key, secret, token=server.fake.accounts[0].token, endpoint=server.endpoint)
+"""
+from flickr.flickr_spec import FLICKR_PHOTO_SIZES
+from flickr.ratelimit import parse_rate
+from urlparse import urlsplit, parse_qsl
+import BaseHTTPServer
+import SocketServer
+import bisect
+import calendar
+import datetime
+import hashlib
+import json
+import math
+import random
+import re
+import socket
+import threading
+import time
+
+START = 1262304000  # #2010-01-01, upload date of the first photo of every account
+INTERVAL = 600  # #seconds between two uploads
+ORIGINAL = (3000, 2000)
+
+# #(label, url_suffix, source_suffix, width, height, source_append) of every size with a url_* extra
+SIZES = []
+for _label, _size in sorted(FLICKR_PHOTO_SIZES.items()):
+    if 'url_suffix' not in _size:
+        continue
+    if 'width' in _size:
+        _dims = (_size['width'], _size['height'])
+    elif 'longest' in _size:
+        _dims = (_size['longest'], _size['longest'] * ORIGINAL[1] / ORIGINAL[0])
+    else:
+        _dims = ORIGINAL
+    SIZES.append((_label, _size['url_suffix'], _size.get('source_suffix', ''), _dims[0], _dims[1], _size.get('source_append', '')))
+
+RANGE = re.compile(r'^bytes=(?P<start>\d+)-(?P<end>\d*)$')
+SOURCE_PATH = re.compile(r'^/(?P<server>\d+)/(?P<id>\d+)_(?P<secret>[0-9a-f]+)(?:_(?P<suffix>\w))?\.(?P<format>\w+)$')
+
+
+class FakeError(Exception):
+    """A 'stat': 'fail' answer"""
+
+    def __init__(self, code, message):
+        super(FakeError, self).__init__(message)
+        self.code = code
+        self.message = message
+
+
+def _hash(*parts):
+    return hashlib.sha1('-'.join(str(part) for part in parts)).hexdigest()
+
+
+def parse_date(value):
+    """Unix timestamp, 'YYYY-MM-DD' or 'YYYY-MM-DD HH:MM:SS' (UTC) -> timestamp"""
+    if value in (None, ''):
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for fmt, length in (('%Y-%m-%d %H:%M:%S', 19), ('%Y-%m-%d', 10)):
+        try:
+            return calendar.timegm(datetime.datetime.strptime(value[:length], fmt).timetuple())
+        except ValueError:
+            continue
+    raise FakeError(3, 'Invalid date: %s' % value)
+
+
+class FakeAccount(object):
+    """A synthetic Flickr account, its photos are numbered 0 to photos - 1 in upload order.
+
+    @params index: makes ids unique between accounts
+    @params photos, sets, collections: account size
+    @params geo_every: one photo out of geo_every has a location"""
+
+    def __init__(self, index, photos=1000, sets=10, collections=3, geo_every=3):
+        self.index = index
+        self.count = self.initial = photos
+        self.sets = sets
+        self.collections = collections
+        self.geo_every = geo_every
+        self.nsid = '%d@N00' % (10000000 + index)
+        self.username = 'fake%d' % index
+        self.token_key = 'fake-token-%d' % index
+        self.token = 'oauth_token_secret=fake-secret-%d&oauth_token=%s' % (index, self.token_key)
+        self.base_id = (index + 1) * 10 ** 9
+        self.added = []  # #(first index, upload time) of the photos added after creation
+        self.updated = {}  # #{index: lastupdate} of the photos modified after creation
+        self.base_url = 'http://127.0.0.1'
+
+    # #photos
+
+    def photo_id(self, i):
+        return str(self.base_id + i)
+
+    def photo_index(self, photo_id):
+        try:
+            i = int(photo_id) - self.base_id
+        except (TypeError, ValueError):
+            return None
+        return i if 0 <= i < self.count else None
+
+    def uploaded(self, i):
+        if i < self.initial:
+            return START + i * INTERVAL
+        first, when = self.added[bisect.bisect_right(self.added, (i, float('inf'))) - 1]
+        return int(when) + (i - first)
+
+    def lastupdate(self, i):
+        return self.updated.get(i, self.uploaded(i) + 60)
+
+    def add_photos(self, count, when=None):
+        """New uploads, at when (default now)"""
+        self.added.append((self.count, when or time.time()))
+        self.count += count
+
+    def touch(self, indexes, when=None):
+        """Modify photos, at when (default now)"""
+        when = int(when or time.time())
+        for i in indexes:
+            self.updated[i] = when
+
+    def secret(self, i, original=False):
+        return _hash(self.nsid, i, 'original' if original else 'secret')[:10]
+
+    def server(self, i):
+        return str(1000 + i % 8000)
+
+    def farm(self, i):
+        return 1 + i % 9
+
+    def has_geo(self, i):
+        return bool(self.geo_every) and i % self.geo_every == 0
+
+    def location(self, i):
+        return {'latitude': round((i % 170) - 85 + 0.123456, 6), 'longitude': round((i * 7 % 350) - 175 + 0.654321, 6),
+                'accuracy': 16}
+
+    def tags(self, i):
+        return ['tag%d' % (i % 97), 'group%d' % (i % 13)]
+
+    def date_taken(self, i):
+        return datetime.datetime.utcfromtimestamp(self.uploaded(i) - 86400).strftime('%Y-%m-%d %H:%M:%S')
+
+    def source(self, i, suffix='', append=''):
+        original = suffix == 'o'
+        return '%s/%s/%s_%s%s.jpg%s' % (self.base_url, self.server(i), self.photo_id(i), self.secret(i, original),
+                                        '_%s' % suffix if suffix else '', append)
+
+    def page_url(self, i):
+        return 'http://www.flickr.com/photos/%s/%s/' % (self.username, self.photo_id(i))
+
+    def sizes(self, i):
+        return [{'label': label, 'width': width, 'height': height, 'source': self.source(i, source_suffix, append),
+                 'url': '%ssizes/%s/' % (self.page_url(i), url_suffix), 'media': 'photo'}
+                for label, url_suffix, source_suffix, width, height, append in SIZES]
+
+    def photo(self, i, extras=()):
+        """A photo of a list ('people.getPhotos', 'photos.recentlyUpdated') with the given extras"""
+        photo = {'id': self.photo_id(i), 'owner': self.nsid, 'secret': self.secret(i), 'server': self.server(i),
+                 'farm': self.farm(i), 'title': 'photo %d' % i, 'ispublic': int(i % 10 != 0), 'isfriend': 0, 'isfamily': 0}
+        if 'description' in extras:
+            photo['description'] = {'_content': 'description of photo %d' % i}
+        if 'license' in extras:
+            photo['license'] = i % 7
+        if 'date_upload' in extras:
+            photo['dateupload'] = str(self.uploaded(i))
+        if 'date_taken' in extras:
+            photo.update({'datetaken': self.date_taken(i), 'datetakengranularity': 0})
+        if 'owner_name' in extras:
+            photo['ownername'] = self.username
+        if 'icon_server' in extras:
+            photo.update({'iconserver': '2519', 'iconfarm': 3})
+        if 'original_format' in extras:
+            photo.update({'originalsecret': self.secret(i, True), 'originalformat': 'jpg'})
+        if 'last_update' in extras:
+            photo['lastupdate'] = str(self.lastupdate(i))
+        if 'geo' in extras:
+            location = self.location(i) if self.has_geo(i) else {'latitude': 0, 'longitude': 0, 'accuracy': 0}
+            photo.update(location, context=0)
+        if 'tags' in extras:
+            photo['tags'] = ' '.join(self.tags(i))
+        if 'machine_tags' in extras:
+            photo['machine_tags'] = ''
+        if 'o_dims' in extras:
+            photo.update({'o_width': str(ORIGINAL[0]), 'o_height': str(ORIGINAL[1])})
+        if 'views' in extras:
+            photo['views'] = i % 100
+        if 'media' in extras:
+            photo.update({'media': 'photo', 'media_status': 'ready'})
+        if 'path_alias' in extras:
+            photo['pathalias'] = self.username
+        for label, url_suffix, source_suffix, width, height, append in SIZES:
+            if 'url_%s' % url_suffix in extras:
+                photo.update({'url_%s' % url_suffix: self.source(i, source_suffix, append),
+                              'width_%s' % url_suffix: width, 'height_%s' % url_suffix: height})
+        return photo
+
+    def first_uploaded_since(self, timestamp):
+        """Index of the first photo uploaded at or after timestamp"""
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.uploaded(mid) < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def updated_since(self, timestamp):
+        """Indexes of the photos modified (or uploaded) at or after timestamp, last modified first"""
+        indexes = set(i for i, when in self.updated.items() if when >= timestamp)
+        i = self.count - 1
+        while i >= 0 and self.uploaded(i) + 60 >= timestamp:
+            if i not in self.updated:
+                indexes.add(i)
+            i -= 1
+        return sorted(indexes, key=lambda i: (-self.lastupdate(i), -i))
+
+    def person(self):
+        return {'id': self.nsid, 'nsid': self.nsid, 'ispro': 1, 'iconserver': '2519', 'iconfarm': 3,
+                'path_alias': self.username,
+                'username': {'_content': self.username},
+                'realname': {'_content': 'Fake User %d' % self.index},
+                'mbox_sha1sum': {'_content': _hash(self.nsid)},
+                'location': {'_content': 'Nowhere'},
+                'timezone': {'timezone_id': 'UTC', 'offset': '+00:00', 'label': 'UTC'},
+                'photosurl': {'_content': 'http://www.flickr.com/photos/%s/' % self.username},
+                'profileurl': {'_content': 'http://www.flickr.com/people/%s/' % self.username},
+                'mobileurl': {'_content': 'http://m.flickr.com/photostream.gne?id=%s' % self.index},
+                'photos': {'firstdatetaken': {'_content': self.date_taken(0) if self.count else ''},
+                           'firstdate': {'_content': str(START)},
+                           'count': {'_content': str(self.count)},
+                           'views': {'_content': '0'}}}
+
+    # #sets and collections
+
+    def set_id(self, j):
+        return '7215%d%07d' % (self.index + 1, j)
+
+    def set_index(self, set_id):
+        prefix = '7215%d' % (self.index + 1)
+        if not set_id.startswith(prefix) or len(set_id) != len(prefix) + 7:
+            return None
+        j = int(set_id[len(prefix):])
+        return j if j < self.sets else None
+
+    def set_photos(self, j):
+        return range(j, self.initial, self.sets)
+
+    def photoset(self, j):
+        photos = self.set_photos(j)
+        primary = photos[0] if photos else 0
+        return {'id': self.set_id(j), 'primary': self.photo_id(primary), 'secret': self.secret(primary),
+                'server': self.server(primary), 'farm': self.farm(primary), 'photos': len(photos), 'videos': 0,
+                'title': {'_content': 'set %d' % j}, 'description': {'_content': 'photos %d, %d...' % (j, j + self.sets)},
+                'date_create': str(START + j), 'date_update': str(START + j + 60)}
+
+    def collection_id(self, k):
+        return '%d-7215%d%07d' % (self.index + 1, self.index + 1, 5000000 + k)
+
+    def collection_index(self, collection_id):
+        for k in range(self.collections):
+            if self.collection_id(k) == collection_id:
+                return k
+        return None
+
+    def collection(self, k, children=False):
+        collection = {'id': self.collection_id(k), 'title': 'collection %d' % k, 'description': '',
+                      'iconlarge': '/images/collection_default_l.gif', 'iconsmall': '/images/collection_default_s.gif'}
+        if children and k == 0 and self.collections > 1:
+            # #the first collection holds the others, like Flickr's nested collections
+            collection['collection'] = [self.collection(child, True) for child in range(1, self.collections)]
+        elif children:
+            leaves = max(1, self.collections - 1)
+            leaf = k - 1 if self.collections > 1 else 0
+            collection['set'] = [{'id': self.set_id(j), 'title': 'set %d' % j, 'description': ''}
+                                 for j in range(leaf, self.sets, leaves)]
+        return collection
+
+
+class _Bucket(object):
+    """Token bucket of the server side rate limiting, never waits"""
+
+    def __init__(self, calls, period):
+        self.rate = float(calls) / period
+        self.capacity = self.tokens = max(1.0, self.rate)
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def take(self):
+        """True if the call is allowed, else the seconds to wait"""
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return (1 - self.tokens) / self.rate
+
+
+class FakeFlickr(object):
+    """Answers Flickr REST calls for the accounts.
+
+    @params latency: seconds added to every call (plus up to jitter more)
+    @params error_rate: part of the calls answered with a HTTP 500
+    @params fail_rate: part of the calls answered with 'stat': 'fail', code 105 (service unavailable)
+    @params rate_limit: f.ex. '3600/h', calls above it are answered with a HTTP 429 and Retry-After
+    @params image_size: bytes of an original image, smaller sizes are smaller
+    @params cut_rate: part of the image transfers cut halfway (the connection is closed)"""
+
+    def __init__(self, accounts, latency=0, jitter=0, error_rate=0, fail_rate=0, rate_limit=None, image_size=200000,
+                 cut_rate=0, seed=0):
+        self.accounts = list(accounts)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.fail_rate = fail_rate
+        self.bucket = _Bucket(*parse_rate(rate_limit)) if rate_limit else None
+        self.image_size = image_size
+        self.cut_rate = cut_rate
+        self.random = random.Random(seed)
+        self.calls = {}  # #calls per method
+        self.image_requests = {}  # #image requests per HTTP method
+        self._lock = threading.Lock()
+
+    def set_base_url(self, url):
+        for account in self.accounts:
+            account.base_url = url
+
+    def _random(self):
+        with self._lock:
+            return self.random.random()
+
+    # #lookups
+
+    def account_by_nsid(self, nsid):
+        for account in self.accounts:
+            if account.nsid == nsid:
+                return account
+        raise FakeError(1, 'User not found')
+
+    def account_by_token(self, params):
+        for account in self.accounts:
+            if account.token_key == params.get('oauth_token'):
+                return account
+        if len(self.accounts) == 1:
+            return self.accounts[0]
+        raise FakeError(98, 'Invalid auth token')
+
+    def find_photo(self, photo_id):
+        for account in self.accounts:
+            i = account.photo_index(photo_id)
+            if i is not None:
+                return account, i
+        raise FakeError(1, 'Photo "%s" not found (invalid ID)' % photo_id)
+
+    def find_set(self, set_id):
+        for account in self.accounts:
+            j = account.set_index(set_id or '')
+            if j is not None:
+                return account, j
+        raise FakeError(1, 'Photoset not found')
+
+    @staticmethod
+    def _paging(params, total, default=100, maximum=500):
+        per_page = min(int(params.get('per_page') or default), maximum)
+        page = max(int(params.get('page') or 1), 1)
+        pages = int(math.ceil(float(total) / per_page)) if total else 0
+        return page, per_page, pages
+
+    @staticmethod
+    def _extras(params):
+        return set(extra.strip() for extra in (params.get('extras') or '').split(',') if extra.strip())
+
+    # #methods
+
+    def people_getInfo(self, params):
+        return {'person': self.account_by_nsid(params.get('user_id')).person()}
+
+    def people_getPhotos(self, params):
+        account = self.account_by_nsid(params.get('user_id'))
+        since, until = parse_date(params.get('min_upload_date')), parse_date(params.get('max_upload_date'))
+        first = account.first_uploaded_since(since) if since else 0
+        end = account.first_uploaded_since(int(until) + 1) if until is not None else account.count
+        total = max(0, end - first)
+        page, per_page, pages = self._paging(params, total)
+        # #last uploaded first
+        top = end - 1 - (page - 1) * per_page
+        indexes = range(top, max(first, top - per_page + 1) - 1, -1) if top >= first else []
+        extras = self._extras(params)
+        return {'photos': {'page': page, 'pages': pages, 'perpage': per_page, 'total': str(total),
+                           'photo': [account.photo(i, extras) for i in indexes]}}
+
+    def photos_recentlyUpdated(self, params):
+        account = self.account_by_token(params)
+        since = parse_date(params.get('min_date'))
+        if since is None:
+            raise FakeError(1, 'Required parameter missing: min_date')
+        updated = account.updated_since(since)
+        page, per_page, pages = self._paging(params, len(updated))
+        extras = self._extras(params)
+        return {'photos': {'page': page, 'pages': pages, 'perpage': per_page, 'total': len(updated),
+                           'photo': [account.photo(i, extras) for i in updated[(page - 1) * per_page:page * per_page]]}}
+
+    def photos_getInfo(self, params):
+        account, i = self.find_photo(params.get('photo_id'))
+        photo = account.photo(i, ('license', 'original_format'))
+        info = {'id': photo['id'], 'secret': photo['secret'], 'server': photo['server'], 'farm': photo['farm'],
+                'dateuploaded': str(account.uploaded(i)), 'isfavorite': 0, 'license': photo['license'], 'safety_level': 0,
+                'rotation': 0, 'originalsecret': photo['originalsecret'], 'originalformat': photo['originalformat'],
+                'owner': {'nsid': account.nsid, 'username': account.username, 'realname': 'Fake User %d' % account.index,
+                          'location': '', 'iconserver': '2519', 'iconfarm': 3},
+                'title': {'_content': photo['title']},
+                'description': {'_content': 'description of photo %d' % i},
+                'visibility': {'ispublic': photo['ispublic'], 'isfriend': 0, 'isfamily': 0},
+                'dates': {'posted': str(account.uploaded(i)), 'taken': account.date_taken(i), 'takengranularity': 0,
+                          'lastupdate': str(account.lastupdate(i))},
+                'views': i % 100,
+                'tags': {'tag': [{'id': '%s-%s' % (photo['id'], tag), 'author': account.nsid, 'raw': tag, '_content': tag,
+                                  'machine_tag': 0} for tag in account.tags(i)]},
+                'urls': {'url': [{'type': 'photopage', '_content': account.page_url(i)}]},
+                'media': 'photo'}
+        if account.has_geo(i):
+            info['location'] = account.location(i)
+        return {'photo': info}
+
+    def photos_getSizes(self, params):
+        account, i = self.find_photo(params.get('photo_id'))
+        return {'sizes': {'canblog': 1, 'canprint': 1, 'candownload': 1, 'size': account.sizes(i)}}
+
+    def photos_getExif(self, params):
+        account, i = self.find_photo(params.get('photo_id'))
+        return {'photo': {'id': account.photo_id(i), 'secret': account.secret(i), 'server': account.server(i),
+                          'farm': account.farm(i), 'camera': 'Fake Camera %d' % (i % 3),
+                          'exif': [
+                              {'tagspace': 'ExifIFD', 'tagspaceid': 0, 'tag': 'ExposureTime', 'label': 'Exposure',
+                               'raw': {'_content': '1/%d' % (50 * (1 + i % 4))}},
+                              {'tagspace': 'ExifIFD', 'tagspaceid': 0, 'tag': 'FNumber', 'label': 'Aperture',
+                               'raw': {'_content': '5.6'}, 'clean': {'_content': 'f/5.6'}},
+                              {'tagspace': 'ExifIFD', 'tagspaceid': 0, 'tag': 'ISO', 'label': 'ISO Speed',
+                               'raw': {'_content': str(100 * (1 + i % 4))}},
+                              {'tagspace': 'ExifIFD', 'tagspaceid': 0, 'tag': 'FocalLength', 'label': 'Focal Length',
+                               'raw': {'_content': '50.0 mm'}, 'clean': {'_content': '50 mm'}},
+                              {'tagspace': 'ExifIFD', 'tagspaceid': 0, 'tag': 'Flash', 'label': 'Flash',
+                               'raw': {'_content': 'Off, Did not fire'}},
+                          ]}}
+
+    def photos_geo_getLocation(self, params):
+        account, i = self.find_photo(params.get('photo_id'))
+        if not account.has_geo(i):
+            raise FakeError(2, 'Photo has no location information.')
+        return {'photo': {'id': account.photo_id(i), 'location': dict(account.location(i), context=0)}}
+
+    def photosets_getList(self, params):
+        account = self.account_by_nsid(params.get('user_id'))
+        page, per_page, pages = self._paging(params, account.sets, default=500)
+        sets = range((page - 1) * per_page, min(page * per_page, account.sets))
+        return {'photosets': {'cancreate': 1, 'page': page, 'pages': pages, 'perpage': per_page, 'total': account.sets,
+                              'photoset': [account.photoset(j) for j in sets]}}
+
+    def photosets_getPhotos(self, params):
+        account, j = self.find_set(params.get('photoset_id'))
+        photos = account.set_photos(j)
+        page, per_page, pages = self._paging(params, len(photos), default=500)
+        primary = photos[0] if photos else None
+        return {'photoset': {'id': account.set_id(j), 'primary': account.photo_id(primary or 0), 'owner': account.nsid,
+                             'ownername': account.username, 'page': page, 'per_page': per_page, 'perpage': per_page,
+                             'pages': pages, 'total': len(photos),
+                             'photo': [{'id': account.photo_id(i), 'secret': account.secret(i), 'server': account.server(i),
+                                        'farm': account.farm(i), 'title': 'photo %d' % i, 'isprimary': int(i == primary)}
+                                       for i in photos[(page - 1) * per_page:page * per_page]]}}
+
+    def collections_getTree(self, params):
+        account = self.account_by_nsid(params.get('user_id'))
+        tops = [0] if account.collections > 1 else range(account.collections)
+        return {'collections': {'collection': [account.collection(k, True) for k in tops]}}
+
+    def collections_getInfo(self, params):
+        for account in self.accounts:
+            k = account.collection_index(params.get('collection_id'))
+            if k is not None:
+                collection = account.collection(k)
+                return {'collection': {'id': collection['id'], 'title': {'_content': collection['title']},
+                                       'description': {'_content': ''}, 'child_count': 0, 'datecreate': str(START + k),
+                                       'iconlarge': collection['iconlarge'], 'iconsmall': collection['iconsmall'],
+                                       'server': '0', 'secret': '0'}}
+        raise FakeError(1, 'Collection not found')
+
+    def test_login(self, params):
+        account = self.account_by_token(params)
+        return {'user': {'id': account.nsid, 'username': {'_content': account.username}}}
+
+    def auth_oauth_checkToken(self, params):
+        account = self.account_by_token(params)
+        return {'oauth': {'token': {'_content': account.token_key}, 'perms': {'_content': 'read'},
+                          'user': {'nsid': account.nsid, 'username': account.username, 'fullname': ''}}}
+
+    def call(self, params):
+        """Answer a REST call: (HTTP status, headers, json body)"""
+        # #python-oauth2 sends the None params as 'None'
+        params = dict((name, value) for name, value in params.items() if value != 'None')
+        method = params.get('method', '')
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency or self.jitter:
+            time.sleep(self.latency + self.jitter * self._random())
+        if self.bucket is not None:
+            allowed = self.bucket.take()
+            if allowed is not True:
+                return 429, {'Retry-After': '%.2f' % allowed}, json.dumps({'stat': 'fail', 'code': 429, 'message': 'Too many requests'})
+        if self.error_rate and self._random() < self.error_rate:
+            return 500, {}, 'Internal Server Error'
+        if self.fail_rate and self._random() < self.fail_rate:
+            data = {'stat': 'fail', 'code': 105, 'message': 'Service currently unavailable'}
+        else:
+            handler = getattr(self, method[len('flickr.'):].replace('.', '_'), None) if method.startswith('flickr.') else None
+            try:
+                if handler is None:
+                    raise FakeError(112, 'Method "%s" not found' % method)
+                data = handler(params)
+                data['stat'] = 'ok'
+            except FakeError, e:
+                data = {'stat': 'fail', 'code': e.code, 'message': e.message}
+        return 200, {}, json.dumps(data)
+
+    def count_image_request(self, command):
+        with self._lock:
+            self.image_requests[command] = self.image_requests.get(command, 0) + 1
+
+    def cut_transfer(self):
+        return bool(self.cut_rate) and self._random() < self.cut_rate
+
+    def image(self, path):
+        """Bytes of the image at a build_photo_source() like path, None if there is no such image"""
+        match = SOURCE_PATH.match(path)
+        if not match:
+            return None
+        try:
+            account, i = self.find_photo(match.group('id'))
+        except FakeError:
+            return None
+        suffix = match.group('suffix') or ''
+        if match.group('secret') != account.secret(i, suffix == 'o'):
+            return None
+        for label, url_suffix, source_suffix, width, height, append in SIZES:
+            if source_suffix == suffix:
+                break
+        else:
+            return None
+        length = max(256, int(self.image_size * float(width * height) / (ORIGINAL[0] * ORIGINAL[1])))
+        filler = _hash(path) * (length // 40 + 1)
+        return '\xff\xd8\xff\xe0' + filler[:length - 6] + '\xff\xd9'
+
+
+class FakeFlickrHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # #keep-alive, like Flickr
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections.add(self.connection)
+
+    def finish(self):
+        self.server.connections.discard(self.connection)
+        BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+
+    def _send(self, status, headers, body, content_type, cut=False):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            if cut:
+                # #announced the whole body, send half of it and hang up
+                self.wfile.write(body[:len(body) // 2])
+                self.close_connection = 1
+            else:
+                self.wfile.write(body)
+
+    def _send_image(self, image):
+        """The image, or the part of it asked for with a Range header"""
+        headers = {'Accept-Ranges': 'bytes', 'ETag': '"%s"' % hashlib.md5(image).hexdigest()}
+        self.server.fake.count_image_request(self.command)
+        match = RANGE.match(self.headers.get('Range') or '')
+        if match:
+            start = int(match.group('start'))
+            if start >= len(image):
+                self._send(416, {'Content-Range': 'bytes */%d' % len(image)}, '', 'text/plain')
+                return
+            end = min(int(match.group('end') or len(image) - 1), len(image) - 1)
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, len(image))
+            self._send(206, headers, image[start:end + 1], 'image/jpeg', cut=self.server.fake.cut_transfer())
+        else:
+            self._send(200, headers, image, 'image/jpeg', cut=self.server.fake.cut_transfer())
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        fake = self.server.fake
+        if url.path.rstrip('/') == '/services/rest':
+            status, headers, body = fake.call(dict(parse_qsl(url.query)))
+            self._send(status, headers, body, 'application/json' if status != 500 else 'text/plain')
+            return
+        image = fake.image(url.path)
+        if image is None:
+            self._send(404, {}, 'Not found', 'text/plain')
+        else:
+            self._send_image(image)
+
+    do_HEAD = do_GET
+
+    def log_message(self, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, *args)
+
+
+class FakeFlickrServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """HTTP server of a FakeFlickr, port 0 picks a free one."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, fake, host='127.0.0.1', port=0, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), FakeFlickrHandler)
+        self.fake = fake
+        self.verbose = verbose
+        self.url = 'http://%s:%d' % self.server_address[:2]
+        self.endpoint = '%s/services/rest/' % self.url
+        fake.set_base_url(self.url)
+        self.thread = None
+        self.connections = set()  # #open keep-alive connections, closed on stop()
+
+    def start(self):
+        """Serve in a daemon thread"""
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        for connection in list(self.connections):
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        # #let the handler threads end before the interpreter does
+        deadline = time.time() + 1
+        while self.connections and time.time() < deadline:
+            time.sleep(0.01)
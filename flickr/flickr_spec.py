@@ -65,6 +65,7 @@ FLICKR_PHOTO_SIZES = {
     'Medium 800' : {'label' : 'medium800',
                     'longest' : 800,
                     'source_suffix' : 'c',
+                    'url_suffix' : 'c',
                 },
     'Large' : { 'label' : 'large',
                 'longest' : 1024,
@@ -74,11 +75,13 @@ FLICKR_PHOTO_SIZES = {
     'Large 1600' : {'label' : 'large1600',
                     'longest' : 1600,
                     'source_suffix' : 'h',
+                    'url_suffix' : 'h',
                     'secret_field' : '',
                 },
     'Large 2048' : {'label' : 'large2048',
                     'longest' : 2048,
-                    'suffix' : 'k',
+                    'source_suffix' : 'k',
+                    'url_suffix' : 'k',
                     'secret_field' : '',
                 },
     'Original' : {  'label' : 'ori',
@@ -89,6 +92,14 @@ FLICKR_PHOTO_SIZES = {
                 },
     }
 
+"""
+'url_*' extras of 'flickr.people.getPhotos' (and other lists of photos), one
+for every size: with them the list gives source, width and height of all
+sizes, no need to call 'flickr.photos.getSizes' for every photo.
+"""
+
+FLICKR_URL_EXTRAS = ', '.join(sorted('url_%s' % size['url_suffix'] for size in FLICKR_PHOTO_SIZES.values() if 'url_suffix' in size))
+
 def get_size_from_label(label):
     for key, size_item in FLICKR_PHOTO_SIZES.items():
         if label == size_item.get('label', None):
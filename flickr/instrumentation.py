@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Timing of Flickr API calls and of the sync phases.
+
+Every BaseFlickrApi.get() makes an ApiCallEvent (method, HTTP status, bytes
+received, retries, wall time, json parsing time...) handed to the sinks of
+its Instrumentation: the log, a Django signal, a StatsD daemon, or a summary
+table printed at the end of a sync.
+
+PhaseTimer and QueryCounter tell where a sync spends its time (listing,
+per-photo calls, preparing data, db writes...) and how many queries it makes.
+"""
+from collections import namedtuple, defaultdict
+from contextlib import contextmanager
+from functools import wraps
+import logging
+import resource
+import socket
+import sys
+import threading
+import time
+
+
+ApiCallEvent = namedtuple('ApiCallEvent', 'method status stat bytes retries time parse_time cached error')
+
+_local = threading.local()
+
+
+def record(**values):
+    """Add values (bytes, status...) to the call being measured in this thread, if any"""
+    event = getattr(_local, 'event', None)
+    if event is not None:
+        event.update(values)
+
+
+def record_retry():
+    event = getattr(_local, 'event', None)
+    if event is not None:
+        event['retries'] += 1
+
+
+def normalize_method(method):
+    return method if method.startswith('flickr.') else 'flickr.%s' % method
+
+
+class Instrumentation(object):
+    """Measures calls and hands the events to the sinks, anything with emit(event)."""
+
+    def __init__(self, sinks=None):
+        self.sinks = list(sinks or [])
+        self.logger = logging.getLogger('flickr.instrumentation')
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def remove_sink(self, sink):
+        if sink in self.sinks:
+            self.sinks.remove(sink)
+
+    @contextmanager
+    def measure(self, method):
+        previous = getattr(_local, 'event', None)
+        event = _local.event = {'status': None, 'stat': None, 'bytes': 0, 'retries': 0,
+                                'parse_time': 0.0, 'cached': False, 'error': None}
+        t1 = time.time()
+        try:
+            yield event
+        except Exception, e:
+            event['error'] = e.__class__.__name__
+            raise
+        finally:
+            _local.event = previous
+            self.emit(ApiCallEvent(method=normalize_method(method), time=time.time() - t1, **event))
+
+    def emit(self, event):
+        for sink in list(self.sinks):
+            try:
+                sink.emit(event)
+            except Exception:
+                # #a broken sink must not break the sync
+                self.logger.exception('Instrumentation sink %r failed', sink)
+
+
+class LoggingSink(object):
+    """One log line per call."""
+
+    def __init__(self, logger='flickr.api', level=logging.DEBUG):
+        self.logger = logging.getLogger(logger)
+        self.level = level
+
+    def emit(self, event):
+        self.logger.log(self.level, '%s status=%s stat=%s bytes=%d retries=%d time=%.3fs parse=%.3fs%s%s', event.method,
+                        event.status, event.stat, event.bytes, event.retries, event.time, event.parse_time,
+                        ' cached' if event.cached else '', ' error=%s' % event.error if event.error else '')
+
+
+class SignalSink(object):
+    """Sends flickr.signals.api_call, receivers get the ApiCallEvent as event."""
+
+    def emit(self, event):
+        from flickr.signals import api_call
+        api_call.send(sender=self.__class__, event=event)
+
+
+class StatsdSink(object):
+    """Counters and timers sent over UDP in the StatsD format, f.ex. flickr.photos.getInfo.time:120|ms"""
+
+    def __init__(self, host='127.0.0.1', port=8125, prefix='flickr'):
+        self.address = (host, int(port))
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def lines(self, event):
+        name = '%s.%s' % (self.prefix, event.method[len('flickr.'):])
+        lines = ['%s.calls:1|c' % name,
+                 '%s.time:%d|ms' % (name, round(event.time * 1000)),
+                 '%s.parse_time:%d|ms' % (name, round(event.parse_time * 1000)),
+                 '%s.bytes:%d|c' % (name, event.bytes)]
+        if event.retries:
+            lines.append('%s.retries:%d|c' % (name, event.retries))
+        if event.cached:
+            lines.append('%s.cached:1|c' % name)
+        if event.error or event.stat == 'fail':
+            lines.append('%s.errors:1|c' % name)
+        return lines
+
+    def emit(self, event):
+        try:
+            self.socket.sendto('\n'.join(self.lines(event)), self.address)
+        except socket.error:
+            pass  # #nobody listening, metrics are best effort
+
+
+class SummarySink(object):
+    """Totals per method, for a table at the end of a run."""
+
+    FIELDS = ('calls', 'errors', 'retries', 'cached', 'bytes', 'time', 'max_time', 'parse_time')
+
+    def __init__(self):
+        self.methods = defaultdict(lambda: dict.fromkeys(self.FIELDS, 0))
+        self._lock = threading.Lock()
+
+    def emit(self, event):
+        with self._lock:
+            stats = self.methods[event.method]
+            stats['calls'] += 1
+            stats['errors'] += bool(event.error or event.stat == 'fail')
+            stats['retries'] += event.retries
+            stats['cached'] += event.cached
+            stats['bytes'] += event.bytes
+            stats['time'] += event.time
+            stats['max_time'] = max(stats['max_time'], event.time)
+            stats['parse_time'] += event.parse_time
+
+    def totals(self):
+        totals = dict.fromkeys(self.FIELDS, 0)
+        with self._lock:
+            for stats in self.methods.values():
+                for field in self.FIELDS:
+                    totals[field] = max(totals[field], stats[field]) if field == 'max_time' else totals[field] + stats[field]
+        return totals
+
+    def table(self):
+        """Lines of text, the methods taking the most time first"""
+        header = '%-34s %7s %6s %7s %6s %10s %9s %9s %9s' % ('method', 'calls', 'errors', 'retries', 'cached', 'KB',
+                                                             'time', 'avg', 'parse')
+        lines = [header]
+        with self._lock:
+            rows = sorted(self.methods.items(), key=lambda (method, stats): -stats['time'])
+        for method, stats in rows + [('TOTAL', self.totals())]:
+            lines.append('%-34s %7d %6d %7d %6d %10.1f %8.2fs %8.3fs %8.2fs' % (method[:34], stats['calls'], stats['errors'],
+                         stats['retries'], stats['cached'], stats['bytes'] / 1024.0, stats['time'],
+                         stats['time'] / stats['calls'] if stats['calls'] else 0, stats['parse_time']))
+        return lines
+
+
+@contextmanager
+def phase(name):
+    """Time the block as phase name of the PhaseTimer active in this thread, if any"""
+    timer = getattr(_local, 'timer', None)
+    if timer is None:
+        yield
+    else:
+        with timer.phase(name):
+            yield
+
+
+def timed(name):
+    """Decorator timing every call of the function as phase name"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class PhaseTimer(object):
+    """Time spent per phase, to be used from one thread. Phases can be nested,
+    the time of a phase doesn't include the phases run inside it, so the
+    times add up to the time of the run."""
+
+    def __init__(self):
+        self.times = defaultdict(float)
+        self.counts = defaultdict(int)
+        self._stack = []  # #time spent in the nested phases of each running phase
+
+    def activate(self):
+        """phase() and @timed in this thread now report to this timer"""
+        _local.timer = self
+
+    def deactivate(self):
+        if getattr(_local, 'timer', None) is self:
+            _local.timer = None
+
+    @contextmanager
+    def phase(self, name):
+        self._stack.append(0.0)
+        t1 = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - t1
+            self.times[name] += elapsed - self._stack.pop()
+            self.counts[name] += 1
+            if self._stack:
+                self._stack[-1] += elapsed
+
+    def iterate(self, name, iterable):
+        """Yield the items of iterable, the time spent getting each one is phase name"""
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+
+class _CountingCursor(object):
+
+    def __init__(self, cursor, counter):
+        self.cursor = cursor
+        self.counter = counter
+
+    def _timed(self, func, *args):
+        t1 = time.time()
+        try:
+            return func(*args)
+        finally:
+            self.counter.queries += 1
+            self.counter.time += time.time() - t1
+
+    def execute(self, sql, params=()):
+        return self._timed(self.cursor.execute, sql, params)
+
+    def executemany(self, sql, param_list):
+        return self._timed(self.cursor.executemany, sql, param_list)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+
+class QueryCounter(object):
+    """Counts the queries (and their time) made through connection, without
+    needing DEBUG and connection.queries, by wrapping the cursors it hands out."""
+
+    def __init__(self, connection=None):
+        if connection is None:
+            from django.db import connections, DEFAULT_DB_ALIAS
+            connection = connections[DEFAULT_DB_ALIAS]  # #the wrapper itself, not the django.db.connection proxy
+        self.connection = connection
+        self.queries = 0
+        self.time = 0.0
+
+    def install(self):
+        """Count from now on. Counters can be nested, the queries count for the outer ones too."""
+        self._previous = self.connection.__dict__.get('cursor')  # #an outer counter's, None for the class method
+        cursor = self.connection.cursor
+        self.connection.cursor = lambda: _CountingCursor(cursor(), self)
+
+    def uninstall(self):
+        if getattr(self, '_previous', None) is not None:
+            self.connection.cursor = self._previous
+        else:
+            self.connection.__dict__.pop('cursor', None)
+        self._previous = None
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.uninstall()
+
+
+def peak_rss():
+    """Peak resident memory of the process (since the last reset_peak_rss()), in MB"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except IOError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024.0 * 1024) if sys.platform == 'darwin' else peak / 1024.0
+
+
+def reset_peak_rss():
+    """Measure the peak memory from now on instead of since the process started.
+    Only Linux allows it, returns False elsewhere."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except IOError:
+        return False
@@ -2,8 +2,8 @@
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.management.base import BaseCommand, CommandError
-from flickr.api import FlickrApi
 from flickr.models import FlickrUser
+from flickr.shortcuts import get_api
 import time
 import sys
 
@@ -18,7 +18,7 @@ class Printer():
 class FlickrCommand(BaseCommand):
 
     def loader(self, i, total, message, errors_message=None):
-        message = '%d%% [%d/%d] %s' % (int(round(float(i) / total * 100)), i, total, errors_message) + message
+        message = '%d%% [%d/%d] %s' % (int(round(float(i) / total * 100)) if total else 100, i, total, errors_message) + message
         self.v(message, 1, True)
 
     def v(self, message, level=1, inplace=False):
@@ -36,7 +36,7 @@ class FlickrCommand(BaseCommand):
         self.FLICKR_SECRET = getattr(settings, 'FLICKR_SECRET', None)
         if not self.FLICKR_SECRET:
             raise CommandError, 'No FLICKR_SECRET in settings. %s' % self.help_text
-        self.api = FlickrApi(self.FLICKR_KEY, self.FLICKR_SECRET)
+        self.api = get_api()
 
     def handle(self, *args, **options):
         self.verbosity = options.get('verbosity')
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Time flickr_sync end to end against the fake Flickr server (flickr.benchmark)
+and write the figures to a json file, to compare commits and databases.
+"""
+from django.core.management.base import BaseCommand, CommandError
+from flickr.benchmark import Benchmark, ACCOUNT_SIZES, SCENARIOS, table
+from optparse import make_option
+import json
+
+
+class Command(BaseCommand):
+
+    help = 'Benchmark flickr_sync (initial, incremental, --update-photos, photosets, collections) on synthetic \
+accounts served by a local fake Flickr. Runs on the configured database, so run it with the settings of each \
+database to compare (f.ex. --settings=bench_sqlite, --settings=bench_postgres).'
+
+    option_list = BaseCommand.option_list + (
+
+        make_option('--sizes', action='store', dest='sizes', default=','.join(str(size) for size in ACCOUNT_SIZES),
+            help='Photos of the accounts to sync, comma separated. Default is %s.' % ','.join(str(size) for size in ACCOUNT_SIZES)),
+
+        make_option('--scenarios', action='store', dest='scenarios', default=','.join(SCENARIOS),
+            help='Runs for each account, comma separated, out of %s (always in that order).' % ','.join(SCENARIOS)),
+
+        make_option('--output', '-o', action='store', dest='output', default='flickr-benchmark.json',
+            help='Json file the results are written to. Default is flickr-benchmark.json.'),
+
+        make_option('--compare', action='store', dest='compare', default=None,
+            help='Results file of an earlier benchmark (f.ex. of the previous commit), to print the change of every run.'),
+
+        make_option('--per-page', action='store', dest='per_page', type='int', default=500,
+            help='flickr_sync --per-page. Default is 500.'),
+
+        make_option('--workers', '-w', action='store', dest='workers', type='int', default=4,
+            help='flickr_sync --workers. Default is 4.'),
+
+        make_option('--batch-size', action='store', dest='batch_size', type='int', default=None,
+            help='flickr_sync --batch-size.'),
+
+        make_option('--info', '-i', action='store_true', dest='info', default=False,
+            help='Fetch info for photos (flickr_sync --info).'),
+
+        make_option('--exif', '-e', action='store_true', dest='exif', default=False,
+            help='Fetch exif for photos (flickr_sync --exif).'),
+
+        make_option('--latency', action='store', dest='latency', type='float', default=0,
+            help='Seconds the fake server adds to every API call, to mimic the network.'),
+
+        make_option('--jitter', action='store', dest='jitter', type='float', default=0,
+            help='Up to that many seconds more, at random.'),
+
+        make_option('--rate-limit', action='store', dest='rate_limit', default=None,
+            help='API calls budget of the syncs, f.ex. 3600/h. Not limited by default.'),
+        )
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',') if size.strip()]
+        except ValueError:
+            raise CommandError('--sizes takes numbers of photos, f.ex. 1000,10000')
+        scenarios = [scenario.strip() for scenario in options['scenarios'].split(',') if scenario.strip()]
+        unknown = set(scenarios) - set(SCENARIOS)
+        if unknown:
+            raise CommandError('Unknown scenarios: %s (choose out of %s)' % (', '.join(sorted(unknown)), ', '.join(SCENARIOS)))
+        baseline = None
+        if options.get('compare'):
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+
+        sync_options = dict((name, options[name]) for name in ('per_page', 'workers', 'batch_size', 'info', 'exif'))
+        benchmark = Benchmark(sizes, scenarios, latency=options['latency'], jitter=options['jitter'],
+                              rate_limit=options['rate_limit'], verbosity=int(options.get('verbosity', 1)),
+                              stdout=self.stdout, **sync_options)
+        results = benchmark.run()
+        with open(options['output'], 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+        self.stdout.write('\n%s on %s, revision %s\n' % (results['version'], results['db_vendor'], results['revision']))
+        if baseline:
+            self.stdout.write('compared with revision %s on %s\n' % (baseline.get('revision'), baseline.get('db_vendor')))
+        for line in table(results, baseline):
+            self.stdout.write(line + '\n')
+        self.stdout.write('Results written to %s\n' % options['output'])
@@ -3,13 +3,79 @@
 """
 Download all files from Flickr to disk (the ones in our synced DB'
 """
-from django.core.files.base import ContentFile
+from collections import namedtuple
+from django.conf import settings
+from django.core.files.base import File
+from django.core.management.base import CommandError
+from django.utils.timezone import now
+from flickr.flickr_spec import FLICKR_PHOTO_SIZES
 from flickr.management.commands import FlickrCommand
-from flickr.models import Photo, PhotoDownload
+from flickr.models import Photo, PhotoDownload, PhotoSizeData, DownloadBlob, DownloadTask, DOWNLOAD_PRIORITIES
+from flickr.shortcuts import make_transport
+from flickr.utils import WorkerPool
 from optparse import make_option
+from urllib2 import HTTPError
+from urlparse import urlsplit
+import hashlib
 import os
+import re
+import socket
+import tempfile
 import time
-import urllib2
+
+
+SIZE_LABELS = [size['label'] for size in FLICKR_PHOTO_SIZES.values()]
+CHUNK_SIZE = getattr(settings, 'FLICKR_DOWNLOAD_CHUNK_SIZE', 64 * 1024)
+
+
+CONTENT_RANGE = re.compile(r'^bytes (?P<start>\d+)-(?P<end>\d+)/(?P<length>\d+|\*)$')
+
+
+# #what a transfer got, blob_id without transfer if the HEAD request tells a blob has the file already
+Fetched = namedtuple('Fetched', 'url headers file content_length digest blob_id')
+
+
+class IncompleteDownload(Exception):
+    """The transfer ended before the whole file arrived, the partial file is kept to resume"""
+
+    def __init__(self, message, content_length=None):
+        super(IncompleteDownload, self).__init__(message)
+        self.content_length = content_length
+
+
+def parse_content_range(value):
+    """(first byte, whole file size) of a 206 response, the size is None if the server doesn't tell"""
+    match = CONTENT_RANGE.match(value or '')
+    if not match:
+        raise IncompleteDownload('Wrong Content-Range: %s' % value)
+    return int(match.group('start')), int(match.group('length')) if match.group('length') != '*' else None
+
+
+def hash_file(path):
+    """sha256 of the file so far, to go on with the rest of it"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+            digest.update(chunk)
+    return digest
+
+
+def discard_partial(dphoto):
+    """Remove what was downloaded of the file so far, if the storage didn't take it"""
+    if dphoto.partial_path and os.path.exists(dphoto.partial_path):
+        os.remove(dphoto.partial_path)
+
+
+class DownloadedFile(File):
+    """Image streamed to a file of its own. Like an uploaded TemporaryUploadedFile,
+    FileSystemStorage moves it in place instead of copying it, other storages read it in chunks."""
+
+    def __init__(self, path):
+        super(DownloadedFile, self).__init__(open(path, 'rb'), name=path)
+        self.size = os.path.getsize(path)  # #asked for once moved
+
+    def temporary_file_path(self):
+        return self.name
 
 
 class Command(FlickrCommand):
@@ -27,11 +93,26 @@ class Command(FlickrCommand):
         make_option('--public', '-p', action='store_true', dest='public', default=False,
             help='Only public photos.'),
 
-        make_option('--size', '-s', action='store_true', dest='size', default=None,
-            help='Specify size for download (by default original for pro accounts and large for non-pro).'),
+        make_option('--size', '-s', action='store', dest='size', default=None,
+            help='Specify size for download, f.ex. ori, large1600, large (by default original for pro accounts and large for non-pro).'),
+
+        make_option('--concurrency', '-c', action='store', dest='concurrency', type='int', default=1,
+            help='How many photos are downloaded at once, over keep-alive connections. Default is 1.'),
+
+        make_option('--priority', action='store', dest='priority', default=None, choices=DOWNLOAD_PRIORITIES,
+            help='Order of the photos added to the download queue: recent (last posted first) or public (public first).'),
+
+        make_option('--batch-size', '-b', action='store', dest='batch_size', type='int', default=100,
+            help='How many queued downloads are claimed at once. Default is 100.'),
+
+        make_option('--retry-failed', action='store_true', dest='retry_failed', default=False,
+            help='Queue again the downloads given up after FLICKR_DOWNLOAD_MAX_ATTEMPTS.'),
 
         make_option('--reset', '-r', action='store_true', dest='reset', default=False,
-            help='Clear downloads db table. Does not affect your files.'),
+            help='Clear downloads db table and download queue. Does not affect your files.'),
+
+        make_option('--prune', action='store_true', dest='prune', default=False,
+            help='Delete the stored files (FLICKR_DOWNLOAD_DEDUP) no download references any more.'),
         )
 
     def handle(self, *args, **options):
@@ -41,61 +122,241 @@ class Command(FlickrCommand):
 
         if options.get('reset'):
             self.v('Deleting everything from PhotoDownload table (%d records).' % PhotoDownload.objects.count(), 0)
-            [d.delete() for d in PhotoDownload.objects.all()]
+            for d in PhotoDownload.objects.all():
+                discard_partial(d)
+                d.delete()  # #releases its blob
+            DownloadTask.objects.all().delete()
             self.v('PhotoDownload table empty.', 0)
             return
 
+        if options.get('prune'):
+            self.v('%d unreferenced files deleted.' % DownloadBlob.objects.prune(), 0)
+            return
+
+        size = options.get('size')
+        if not size:
+            if self.flickr_user.ispro:
+                size = 'ori'
+            else:
+                size = 'large'
+        if size not in SIZE_LABELS:
+            raise CommandError('Unknown size "%s", choose out of %s' % (size, ', '.join(sorted(SIZE_LABELS))))
+
         if options.get('public'):
             photos = Photo.objects.visible()
             self.v('Downloading public photos', 0)
         else:
             photos = Photo.objects.all()
             self.v('Downloading photos', 0)
-        if not options.get('all'):
-            photos = photos.exclude(id__in=[pd.photo.id for pd in PhotoDownload.objects.all()])
-        length = len(photos)
-        i = err = 0
-        for photo in photos:
-            i += 1
-            message = '.' * i
-            size = options.get('size')
-            if not size:
-                if self.flickr_user.ispro:
-                    size = 'ori'
-                else:
-                    size = 'large'
-            url = getattr(photo, size).source
-            if not options.get('all'):
-                dphoto = PhotoDownload.objects.create(photo=photo)
-            else:
-                dphoto, cr = PhotoDownload.objects.get_or_create(photo=photo)
-            dphoto.url = url
-            dphoto.size = size
-            try:
-                response = urllib2.urlopen(url)
-                if response.headers['content-type'] in ['image/jpeg', 'image/jpg']:
-                    content = response.read()
-                    dphoto.image_file.save(os.path.basename(url), ContentFile(content), save=True)
-                    #message += ' OK'
+        # #the photos are queued (DownloadTask) then downloaded in batches claimed by this process,
+        # #other downloaders can drain the same queue at the same time
+        queued = photos if options.get('all') else photos.exclude(photodownload__complete=True)
+        added = DownloadTask.objects.enqueue(queued, size, priority_by=options.get('priority'), requeue=options.get('all'))
+        if options.get('retry_failed'):
+            DownloadTask.objects.filter(photo__in=photos, size=size, status=DownloadTask.FAILED).update(
+                status=DownloadTask.PENDING, attempts=0, next_retry=None)
+        length = DownloadTask.objects.ready(size, photos=photos).count()
+        self.v('%d photos added to the download queue, %d to download' % (added, length), 1)
+        if not length:
+            self.v('- nothing to download', 0)
+            self.report_retries(photos, size)
+            return 'Sync end'
+        worker = '%s:%d' % (socket.gethostname(), os.getpid())
+        started = now()  # #what fails during the run is retried by the next one
+        batch_size = max(1, int(options.get('batch_size') or 100))
+        self.claimed = {}
+        concurrency = max(1, int(options.get('concurrency') or 1))
+        # #a connection per transfer kept open per farm server
+        self.transport = make_transport(pool_size=concurrency)
+        # #every file stored once under its digest (DownloadBlob), whatever the photos having it
+        self.dedup = getattr(settings, 'FLICKR_DOWNLOAD_DEDUP', False)
+        # #{(etag, size): blob id} of the files we have, looked up by the workers (no db there)
+        self.blobs = dict(((etag, size), pk) for etag, size, pk in DownloadBlob.objects.exclude(etag=None)
+                          .values_list('etag', 'size', 'pk')) if self.dedup else {}
+        pool = WorkerPool(concurrency)
+        i = err = received = 0
+        try:
+            # #N transfers in flight, each one is written to db here, in the main thread, as soon as done
+            batches = self.claim_batches(worker, size, photos, batch_size, started)
+            for (task, dphoto), future in pool.imap_unordered(self.download, self.get_downloads(batches, size)):
+                i += 1
+                self.save_download(dphoto, future)
+                self.claimed.pop(task.pk)
+                if dphoto.complete:
+                    task.finish()
                 else:
-                    if response.url == 'http://l.yimg.com/g/images/photo_unavailable.gif':  # getcode() returns status 200
-                        dphoto.errors = 'Size unavailable (' + url + ') ' + str(response.headers)
-                        #TODO: what to do? what size fallback to?
-                    else:
-                        dphoto.errors = 'Content-type wrong. ' + str(response.headers)
-                        #message += ' FAIL. check error log in db records\n'
-
-            except Exception as e:
-                #message += str(e)
-                dphoto.errors = str(e)
-                #message += 'FAIL. check error log in db records\n'
-            dphoto.save()
-            errors_message = ''
-            if err > 0:
-                errors_message = '(%d errors) ' % err
-            message = '%d%% [%d/%d] %s' % (int(round(float(i) / length * 100)), i, length, errors_message) + message
-            self.v(message, 1, True)
+                    task.fail(dphoto.errors)
+                if dphoto.errors:
+                    err += 1
+                elif dphoto.complete:
+                    received += dphoto.bytes_received
+                errors_message = ''
+                if err > 0:
+                    errors_message = '(%d errors) ' % err
+                elapsed = time.time() - t1
+                # #other downloaders can fill the queue meanwhile
+                self.loader(i, max(length, i), ' %.1f MB, %.2f MB/s' % (received / 1048576.0, received / 1048576.0 / elapsed if elapsed else 0), errors_message)
+        finally:
+            pool.shutdown()
+            self.transport.close()
+            # #interrupted, what this process claimed can be taken by the next one right away
+            DownloadTask.objects.filter(pk__in=self.claimed.keys(), status=DownloadTask.CLAIMED).update(
+                status=DownloadTask.PENDING, claimed_by=None, claimed_at=None)
 
         t2 = time.time()
+        self.v('', 1)
+        self.v('%d photos, %d errors, %.1f MB' % (i, err, received / 1048576.0), 1)
+        self.report_retries(photos, size)
         self.v('Exec time: ' + str(round(t2 - t1)), 1)
         return 'Sync end'
+
+    def report_retries(self, photos, size):
+        waiting = DownloadTask.objects.filter(photo__in=photos, size=size, status=DownloadTask.PENDING).exclude(next_retry=None)
+        failed = DownloadTask.objects.filter(photo__in=photos, size=size, status=DownloadTask.FAILED).count()
+        next_retry = list(waiting.order_by('next_retry').values_list('next_retry', flat=True)[:1])
+        if next_retry or failed:
+            self.v('%d downloads to retry (from %s on), %d given up (see --retry-failed)' % (
+                waiting.count(), next_retry[0] if next_retry else '-', failed), 1)
+
+    def claim_batches(self, worker, size, photos, batch_size, started):
+        """Lists of DownloadTask claimed from the queue, as long as some were ready when the run started"""
+        while True:
+            tasks = DownloadTask.objects.claim(worker, size=size, photos=photos, limit=batch_size, when=started)
+            if not tasks:
+                return
+            self.claimed.update((task.pk, task) for task in tasks)
+            yield tasks
+
+    def get_downloads(self, batches, size):
+        """(DownloadTask, PhotoDownload) to fetch. The rows are saved before the transfers start,
+        so the partial file of an interrupted download is found again next time."""
+        partial_dir = getattr(settings, 'FLICKR_DOWNLOAD_PARTIAL_DIR', None) or \
+            getattr(settings, 'FILE_UPLOAD_TEMP_DIR', None) or tempfile.gettempdir()
+        for tasks in batches:
+            chunk = [task.photo for task in tasks]
+            ids = [photo.id for photo in chunk]
+            sources = dict(PhotoSizeData.objects.filter(photo__in=ids, size=size).exclude(source=None)
+                           .values_list('photo_id', 'source'))
+            existing = dict((d.photo_id, d) for d in PhotoDownload.objects.filter(photo__in=ids).select_related('blob'))
+            for task, photo in zip(tasks, chunk):
+                url = sources.get(photo.id) or getattr(photo, size).source
+                dphoto = existing.get(photo.id) or PhotoDownload(photo=photo)
+                if dphoto.url != url or dphoto.size != size or dphoto.complete:
+                    # #another file (or downloaded again with --all), what we have of it doesn't count
+                    discard_partial(dphoto)
+                    dphoto.bytes_received, dphoto.content_length, dphoto.complete = 0, None, False
+                dphoto.url, dphoto.size = url, size
+                dphoto.partial_path = os.path.join(partial_dir, 'flickr-%s-%s.part' % (photo.flickr_id, size))
+                dphoto.save()
+                yield task, dphoto
+
+    def download(self, (task, dphoto)):
+        """Runs in the pool, a Fetched (file is None if it's no jpeg). The body is appended to the
+        partial file a chunk at a time, whatever its size. What a previous run left there is kept
+        and the rest asked for with a Range request."""
+        blob_id = self.known_blob(dphoto) if self.blobs else None
+        if blob_id:
+            return Fetched(dphoto.url, {}, None, None, None, blob_id)
+        path = dphoto.partial_path
+        offset = os.path.getsize(path) if os.path.exists(path) else 0
+        try:
+            response = self.transport.open(dphoto.url, headers={'Range': 'bytes=%d-' % offset} if offset else None)
+        except HTTPError as e:
+            if e.code != 416 or not offset:
+                raise
+            # #416 Range Not Satisfiable, the partial file is no part of this image
+            os.remove(path)
+            return self.download((task, dphoto))
+        if response.headers.get('content-type') not in ['image/jpeg', 'image/jpg']:
+            response.close()
+            return Fetched(response.url, response.headers, None, None, None, None)
+        if response.status == 206:
+            start, content_length = parse_content_range(response.headers.get('content-range'))
+            if start != offset:
+                response.close()
+                os.remove(path)
+                raise IncompleteDownload('Asked for the bytes from %d, got them from %s' % (offset, start))
+        else:
+            # #the whole file (the server ignores Range requests)
+            offset = 0
+            content_length = int(response.headers['content-length']) if 'content-length' in response.headers else None
+        # #hashed while streaming (what we had of it first), to store it under its digest
+        digest = hash_file(path) if self.dedup and offset else hashlib.sha256()
+        with open(path, 'ab' if offset else 'wb') as f:
+            for chunk in iter(lambda: response.read(CHUNK_SIZE), ''):
+                f.write(chunk)
+                if self.dedup:
+                    digest.update(chunk)
+        received = os.path.getsize(path)
+        if content_length is not None and received != content_length:
+            raise IncompleteDownload('Got %d of %d bytes' % (received, content_length), content_length)
+        # #moved as is into storage, give it the permissions a file written there would get (not mkstemp's 0600)
+        os.chmod(path, 0644)
+        return Fetched(response.url, response.headers, DownloadedFile(path), content_length,
+                       digest.hexdigest() if self.dedup else None, None)
+
+    def known_blob(self, dphoto):
+        """Id of the blob having the file at the url (same ETag and size, whatever the photo it
+        was downloaded for), as told by a HEAD request, None if the file has to be downloaded"""
+        try:
+            response = self.transport.open(dphoto.url, method='HEAD')
+        except HTTPError:
+            return None  # #download it to know
+        response.read()
+        etag, length = response.headers.get('etag'), response.headers.get('content-length')
+        if not etag or length is None:
+            return None
+        return self.blobs.get((etag, int(length)))
+
+    def save_download(self, dphoto, future):
+        """Record the download (and save the file) in the main thread, so db writes are never concurrent.
+        It's complete once the whole file is in storage, otherwise the partial file is kept to resume."""
+        dphoto.errors = None
+        try:
+            fetched = future.result()
+            if fetched.blob_id:
+                # #a file we have, nothing downloaded
+                if dphoto.blob_id != fetched.blob_id:
+                    DownloadBlob.objects.retain(fetched.blob_id)
+                    self.use_blob(dphoto, DownloadBlob.objects.get(pk=fetched.blob_id))
+                discard_partial(dphoto)
+                dphoto.bytes_received = dphoto.content_length = dphoto.blob.size
+                dphoto.complete, dphoto.partial_path = True, None
+            elif fetched.file is not None:
+                try:
+                    if self.dedup:
+                        self.store_blob(dphoto, fetched)
+                    else:
+                        dphoto.image_file.save(os.path.basename(dphoto.url), fetched.file, save=False)
+                finally:
+                    fetched.file.close()
+                discard_partial(dphoto)
+                dphoto.bytes_received, dphoto.content_length = fetched.file.size, fetched.content_length
+                dphoto.complete, dphoto.partial_path = True, None
+            elif fetched.url == 'http://l.yimg.com/g/images/photo_unavailable.gif':  # getcode() returns status 200
+                dphoto.errors = 'Size unavailable (' + dphoto.url + ') ' + str(fetched.headers)
+                #TODO: what to do? what size fallback to?
+            else:
+                dphoto.errors = 'Content-type wrong. ' + str(fetched.headers)
+        except Exception as e:
+            dphoto.errors = str(e)
+            if getattr(e, 'content_length', None):
+                dphoto.content_length = e.content_length
+        if not dphoto.complete:
+            dphoto.bytes_received = os.path.getsize(dphoto.partial_path) if os.path.exists(dphoto.partial_path) else 0
+        dphoto.save()
+        return dphoto
+
+    def store_blob(self, dphoto, fetched):
+        """Point the download at the blob of its content, the file is stored only if it's new"""
+        extension = os.path.splitext(urlsplit(dphoto.url).path)[1]
+        blob = DownloadBlob.objects.add_reference(fetched.digest, fetched.file, fetched.digest + extension,
+                                                  etag=fetched.headers.get('etag'))
+        self.use_blob(dphoto, blob)
+
+    def use_blob(self, dphoto, blob):
+        """Point the download at blob, which has been given its reference, instead of its previous one"""
+        if dphoto.blob_id:
+            DownloadBlob.objects.release(dphoto.blob_id)
+        dphoto.blob = blob
+        dphoto.image_file = blob.file.name
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Run a local stand-in for the Flickr API (flickr.fakeserver), to benchmark or
+try flickr_sync and flickr_download without hitting Flickr.
+"""
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from flickr.fakeserver import FakeAccount, FakeFlickr, FakeFlickrServer
+from flickr.models import FlickrUser
+from optparse import make_option
+
+
+def get_or_create_flickr_user(account):
+    """Django user and FlickrUser syncing the fake account (token and nsid included)"""
+    user, created = User.objects.get_or_create(username=account.username, defaults={'email': '%s@example.com' % account.username})
+    flickr_user, created = FlickrUser.objects.get_or_create(user=user)
+    FlickrUser.objects.filter(pk=flickr_user.pk).update(nsid=account.nsid, flickr_id=account.nsid, token=account.token)
+    return FlickrUser.objects.get(pk=flickr_user.pk)
+
+
+class Command(BaseCommand):
+
+    help = 'Serve synthetic Flickr accounts over the Flickr REST API on a local port. \
+Point the syncs at it with FLICKR_API_ENDPOINT = "http://HOST:PORT/services/rest/".'
+
+    option_list = BaseCommand.option_list + (
+
+        make_option('--host', action='store', dest='host', default='127.0.0.1',
+            help='Address to listen on. Default is 127.0.0.1.'),
+
+        make_option('--port', action='store', dest='port', type='int', default=8089,
+            help='Port to listen on. Default is 8089.'),
+
+        make_option('--accounts', action='store', dest='accounts', type='int', default=1,
+            help='How many accounts to serve.'),
+
+        make_option('--photos', action='store', dest='photos', type='int', default=1000,
+            help='Photos per account.'),
+
+        make_option('--sets', action='store', dest='sets', type='int', default=10,
+            help='Photosets per account.'),
+
+        make_option('--collections', action='store', dest='collections', type='int', default=3,
+            help='Collections per account.'),
+
+        make_option('--latency', action='store', dest='latency', type='float', default=0,
+            help='Seconds added to every API call.'),
+
+        make_option('--jitter', action='store', dest='jitter', type='float', default=0,
+            help='Up to that many seconds more, at random.'),
+
+        make_option('--error-rate', action='store', dest='error_rate', type='float', default=0,
+            help='Part of the API calls (0 to 1) answered with a HTTP 500.'),
+
+        make_option('--fail-rate', action='store', dest='fail_rate', type='float', default=0,
+            help='Part of the API calls (0 to 1) answered with "stat": "fail" (code 105, service unavailable).'),
+
+        make_option('--rate-limit', action='store', dest='rate_limit', default=None,
+            help='Calls allowed, f.ex. 3600/h. Calls above it are answered with a HTTP 429.'),
+
+        make_option('--image-size', action='store', dest='image_size', type='int', default=200000,
+            help='Bytes of an original image, the other sizes are smaller.'),
+
+        make_option('--create-users', action='store_true', dest='create_users', default=False,
+            help='Create a user (fake0, fake1...) with the Flickr token of every account, to sync them with flickr_sync.'),
+        )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        accounts = [FakeAccount(index, photos=options['photos'], sets=options['sets'], collections=options['collections'])
+                    for index in range(options['accounts'])]
+        fake = FakeFlickr(accounts, latency=options['latency'], jitter=options['jitter'], error_rate=options['error_rate'],
+                          fail_rate=options['fail_rate'], rate_limit=options['rate_limit'], image_size=options['image_size'])
+        server = FakeFlickrServer(fake, options['host'], options['port'], verbose=verbosity > 1)
+        print 'Fake Flickr API at %s' % server.endpoint
+        for account in accounts:
+            if options.get('create_users'):
+                flickr_user = get_or_create_flickr_user(account)
+                print '- %s: %d photos, user %d (./manage.py flickr_sync --user %d)' % (account.nsid, account.count,
+                                                                                    flickr_user.user_id, flickr_user.user_id)
+            else:
+                print '- %s: %d photos, token %s' % (account.nsid, account.count, account.token)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
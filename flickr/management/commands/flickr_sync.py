@@ -3,18 +3,28 @@
 from django.db import models
 from django.contrib.auth.models import User
 from django.core.management.base import CommandError
+from django.utils.timezone import now
 from flickr.management.commands import FlickrCommand
-from flickr.models import FlickrUser, Photo, JsonCache, PhotoSet, Collection
-from flickr.shortcuts import get_all_photos, get_photosets_json, \
+from flickr import VERSION
+from flickr.instrumentation import SummarySink, PhaseTimer, QueryCounter, peak_rss
+from flickr.models import FlickrUser, Photo, JsonCache, PhotoSet, Collection, SyncCheckpoint
+from flickr.shortcuts import iter_all_photos, iter_recently_updated, get_photosets_json, \
     get_photoset_photos_json, get_user_json, get_collections_tree_json, \
-    get_photo_exif_json, get_photo_sizes_json, get_photo_info_json, get_photo_geo_json, ALL_EXTRAS
+    PhotoDetailFetcher, RecentlyUpdatedStream, DETAIL_KINDS, ALL_EXTRAS, to_timestamp, get_instrumentation
+from flickr.utils import chunked
 from optparse import make_option
 import datetime
+import itertools
+import json
 import time
 
 
 class Command(FlickrCommand):
 
+    PHASES = ('photos', 'photosets', 'collections', 'update_photos')
+    STATS_OPTIONS = ('per_page', 'workers', 'batch_size', 'incremental', 'initial', 'info', 'exif', 'sizes', 'geo')
+    RESUMED_OPTIONS = ('info', 'exif', 'sizes', 'geo', 'photosets', 'collections', 'no_photos', 'update_photos', 'update_tags')
+
     help_text = 'Django-Flickr\n\nRun "./manage.py flickr_sync --help" for details, \nor rtfm at http://bitbucket.org/zalew/django-flickr/ \n\n'
 
     option_list = FlickrCommand.option_list + (
@@ -31,11 +41,12 @@ class Command(FlickrCommand):
             help='Fetch exif for photos. It will take a long time to sync as it needs to fetch Flickr data for every photo separately.'),
 
         make_option('--sizes', '-s', action='store_true', dest='sizes', default=False,
-            help='Fetch sizes details for photos. It is not needed, sizes can be obtained dynanmically. \
-It will take a long time as it needs to fetch Flickr data for every photo separately. '),
+            help='Fetch sizes details for photos. It is not needed, sizes come with the photos list (url_* extras). \
+Only photos listed without them are fetched separately.'),
 
         make_option('--geo', '-g', action='store_true', dest='geo', default=False,
-            help='Fetch geo data for photos. It will take a long time as it needs to fetch Flickr data for every photo separately.'),
+            help='Fetch geo data for photos. It is not needed, geo comes with the photos list (geo extras). \
+Only photos listed without it are fetched separately.'),
 
         make_option('--photosets', '-p', action='store_true', dest='photosets', default=False,
             help='Sync photosets. Photos must be synced first. If photo from photoset not in our db, it will be ommited.'),
@@ -67,41 +78,137 @@ set high value (200-500) for initial sync and big updates so we hit flickr less.
         make_option('--ils', action='store_true', dest='ils', default=False,
             help='Ignore last_sync.'),
 
+        make_option('--incremental', action='store_true', dest='incremental', default=False,
+            help='List only photos uploaded or modified since last sync (or --days), instead of photos uploaded since then. \
+Edits to old photos are picked up without listing the whole library. Also used by --update-photos.'),
+
         # Other
 
+        make_option('--workers', '-w', action='store', dest='workers', type='int', default=1,
+            help='Fetch per-photo data (--info, --exif, --sizes, --geo) for that many photos at once. Database writes stay in one thread.'),
+
         make_option('--initial', action='store_true', dest='initial', default=None,
-            help='It assumpts db flickr tables are empty and blindly hits create().'),
+            help='It assumpts db flickr tables are empty and blindly inserts photos in batches (see --batch-size).'),
+
+        make_option('--batch-size', action='store', dest='batch_size', type='int', default=None,
+            help='How many photos are written to db at once. Defaults to --per-page.'),
+
+        make_option('--resume', action='store_true', dest='resume', default=False,
+            help='Resume the last interrupted sync of the user where it stopped (same listing, phase, page and photo).'),
 
         make_option('--test', '-t', action='store_true', dest='test', default=False,
             help='Test/simulate. Don\'t write results to db.'),
 
+        make_option('--stats-json', action='store', dest='stats_json', default=None,
+            help='Write the figures of the run (time per phase, photos per second, API calls and db queries per photo, \
+peak memory...) to this json file.'),
+
         )
 
     def handle(self, *args, **options):
         super(Command, self).handle(*args, **options)
+        self.api_calls = SummarySink()
+        self.phases = PhaseTimer()
+        self.db_queries = QueryCounter()
+        instrumentation = get_instrumentation()
+        instrumentation.add_sink(self.api_calls)
+        self.phases.activate()
+        self.db_queries.install()
+        try:
+            return self.sync(**options)
+        finally:
+            self.db_queries.uninstall()
+            self.phases.deactivate()
+            instrumentation.remove_sink(self.api_calls)
+
+    def sync(self, **options):
         t1 = time.time()
+        started = now()
+        self.summary = {'new': 0, 'updated': 0, 'unchanged': 0, 'errors': 0}
 
         """default behavior: sync pics and user info"""
-        self.user_info(**options)
-        if not options.get('no_photos', False):
+        with self.phases.phase('user info'):
+            self.user_info(**options)
+            self.start_checkpoint(options)
+        if self.checkpoint and self.resumed:
+            started = self.checkpoint.started
+        if not options.get('no_photos', False) and not self._skip_phase('photos'):
             self.user_photos(**options)
 
-        if options.get('photosets'):
-            self.user_photosets(**options)
+        if options.get('photosets') and not self._skip_phase('photosets'):
+            with self.phases.phase('photosets'):
+                self._save_progress('photosets')
+                self.user_photosets(**options)
 
-        if options.get('collections'):
-            self.user_collections(**options)
+        if options.get('collections') and not self._skip_phase('collections'):
+            with self.phases.phase('collections'):
+                self._save_progress('collections')
+                self.user_collections(**options)
 
         if not options.get('test', False):
-            self.flickr_user.bump()  # #bump last_sync
+            self.flickr_user.bump(started)  # #bump last_sync, changes made while syncing will be picked up next time
 
         if options.get('update_photos'):
-            self.update_photos(**options)
+            with self.phases.phase('update photos'):
+                self.update_photos(**options)
+
+        if self.checkpoint:
+            self.checkpoint.finish()
 
         t2 = time.time()
+        self.summary['time'] = t2 - t1
+        stats = self.get_stats(t2 - t1, **options)
+        self.summary.update((key, stats[key]) for key in ('api_calls', 'api_time', 'db_queries'))
+        self.print_stats(stats)
+        if options.get('stats_json'):
+            with open(options['stats_json'], 'w') as f:
+                json.dump(stats, f, indent=2, sort_keys=True)
         self.v('Exec time: ' + str(round(t2 - t1)), 0)
         return 'Sync end'
 
+    def get_stats(self, exec_time, **options):
+        """Figures of the run, to compare releases and tune --per-page, --workers and --batch-size"""
+        photos = self.summary['new'] + self.summary['updated'] + self.summary['unchanged']
+        api = self.api_calls.totals()
+
+        def per_photo(value):
+            return round(float(value) / photos, 2) if photos else None
+        return {
+            'version': '.'.join(str(part) for part in VERSION),
+            'user_id': self.flickr_user.user_id,
+            'options': dict((name, options.get(name)) for name in self.STATS_OPTIONS),
+            'time': exec_time,
+            'photos': photos,
+            'new': self.summary['new'],
+            'updated': self.summary['updated'],
+            'unchanged': self.summary['unchanged'],
+            'errors': self.summary['errors'],
+            'photos_per_second': round(photos / exec_time, 2) if exec_time else None,
+            'api_calls': api['calls'],
+            'api_time': api['time'],
+            'api_calls_per_photo': per_photo(api['calls']),
+            'api_methods': dict(self.api_calls.methods),
+            'db_queries': self.db_queries.queries,
+            'db_time': self.db_queries.time,
+            'db_queries_per_photo': per_photo(self.db_queries.queries),
+            'peak_rss_mb': round(peak_rss(), 1),
+            'phases': dict((name, {'time': self.phases.times[name], 'count': self.phases.counts[name]}) for name in self.phases.times),
+        }
+
+    def print_stats(self, stats):
+        """Where the time went, per API method and per phase"""
+        self.v('', 1)
+        for line in self.api_calls.table():
+            self.v(line, 1)
+        self.v('', 1)
+        self.v('%-20s %9s %6s' % ('phase', 'time', '%'), 1)
+        for name, phase in sorted(stats['phases'].items(), key=lambda (name, phase): -phase['time']):
+            self.v('%-20s %8.2fs %5.1f%%' % (name, phase['time'], 100 * phase['time'] / stats['time'] if stats['time'] else 0), 1)
+        self.v('', 1)
+        self.v('%d photos, %s photos/s, %s API calls/photo, %d db queries (%s/photo, %.2fs), peak memory %.1f MB' % (
+                    stats['photos'], stats['photos_per_second'], stats['api_calls_per_photo'], stats['db_queries'],
+                    stats['db_queries_per_photo'], stats['db_time'], stats['peak_rss_mb']), 1)
+
     def user_info(self, **options):
         flickr_user = self.flickr_user
         self.v('Syncing user info', 0)
@@ -117,12 +224,55 @@ set high value (200-500) for initial sync and big updates so we hit flickr less.
                 self.v('-- got data for user', 1)
         self.v('COMPLETE: user info sync', 0)
 
-    def _get_photo_subset(self, extras=None, **options):
+    def start_checkpoint(self, options):
+        """Start recording the progress of this run or, with --resume, pick up the last
+        interrupted one. The listing parameters (dates included) are those of the first run."""
+        self.checkpoint, self.resumed = None, None
+        if options.get('test', False):
+            return
+        if options.get('resume'):
+            self.checkpoint = SyncCheckpoint.objects.resumable(self.flickr_user)
+            if self.checkpoint:
+                self.resumed = self.checkpoint.phase
+                options.update(self.checkpoint.get_params())
+                self.v('- resuming sync started %s at %s, page %s, after #%s' % (self.checkpoint.started,
+                            self.resumed, self.checkpoint.page, self.checkpoint.flickr_id), 1)
+                return
+            self.v('- no interrupted sync to resume, starting a new one', 1)
+        since = None
+        if options.get('days'):
+            since = (datetime.date.today() - datetime.timedelta(int(options.get('days')))).isoformat()
+        elif not options.get('ils') and self.flickr_user.last_sync:
+            since = to_timestamp(self.flickr_user.last_sync)
+        params = {'since': since, 'page': options.get('page'), 'per_page': options.get('per_page'),
+                  'incremental': options.get('incremental', False)}
+        # #so that --resume alone does the same job
+        params.update((name, options.get(name)) for name in self.RESUMED_OPTIONS)
+        options.update(params)
+        self.checkpoint = SyncCheckpoint.objects.start(self.flickr_user, **params)
+
+    def _skip_phase(self, phase):
+        """Phases done before the interrupted one are not run again on resume"""
+        return bool(self.resumed) and self.PHASES.index(phase) < self.PHASES.index(self.resumed)
+
+    def _resume_point(self, phase):
+        """(page, last flickr_id, its upload date, processed) to start the phase from"""
+        if self.resumed == phase and self.checkpoint.page:
+            return self.checkpoint.page, self.checkpoint.flickr_id, self.checkpoint.upload_date, self.checkpoint.processed
+        return None, None, None, 0
+
+    def _save_progress(self, phase, page=None, flickr_id=None, processed=0, upload_date=None):
+        if self.checkpoint:
+            self.checkpoint.save_progress(phase, page, flickr_id, processed, upload_date)
+
+    def _get_photo_subset(self, extras=None, start_page=None, after=None, upload_date=None, **options):
         flickr_user = self.flickr_user
         page = options.get('page')
         per_page = options.get('per_page')
         min_upload_date = None
-        if options.get('days'):
+        if 'since' in options:
+            min_upload_date = options['since']
+        elif options.get('days'):
             days = int(options.get('days'))
             min_upload_date = (datetime.date.today() - datetime.timedelta(days)).isoformat()
         else:
@@ -134,65 +284,151 @@ set high value (200-500) for initial sync and big updates so we hit flickr less.
         #extras = extras or ALL_EXTRAS
         # \todo Overriden util PhotoManager._prepare_data look up for extras.
         extras = ALL_EXTRAS
-        photos = get_all_photos(nsid=flickr_user.nsid, token=flickr_user.token,
-                        page=page, per_page=per_page, min_upload_date=min_upload_date, extras=extras)
+        if options.get('incremental') and min_upload_date:
+            self.v('- listing photos uploaded or modified since %s' % min_upload_date, 1)
+            # #its pages move as photos are modified, a resumed listing starts over,
+            # #the photos already synced are skipped as unchanged
+            return iter_recently_updated(token=flickr_user.token, min_date=min_upload_date,
+                        page=page, per_page=per_page, extras=extras)
+        if upload_date and not page:
+            # #the photos uploaded before the last one done, whatever was uploaded or deleted meanwhile
+            photos = iter_all_photos(nsid=flickr_user.nsid, token=flickr_user.token, per_page=per_page,
+                        min_upload_date=min_upload_date, extras=extras, after=after, max_upload_date=upload_date)
+        else:
+            photos = iter_all_photos(nsid=flickr_user.nsid, token=flickr_user.token,
+                        page=page, per_page=per_page, min_upload_date=min_upload_date, extras=extras,
+                        start_page=start_page, after=after)
         return photos
 
-    def user_photos(self, **options):
+    def _get_detail_fetcher(self, kinds, **options):
+        """Fetches the per-photo data, the calls of --workers photos at once. Runs in worker
+        threads, a call failing doesn't drop the other data of the photo."""
+        return PhotoDetailFetcher(self.flickr_user.token, kinds=kinds, workers=options.get('workers') or 1)
+
+    def _detail_requests(self, listing, kinds, size, **options):
+        """(flickr_id, kinds to fetch) of the listed (page, photo). Sizes and geo usually come with
+        the list extras, only the rest needs per-photo calls. Photos we have with the same 'lastupdate'
+        need none (one query per batch tells which), unless --initial or --update-tags."""
+        check = not options.get('initial') and not options.get('update_tags')
+        for chunk in chunked(listing, size):
+            existing = Photo.objects.existing_map([photo.id for page, photo in chunk]) if check else {}
+            for page, photo in chunk:
+                stored = existing.get(photo.id)
+                if stored and stored[1] is not None and stored[1] == Photo.objects.date_updated_from_json(photo, self.flickr_user):
+                    yield photo.id, ()
+                else:
+                    yield photo.id, set(kinds) - Photo.objects.details_in_extras(photo)
+
+    def _detail_errors(self, details):
+        return '; '.join('%s: %s' % (kind, details.errors[kind]) for kind in DETAIL_KINDS if kind in details.errors)
+
+    def _log_photo_error(self, photo, details, e):
+        self.v('- ERR failing silently exception "%s"' % (e), 1)
+        self.summary['errors'] += 1
+        info, sizes, exif, geo = details
+        # in case sth got wrong with a data set, let's log all the data to db and not break the ongoing process
+        try:
+            JsonCache.objects.create(flickr_id=photo.id, photo=photo, info=info, sizes=sizes, exif=exif, geo=geo, exception=e)
+        except Exception as e2:
+            #whoa sth is really messed up
+            JsonCache.objects.create(flickr_id=photo.id, exception=e2)
+
+    def _forget_sync_state(self, flickr_ids):
+        """Photos written without some of their details: no date_updated nor sync_hash, so
+        the next sync doesn't take them as unchanged and fetches their details again."""
+        Photo.objects.filter(user=self.flickr_user, flickr_id__in=flickr_ids).update(date_updated=None, sync_hash=None)
+
+    def _bulk_insert(self, batch):
+        """Insert a batch of (photo, info, sizes, exif, geo) at once, one by one if that fails
+        so the photo with broken data can be logged."""
         flickr_user = self.flickr_user
+        self.v(' - inserting %d photos to db' % len(batch), 2)
+        try:
+            Photo.objects.bulk_create_from_json(flickr_user=flickr_user, photos=batch, batch_size=len(batch))
+        except Exception as e:
+            self.v('- ERR bulk insert failed with "%s", inserting one by one' % e, 1)
+            for photo, info, sizes, exif, geo in batch:
+                try:
+                    Photo.objects.create_from_json(flickr_user=flickr_user, photo=photo, info=info, sizes=sizes, exif=exif, geo=geo)
+                except Exception as e:
+                    self._log_photo_error(photo, (info, sizes, exif, geo), e)
+
+    def _sync_photos_page(self, items, **options):
+        """Write a page of (photo, info, sizes, exif, geo): one query tells which photos
+        we already have, new ones are inserted in bulk, changed ones updated."""
+        flickr_user = self.flickr_user
+        existing = Photo.objects.existing_map([item[0].id for item in items])
+        creates, updates = [], []
+        for item in items:
+            photo, info, sizes, exif, geo = item
+            if photo.id not in existing:
+                creates.append(item)
+            elif not options.get('update_tags') and \
+                    Photo.objects.is_unchanged(existing[photo.id], flickr_user, photo, info=info, sizes=sizes, exif=exif, geo=geo):
+                # #no writes, tag resets nor size rebuilds
+                self.v(' - #%s not changed since last sync, skipping' % photo.id, 2)
+            else:
+                updates.append(item)
+        if creates:
+            self._bulk_insert(creates)
+        for photo, info, sizes, exif, geo in updates:
+            self.v(' - updating #%s in db' % photo.id, 2)
+            try:
+                Photo.objects.update_from_json(flickr_user=flickr_user, flickr_id=photo.id, photo=photo, info=info, sizes=sizes, exif=exif, geo=geo, update_tags=options.get('update_tags', False))
+            except Exception as e:
+                self._log_photo_error(photo, (info, sizes, exif, geo), e)
+        return len(creates), len(updates), len(items) - len(creates) - len(updates)
+
+    def user_photos(self, **options):
         self.v('Syncing user photos', 0)
         self.v('- getting user photos list...', 1)
 
-        photos = self._get_photo_subset(**options)
-        length = len(photos)
+        start_page, after, upload_date, i = self._resume_point('photos')
+        self._save_progress('photos', start_page, after, i, upload_date)
+        with self.phases.phase('listing'):
+            photos = self._get_photo_subset(start_page=start_page, after=after, upload_date=upload_date, **options)
+        length = photos.total
+        if isinstance(photos, RecentlyUpdatedStream):
+            i = 0  # #listed again from the start
+        elif upload_date and not options.get('page'):
+            length += i  # #listed are the photos left
         if length > 0:
             self.v('- got %d photos, it might take a while...' % length, 1)
-            i = 0
-            for photo in photos:
-                info = sizes = exif = geo = None
-                self.v('- processing photo #%s "%s"' % (photo.id, photo.title), 2)
-                try:
-                    if options.get('info'):
-                        self.v(' - fetching info', 2)
-                        info = get_photo_info_json(photo_id=photo.id, token=flickr_user.token)
-                    if options.get('sizes'):
-                        self.v(' - fetching sizes', 2)
-                        sizes = get_photo_sizes_json(photo_id=photo.id, token=flickr_user.token)
-                    if options.get('exif'):
-                        self.v(' - fetching exif', 2)
-                        exif = get_photo_exif_json(photo_id=photo.id, token=flickr_user.token)
-                    if options.get('geo'):
-                        self.v(' - fetching geo', 2)
-                        geo = get_photo_geo_json(photo_id=photo.id, token=flickr_user.token)
-                    #info, sizes, exif, geo = get_photo_details_jsons(photo_id=photo.id, token=flickr_user.token)
-                    if not options.get('test', False):
-                        if options.get('initial', False):
-                            #blindly create for initial sync (assumpts table is empty)
-                            self.v(' - inserting to db', 2)
-                            Photo.objects.create_from_json(flickr_user=flickr_user, photo=photo, info=info, sizes=sizes, exif=exif, geo=geo)
-                        else:
-                            if not Photo.objects.filter(flickr_id=photo.id):
-                                self.v(' - inserting to db', 2)
-                                Photo.objects.create_from_json(flickr_user=flickr_user, photo=photo, info=info, sizes=sizes, exif=exif, geo=geo)
-                            else:
-                                self.v(' - updating db', 2)
-                                Photo.objects.update_from_json(flickr_user=flickr_user, flickr_id=photo.id, photo=photo, info=info, sizes=sizes, exif=exif, geo=geo, update_tags=options.get('update_tags', False))
-                    else:
+            fetcher = self._get_detail_fetcher([kind for kind in DETAIL_KINDS if options.get(kind)], **options)
+            listing, ids = itertools.tee(self.phases.iterate('listing', photos.iter_with_pages()))
+            batch_size = int(options.get('batch_size') or options.get('per_page') or 100)
+            created = updated = unchanged = 0
+            # #details are fetched concurrently with --workers (all API calls share one rate limiter),
+            # #but written to db here, in order, in one thread, a batch at a time
+            details_stream = self.phases.iterate('details', fetcher.iter_details(
+                self._detail_requests(ids, fetcher.kinds, batch_size, **options)))
+            for chunk in chunked(itertools.izip(listing, details_stream), batch_size):
+                items, incomplete = [], []
+                for (page, photo), details in chunk:
+                    self.v('- processing photo #%s "%s"' % (photo.id, photo.title), 2)
+                    if details.errors:
+                        self._log_photo_error(photo, details[1:5], self._detail_errors(details))
+                        incomplete.append(photo.id)
+                    items.append((photo, details.info, details.sizes, details.exif, details.geo))
+                with self.phases.phase('db'):
+                    if options.get('test', False):
                         self.v(' - it\'s a test, so not writing to db', 2)
-                except Exception as e:
-                    self.v('- ERR failing silently exception "%s"' % (e), 1)
-                    # in case sth got wrong with a data set, let's log all the data to db and not break the ongoing process
-                    try:
-                        JsonCache.objects.create(flickr_id=photo.id, photo=photo, info=info, sizes=sizes, exif=exif, geo=geo, exception=e)
-                    except Exception as e2:
-                        #whoa sth is really messed up
-                        JsonCache.objects.create(flickr_id=photo.id, exception=e2)
-                i += 1
-                if i % 10 == 0:
-                    self.v('- %d photos processed, %d to go' % (i, length - i), 1)
-                    time.sleep(2)  # #so we don't get our connections dropped by flickr api'
-                if i % 100 == 0:
-                    time.sleep(3)
+                    elif options.get('initial', False):
+                        #blindly create for initial sync (assumpts table is empty)
+                        self._bulk_insert(items)
+                        created += len(items)
+                    elif items:
+                        counts = self._sync_photos_page(items, **options)
+                        created, updated, unchanged = [a + b for a, b in zip((created, updated, unchanged), counts)]
+                    if incomplete and not options.get('test', False):
+                        self._forget_sync_state(incomplete)
+                    i += len(chunk)
+                    # #the batch is in db, a crash from now on resumes after its last photo
+                    self._save_progress('photos', page, photo.id, i, getattr(photo, 'dateupload', None))
+                self.v('- %d photos processed, %d to go' % (i, length - i), 1)
+            fetcher.close()
+            self.summary.update({'new': created, 'updated': updated, 'unchanged': unchanged})
+            self.v('- %d new, %d updated, %d skipped (not changed)' % (created, updated, unchanged), 1)
         else:
             self.v('- nothing to sync', 0)
         self.v('COMPLETE: user photos sync', 0)
@@ -204,28 +440,53 @@ set high value (200-500) for initial sync and big updates so we hit flickr less.
         """ Update (no creation) all photos in database to get last_updated date """
         self.v('- updating user photos list...', 1)
         opts = {'page':options.get('page'), 'per_page':options.get('per_page'), 'ils':True}
-        photos = self._get_photo_subset(extras='last_update', **opts)
-        self.v('- got %d photos...' % len(photos), 1)
-        for photo in photos:
-            self.v('- processing photo #%s "%s"' % (photo.id, photo.title), 2)
-            if not options.get('test', False):
-                Photo.objects.update_from_json(flickr_user=flickr_user, flickr_id=photo.id, photo=photo)
-
-        """ Update info for outdated photos """
+        if options.get('incremental'):
+            # #only photos modified since last sync, not the whole stream
+            opts.update({'ils': options.get('ils'), 'days': options.get('days'), 'incremental': True})
+            if 'since' in options:
+                opts['since'] = options['since']
+        start_page, after, upload_date, i = self._resume_point('update_photos')
+        self._save_progress('update_photos', start_page, after, i, upload_date)
+        photos = self._get_photo_subset(extras='last_update', start_page=start_page, after=after, upload_date=upload_date, **opts)
+        self.v('- got %d photos...' % photos.total, 1)
+        updated = unchanged = 0
+        for chunk in chunked(self.phases.iterate('listing', photos.iter_with_pages()), int(options.get('per_page') or 100)):
+            existing = Photo.objects.existing_map([photo.id for page, photo in chunk])
+            for page, photo in chunk:
+                self.v('- processing photo #%s "%s"' % (photo.id, photo.title), 2)
+                if photo.id not in existing:
+                    continue  # #no creation here
+                if Photo.objects.is_unchanged(existing[photo.id], flickr_user, photo):
+                    self.v(' - #%s not changed since last sync, skipping' % photo.id, 2)
+                    unchanged += 1
+                elif not options.get('test', False):
+                    # #listing data only, the hash of the full data is written with the details below
+                    Photo.objects.update_from_json(flickr_user=flickr_user, flickr_id=photo.id, photo=photo, sync_hash=None)
+                    updated += 1
+            i += len(chunk)
+            self._save_progress('update_photos', page, photo.id, i, getattr(photo, 'dateupload', None))
+        self.v('- %d updated, %d skipped (not changed)' % (updated, unchanged), 1)
+
+        """ Update info for outdated photos (on resume, the ones done already are not outdated anymore) """
         self.v('- getting user photos list to update...', 1)
         photos = Photo.objects.filter(models.Q(last_sync=None) | models.Q(date_updated__gte=models.F('last_sync')))
         length = len(photos)
         if length > 0:
             self.v('- got %d photos, it might take a while...' % len(photos), 1)
-            for photo in photos:
+            fetcher = self._get_detail_fetcher(('info', 'exif', 'geo'), **options)
+            details_stream = self.phases.iterate('details', fetcher.iter_details(photo.flickr_id for photo in photos))
+            for photo, details in itertools.izip(photos, details_stream):
+                info, sizes, exif, geo = details.info, None, details.exif, details.geo
                 try:
                     self.v('- processing photo #%s "%s"' % (photo.flickr_id, photo.title), 2)
-                    info = get_photo_info_json(photo_id=photo.flickr_id, token=flickr_user.token)
-                    exif = get_photo_exif_json(photo_id=photo.flickr_id, token=flickr_user.token)
-                    geo = get_photo_geo_json(photo_id=photo.flickr_id, token=flickr_user.token)
-                    sizes = None
+                    if details.errors:
+                        # #update with the data we got anyway
+                        self.v('- ERR failing silently exception "%s"' % self._detail_errors(details), 1)
+                        JsonCache.objects.create(flickr_id=photo.flickr_id, info=info, exif=exif, geo=geo, exception=self._detail_errors(details))
                     if not options.get('test', False):
                         Photo.objects.update_from_json(flickr_user=flickr_user, flickr_id=photo.flickr_id, photo=None, info=info, sizes=sizes, exif=exif, geo=geo, update_tags=options.get('update_tags', False))
+                        if details.errors:
+                            self._forget_sync_state([photo.flickr_id])
                     else:
                         self.v(' - it\'s a test, so not writing to db', 2)
                 except Exception as e:
@@ -249,7 +510,6 @@ set high value (200-500) for initial sync and big updates so we hit flickr less.
         length = len(sets)
         if length > 0:
             self.v('- got %d photosets, fetching photos, it might take a while...' % length, 1)
-            time.sleep(1)
             i = 0
             for s in sets:
                 photos = get_photoset_photos_json(photoset_id=s.id, token=flickr_user.token)
@@ -264,7 +524,6 @@ set high value (200-500) for initial sync and big updates so we hit flickr less.
                 i += 1
                 if i % 10 == 0:
                     self.v('- %d photosets fetched, %d to go' % (i, length - i), 1)
-                    time.sleep(2)  # #so we don't get our connections dropped by flickr api'
         else:
             self.v('- nothing to sync', 1)
         self.v('COMPLETE: user photosets sync', 0)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Sync all the users with a Flickr token, several at once in a pool of processes.
+"""
+from django.db import connection
+from flickr.management.commands import FlickrCommand
+from flickr.management.commands.flickr_sync import Command as SyncCommand
+from flickr.models import FlickrUser
+from flickr.ratelimit import RateLimiter, parse_rate
+from flickr.shortcuts import set_rate_limiter, FLICKR_RATE_LIMIT, FLICKR_RATE_LIMIT_BURST, FLICKR_RATE_LIMIT_FILE
+from optparse import make_option
+import multiprocessing
+import time
+import traceback
+
+
+def init_worker(rate, burst):
+    """Every worker process gets its own rate budget, unless FLICKR_RATE_LIMIT_FILE is set: then they
+    keep sharing its budget with each other and with any other flickr_sync process.
+    The db connection inherited from the parent is not used."""
+    connection.close()
+    if rate and not FLICKR_RATE_LIMIT_FILE:
+        calls, period = parse_rate(rate)
+        set_rate_limiter(RateLimiter(calls, period, burst))
+
+
+def sync_user(job):
+    """Run flickr_sync for one user, returns (user_id, summary, error)"""
+    user_id, options = job
+    command = None
+    try:
+        command = SyncCommand()
+        defaults = dict((option.dest, option.default) for option in command.option_list if option.dest)
+        defaults.update(options)
+        defaults['user_id'] = user_id
+        command.handle(**defaults)
+        return user_id, command.summary, None
+    except Exception:
+        return user_id, getattr(command, 'summary', None), traceback.format_exc()
+    finally:
+        connection.close()
+
+
+class Command(FlickrCommand):
+
+    help_text = 'Django-Flickr\n\nRun "./manage.py flickr_sync_all --help" for details, \nor rtfm at http://bitbucket.org/zalew/django-flickr/ \n\n'
+
+    option_list = tuple(option for option in SyncCommand.option_list if option.dest != 'user_id') + (
+
+        make_option('--processes', '-P', action='store', dest='processes', type='int', default=multiprocessing.cpu_count(),
+            help='How many users are synced at once. Default is the number of CPUs.'),
+
+        make_option('--rate', action='store', dest='rate', default=None,
+            help='API calls budget of each user being synced, f.ex. 600/h. Defaults to FLICKR_RATE_LIMIT divided by --processes, \
+so all together stay under the API key limit. Not used with FLICKR_RATE_LIMIT_FILE, the processes share its budget.'),
+        )
+
+    def handle(self, *args, **options):
+        self.verbosity = options.get('verbosity')
+        t1 = time.time()
+        processes = max(1, int(options.pop('processes') or 1))
+        rate = options.pop('rate') or self.default_rate(processes)
+
+        users = self.get_users()
+        if FLICKR_RATE_LIMIT_FILE:
+            budget = '%s API calls shared through %s' % (FLICKR_RATE_LIMIT, FLICKR_RATE_LIMIT_FILE)
+        else:
+            budget = '%s API calls each' % (rate or 'unlimited')
+        self.v('Syncing %d users, %d at once, %s' % (len(users), processes, budget), 0)
+        jobs = [(flickr_user.user_id, options) for flickr_user in users]
+        results = {}
+        if processes == 1:
+            init_worker(rate, FLICKR_RATE_LIMIT_BURST)
+            for job in jobs:
+                user_id, summary, error = sync_user(job)
+                results[user_id] = self.report(user_id, summary, error)
+        else:
+            # #children must not share the parent's db connection
+            connection.close()
+            pool = multiprocessing.Pool(processes, init_worker, (rate, FLICKR_RATE_LIMIT_BURST))
+            try:
+                # #chunksize=1 so users are taken in order, the longest not synced first
+                for user_id, summary, error in pool.imap_unordered(sync_user, jobs, 1):
+                    results[user_id] = self.report(user_id, summary, error)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+
+        self.print_summary(users, results, time.time() - t1)
+        return 'Sync end'
+
+    def default_rate(self, processes):
+        if not FLICKR_RATE_LIMIT:
+            return None
+        calls, period = parse_rate(FLICKR_RATE_LIMIT)
+        return '%g/%g' % (calls / processes, period)
+
+    def get_users(self):
+        """Users with a token, the ones never synced first, then by last_sync age"""
+        users = FlickrUser.objects.exclude(token=None).exclude(token='').select_related('user')
+        return sorted(users, key=lambda flickr_user: (flickr_user.last_sync is not None, flickr_user.last_sync))
+
+    def report(self, user_id, summary, error):
+        if error:
+            self.v('- ERR sync failed for user %s\n%s' % (user_id, error), 0)
+        else:
+            self.v('- synced user %s in %ds' % (user_id, round(summary.get('time', 0))), 1)
+        return summary, error
+
+    def print_summary(self, users, results, exec_time):
+        self.v('', 0)
+        self.v('%-30s %8s %8s %8s %8s %8s  %s' % ('user', 'new', 'updated', 'skipped', 'errors', 'time', 'status'), 0)
+        totals = dict.fromkeys(('new', 'updated', 'unchanged', 'errors'), 0)
+        failed = 0
+        for flickr_user in users:
+            summary, error = results.get(flickr_user.user_id, (None, 'not run'))
+            summary = summary or {}
+            for key in totals:
+                totals[key] += summary.get(key, 0)
+            failed += bool(error)
+            self.v('%-30s %8d %8d %8d %8d %7ds  %s' % (unicode(flickr_user.user)[:30], summary.get('new', 0), summary.get('updated', 0),
+                        summary.get('unchanged', 0), summary.get('errors', 0), round(summary.get('time', 0)), 'FAILED' if error else 'ok'), 0)
+        self.v('%-30s %8d %8d %8d %8d %7ds  %d failed' % ('TOTAL (%d users)' % len(users), totals['new'], totals['updated'],
+                    totals['unchanged'], totals['errors'], round(exec_time), failed), 0)
@@ -4,11 +4,19 @@ from bunch import bunchify  # #for json.dot.notation instead of json['annoying']
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models.signals import post_delete
+from django.utils.encoding import force_unicode
 from django.utils.timezone import now
 from taggit.managers import TaggableManager
-from flickr.flickr_spec import FLICKR_PHOTO_SIZES, build_photo_source
-from flickr.utils import ts_to_dt, unslash
+from flickr.instrumentation import phase, timed
+from flickr.flickr_spec import FLICKR_PHOTO_SIZES, FLICKR_PHOTO_URL_PAGE_SIZES, build_photo_source
+from flickr.utils import chunked, ts_to_dt, unslash
+import calendar
+import datetime
+import hashlib
+import json
+import uuid
 
 URL_BASE = getattr(settings, 'FLICKR_URL_BASE', 'http://www.flickr.com/')
 
@@ -62,8 +70,8 @@ class FlickrUser(models.Model):
             return '%sphotos/%s/' % (URL_BASE, self.username)
         return '%sphotos/%s/' % (URL_BASE, self.nsid)
 
-    def bump(self):
-        self.last_sync = now()
+    def bump(self, last_sync=None):
+        self.last_sync = last_sync or now()
         self.save()
 
 
@@ -113,6 +121,7 @@ class PhotoManager(models.Manager):
     def public(self, *args, **kwargs):
         return self.visible(ispublic=1, *args, **kwargs)
 
+    @timed('prepare')
     def _prepare_data(self, photo, flickr_user, info=None, exif=None, geo=None, **kwargs):
         """
         Returns a dict with all information related to a photo. As some info
@@ -224,56 +233,171 @@ class PhotoManager(models.Manager):
         photo_data.update(geo_data)
         return photo_data
 
+    def _tag_names(self, tags):
+        """Tags come as a space separated string from 'getPhotos' and as a list from 'getInfo'"""
+        if not tags:
+            return []
+        if isinstance(tags, basestring):
+            return [force_unicode(tag) for tag in tags.split()]
+        return [force_unicode(tag['_content']) for tag in tags]
+
+    @timed('tags')
     def _add_tags(self, obj, tags):
         try:
-            obj.tags.set(*[tag for tag in tags.split()])
+            obj.tags.set(*self._tag_names(tags))
         except KeyError:
             pass
         except:
             # \todo TBD: implements feeders: from 'getPhotos' and from 'getInfo'
             pass
 
-    def _add_sizes(self, obj, photo, sizes):
+    def _sizes_data(self, photo, sizes):
+        """Size dicts from 'photos.getSizes' or, without it, from the url_* extras of 'getPhotos'"""
         if sizes:
-            for size in sizes['sizes']['size']:
-                obj.sizes.create_from_json(photo=obj, size=size)
-        else:
-            for key, size in FLICKR_PHOTO_SIZES.items():
-                url_suffix = size.get('url_suffix', None)
-                if url_suffix and getattr(photo, 'url_%s' % url_suffix, None):
-                    size_data = {
-                            'label' : key,
-                            'width' : getattr(photo, 'width_%s' % url_suffix, None),
-                            'height' : getattr(photo, 'height_%s' % url_suffix, None),
-                            'source' : getattr(photo, 'url_%s' % url_suffix, None),
-                            }
-                    obj.sizes.create_from_json(photo=obj, size=size_data)
+            # #skip sizes we don't know (f.ex. video players)
+            return [size for size in sizes['sizes']['size'] if size['label'] in FLICKR_PHOTO_SIZES]
+        sizes_data = []
+        for key, size in sorted(FLICKR_PHOTO_SIZES.items()):
+            url_suffix = size.get('url_suffix', None)
+            if url_suffix and getattr(photo, 'url_%s' % url_suffix, None):
+                sizes_data.append({
+                        'label' : key,
+                        'width' : getattr(photo, 'width_%s' % url_suffix, None),
+                        'height' : getattr(photo, 'height_%s' % url_suffix, None),
+                        'source' : getattr(photo, 'url_%s' % url_suffix, None),
+                        'url' : FLICKR_PHOTO_URL_PAGE_SIZES % {
+                                'user-id': getattr(photo, 'pathalias', None) or getattr(photo, 'owner', ''),
+                                'photo-id': photo.id, 'size-suffix': url_suffix},
+                        })
+        return sizes_data
+
+    def details_in_extras(self, photo):
+        """Per-photo data kinds ('sizes', 'geo') the extras of a 'getPhotos' photo already give,
+        so they don't need their own call"""
+        kinds = set()
+        if any(getattr(photo, 'url_%s' % size['url_suffix'], None) for size in FLICKR_PHOTO_SIZES.values() if 'url_suffix' in size):
+            kinds.add('sizes')
+        if getattr(photo, 'latitude', None) is not None:
+            kinds.add('geo')
+        return kinds
+
+    @timed('sizes')
+    def _add_sizes(self, obj, photo, sizes):
+        for size in self._sizes_data(photo, sizes):
+            obj.sizes.create_from_json(photo=obj, size=size)
+
+    @timed('prepare')
+    def _data_hash(self, photo_data, sizes_data):
+        """Hash of the prepared data, to tell if anything changed since the last sync"""
+        data = dict((key, value) for key, value in photo_data.items() if key not in ('last_sync', 'user', 'sync_hash'))
+        return hashlib.sha1(json.dumps([data, sizes_data], sort_keys=True, default=unicode)).hexdigest()
+
+    def is_unchanged(self, stored, flickr_user, photo, info=None, sizes=None, exif=None, geo=None):
+        """Compare a photo we have, (pk, date_updated, last_sync, sync_hash) from existing_map(),
+        with fresh data. It's unchanged if Flickr's lastupdate is the same and, if per-photo
+        details were fetched, they hash the same as the data written last time."""
+        pk, date_updated, last_sync, sync_hash = stored
+        if date_updated is None or date_updated != self.date_updated_from_json(photo, flickr_user):
+            return False
+        if not (info or sizes or exif or geo):
+            return True
+        photo_data = self._prepare_data(flickr_user=flickr_user, photo=photo, info=info, exif=exif, geo=geo)
+        return sync_hash == self._data_hash(photo_data, self._sizes_data(photo, sizes))
 
     def create_from_json(self, flickr_user, photo, info=None, sizes=None, exif=None, geo=None, **kwargs):
         """Create a record for flickr_user"""
         photo_data = self._prepare_data(flickr_user=flickr_user, photo=photo, info=info, exif=exif, geo=geo, **kwargs)
+        photo_data['sync_hash'] = self._data_hash(photo_data, self._sizes_data(photo, sizes))
         tags = photo_data.pop('tags')
         obj = self.create(**dict(photo_data.items() + kwargs.items()))
         self._add_tags(obj, tags)
         self._add_sizes(obj, photo, sizes)
         return obj
 
+    def bulk_create_from_json(self, flickr_user, photos, batch_size=100, **kwargs):
+        """Create records for flickr_user with a few queries per batch instead of
+        several per photo. Like create_from_json it assumes the photos are not
+        in the db yet (initial sync).
+
+        @params photos: photo dicts as returned from 'flickr.people.getPhotos',
+                        or (photo, info, sizes, exif, geo) tuples
+        @return: number of created photos
+        """
+        created = 0
+        batch = []
+        for item in photos:
+            batch.append(item if isinstance(item, tuple) else (item, None, None, None, None))
+            if len(batch) >= batch_size:
+                created += self._bulk_create_batch(flickr_user, batch, **kwargs)
+                batch = []
+        if batch:
+            created += self._bulk_create_batch(flickr_user, batch, **kwargs)
+        return created
+
+    def _bulk_create_batch(self, flickr_user, batch, **kwargs):
+        objs, tags, sizes = [], {}, {}
+        for photo, info, photo_sizes, exif, geo in batch:
+            photo_data = self._prepare_data(flickr_user=flickr_user, photo=photo, info=info, exif=exif, geo=geo, **kwargs)
+            flickr_id = photo_data['flickr_id']
+            sizes[flickr_id] = self._sizes_data(photo, photo_sizes)
+            photo_data['sync_hash'] = self._data_hash(photo_data, sizes[flickr_id])
+            tags[flickr_id] = self._tag_names(photo_data.pop('tags'))
+            objs.append(self.model(**dict(photo_data.items() + kwargs.items())))
+
+        with transaction.commit_on_success(using=self.db):
+            self.bulk_create(objs)
+            # #bulk_create doesn't set primary keys, get them in one query
+            pks = dict(self.filter(flickr_id__in=tags.keys()).values_list('flickr_id', 'pk'))
+            with phase('sizes'):
+                PhotoSizeData.objects.bulk_create([
+                    PhotoSizeData(**PhotoSizeData.objects._prepare_data(size=size, photo=self.model(pk=pks[flickr_id])))
+                    for flickr_id, photo_sizes in sizes.items() for size in photo_sizes])
+            self._bulk_add_tags(pks, tags)
+        return len(objs)
+
+    @timed('tags')
+    def _bulk_add_tags(self, pks, tags):
+        through = self.model._meta.get_field_by_name('tags')[0].through
+        tag_model = through.tag_model()
+        names = set(name for photo_tags in tags.values() for name in photo_tags)
+        tag_objs = dict((tag.name, tag) for tag in tag_model.objects.filter(name__in=names))
+        for name in names - set(tag_objs.keys()):
+            tag_objs[name] = tag_model.objects.create(name=name)
+        through.objects.bulk_create([
+            through(tag=tag_objs[name], **through.lookup_kwargs(self.model(pk=pks[flickr_id])))
+            for flickr_id, photo_tags in tags.items() for name in set(photo_tags)])
+
     def update_from_json(self, flickr_user, flickr_id, photo, info=None, sizes=None, exif=None, geo=None, **kwargs):
         """Update a record with flickr_id"""
         update_tags = kwargs.pop('update_tags', False)
+        update_sizes = kwargs.pop('update_sizes', False)
         photo_data = self._prepare_data(photo=photo, flickr_user=flickr_user, info=info, exif=exif, geo=geo, **kwargs)
+        photo_data['sync_hash'] = self._data_hash(photo_data, self._sizes_data(photo, sizes))
         tags = photo_data.pop('tags')
         result = self.filter(flickr_id=flickr_id).update(**dict(photo_data.items() + kwargs.items()))
-        if result == 1:
+        if result == 1 and (update_tags or update_sizes):
             obj = self.get(flickr_id=flickr_id)
             if update_tags:
                 obj.tags.clear()
                 self._add_tags(obj, tags)
-            if kwargs.get('update_sizes', False):
-                obj.sizes.clear()  # Delete all sizes or only update them?
+            if update_sizes:
+                obj.sizes.all().delete()  # Delete all sizes or only update them?
                 self._add_sizes(obj, photo, sizes)
         return result
 
+    def existing_map(self, flickr_ids):
+        """{flickr_id: (pk, date_updated, last_sync, sync_hash)} of the given photos we already have, in one query"""
+        return dict((row[0], row[1:]) for row in
+                    self.filter(flickr_id__in=flickr_ids).values_list('flickr_id', 'pk', 'date_updated', 'last_sync', 'sync_hash'))
+
+    def date_updated_from_json(self, photo, flickr_user):
+        """'lastupdate' of a 'getPhotos' photo as it would be stored in date_updated"""
+        lastupdate = getattr(photo, 'lastupdate', None)
+        if not lastupdate:
+            return None
+        field = self.model._meta.get_field('date_updated')
+        return field.get_prep_value(ts_to_dt(lastupdate, flickr_user.tzoffset))
+
     def create_or_update_from_json(self, flickr_user, info, sizes=None, exif=None, geo=None, **kwargs):
         """Pretty self explanatory"""
 
@@ -326,6 +450,8 @@ class Photo(FlickrModel):
 
     license = models.CharField(max_length=50, choices=FLICKR_LICENSES, default=0)
 
+    sync_hash = models.CharField(max_length=40, null=True, blank=True, editable=False)  # #hash of the data last written by sync
+
     objects = PhotoManager()
 
     class Meta:
@@ -765,6 +891,61 @@ class Collection(FlickrModel):
     thumbnail.allow_tags = True
 
 
+class SyncCheckpointManager(models.Manager):
+
+    def start(self, flickr_user, **params):
+        """New run for the user, params are the listing parameters to be reused on resume.
+        The runs of the user left unfinished can't be resumed any more, they are deleted."""
+        self.filter(flickr_user=flickr_user, finished=None).delete()
+        return self.create(flickr_user=flickr_user, params=json.dumps(params))
+
+    def resumable(self, flickr_user):
+        """The last run of the user which didn't finish, or None"""
+        checkpoints = self.filter(flickr_user=flickr_user, finished=None).order_by('-started', '-pk')[:1]
+        return checkpoints[0] if checkpoints else None
+
+
+class SyncCheckpoint(models.Model):
+    """Progress of a flickr_sync run, updated after every batch written to db,
+    so an interrupted run can be resumed (flickr_sync --resume)."""
+
+    flickr_user = models.ForeignKey(FlickrUser)
+    started = models.DateTimeField(default=now)
+    updated = models.DateTimeField(auto_now=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    phase = models.CharField(max_length=20, null=True, blank=True)
+    page = models.PositiveIntegerField(null=True, blank=True)
+    flickr_id = models.CharField(max_length=50, null=True, blank=True)
+    upload_date = models.BigIntegerField(null=True, blank=True)  # #'dateupload' of flickr_id, where to resume the listing from
+    processed = models.PositiveIntegerField(default=0)
+    params = models.TextField(null=True, blank=True)
+
+    objects = SyncCheckpointManager()
+
+    class Meta:
+        ordering = ['-started']
+
+    def __unicode__(self):
+        return u"%s %s (%s)" % (self.flickr_user, self.started, self.phase)
+
+    def get_params(self):
+        return json.loads(self.params or '{}')
+
+    def save_progress(self, phase, page=None, flickr_id=None, processed=0, upload_date=None):
+        """Last processed page and photo (and its upload date) of the phase, one UPDATE query"""
+        self.phase, self.page, self.flickr_id, self.processed = phase, page, flickr_id, processed
+        self.upload_date = int(upload_date) if upload_date else None
+        self.updated = now()
+        SyncCheckpoint.objects.filter(pk=self.pk).update(phase=phase, page=page, flickr_id=flickr_id, upload_date=self.upload_date,
+                                                         processed=processed, updated=self.updated)
+
+    def finish(self):
+        """Done: only this run is kept of the finished runs of the user"""
+        self.finished = now()
+        self.save()
+        SyncCheckpoint.objects.filter(flickr_user=self.flickr_user_id, finished__isnull=False).exclude(pk=self.pk).delete()
+
+
 class JsonCache(models.Model):
 
     flickr_id = models.CharField(max_length=50, null=True, blank=True)
@@ -776,6 +957,77 @@ class JsonCache(models.Model):
     added = models.DateTimeField(auto_now=True, auto_now_add=True)
 
 
+class DownloadBlobManager(models.Manager):
+
+    def add_reference(self, digest, content, filename, etag=None):
+        """Blob of the content (with that sha256 digest) with one more reference. The file
+        is only written to storage the first time the content is seen."""
+        try:
+            blob = self.get(digest=digest)
+        except self.model.DoesNotExist:
+            blob = self.model(digest=digest, size=content.size, etag=etag, refcount=0)
+            name = blob.upload_path(filename)
+            written = not blob.file.storage.exists(name)
+            if written:
+                blob.file.save(filename, content, save=False)
+            else:
+                blob.file.name = name  # #left by a blob deleted from db, same digest so same content
+            try:
+                blob.save()
+            except IntegrityError:
+                # #stored by another process in the meantime, under its own file
+                transaction.rollback_unless_managed()
+                if written:
+                    blob.file.storage.delete(blob.file.name)
+                blob = self.get(digest=digest)
+        if etag and not blob.etag:
+            # #the ETag of the first url the content came from is kept
+            self.filter(pk=blob.pk, etag=None).update(etag=etag)
+            blob.etag = etag
+        self.retain(blob.pk)
+        blob.refcount += 1
+        return blob
+
+    def retain(self, blob_id):
+        """One reference more"""
+        self.filter(pk=blob_id).update(refcount=models.F('refcount') + 1)
+
+    def release(self, blob_id):
+        """One reference less. The file stays until prune(), it can be referenced again."""
+        if blob_id:
+            self.filter(pk=blob_id).update(refcount=models.F('refcount') - 1)
+
+    def prune(self):
+        """Delete the blobs no download references any more, files included. Returns how many."""
+        pruned = 0
+        for blob in self.filter(refcount__lte=0).exclude(photodownload__isnull=False):
+            blob.file.delete(save=False)
+            blob.delete()
+            pruned += 1
+        return pruned
+
+
+class DownloadBlob(models.Model):
+    """Downloaded file stored once under its sha256 digest, whatever the photos
+    (of one or several users) having the same content (FLICKR_DOWNLOAD_DEDUP)."""
+
+    def upload_path(self, filename):
+        dirbase = getattr(settings, 'FLICKR_DOWNLOAD_DIRBASE', 'flickr')
+        return '/'.join([dirbase, 'blobs', self.digest[:2], self.digest[2:4], filename])
+
+    digest = models.CharField(max_length=64, unique=True)
+    file = models.FileField(upload_to=upload_path, max_length=255)
+    size = models.BigIntegerField()
+    etag = models.CharField(max_length=255, null=True, blank=True)
+    refcount = models.PositiveIntegerField(default=0)
+    date_created = models.DateTimeField(default=now)
+
+    objects = DownloadBlobManager()
+
+    def __unicode__(self):
+        return u'%s (%d)' % (self.digest, self.refcount)
+
+
 class PhotoDownload(models.Model):
 
     def upload_path(self, filename):
@@ -789,6 +1041,144 @@ class PhotoDownload(models.Model):
     size = models.CharField(max_length=11, choices=[(v['label'], k) for k, v in FLICKR_PHOTO_SIZES.iteritems()])
     errors = models.TextField(null=True, blank=True)
     date_downloaded = models.DateTimeField(auto_now=True, auto_now_add=True)
+    # #an interrupted download is kept in partial_path and resumed from there with a Range request
+    partial_path = models.CharField(max_length=255, null=True, blank=True)
+    bytes_received = models.BigIntegerField(default=0)
+    content_length = models.BigIntegerField(null=True, blank=True)
+    complete = models.BooleanField(default=False)
+    blob = models.ForeignKey(DownloadBlob, null=True, blank=True, on_delete=models.SET_NULL)
 
     def __unicode__(self):
         return u'%s' % str(self.photo)
+
+
+def release_blob(sender, instance, **kwargs):
+    """A deleted download (by itself or with its photo) doesn't reference its blob any more"""
+    DownloadBlob.objects.release(instance.blob_id)
+
+post_delete.connect(release_blob, sender=PhotoDownload)
+
+
+DOWNLOAD_PRIORITIES = ('recent', 'public')
+
+
+def download_priority(date_posted, ispublic, priority_by=None):
+    """Priority of a photo's download, the higher the sooner: the minute it was posted
+    with 'recent', 1 for public photos (0 for the others) with 'public'."""
+    if priority_by == 'recent':
+        return calendar.timegm(date_posted.utctimetuple()) // 60 if date_posted else 0
+    if priority_by == 'public':
+        return 1 if ispublic else 0
+    return 0
+
+
+class DownloadTaskManager(models.Manager):
+
+    def enqueue(self, photos, size, priority_by=None, requeue=False):
+        """Queue a download of the size for every photo of the queryset having none yet,
+        with requeue the ones already queued (done or failed) are pending again. With priority_by
+        the tasks already queued get the priority it gives too. Tasks a downloader is working on
+        (claimed less than FLICKR_DOWNLOAD_CLAIM_TIMEOUT ago) are left alone.
+        Returns how many tasks were added."""
+        timeout = getattr(settings, 'FLICKR_DOWNLOAD_CLAIM_TIMEOUT', 3600)
+        queued = self.filter(photo__in=photos, size=size).exclude(
+            status=DownloadTask.CLAIMED, claimed_at__gte=now() - datetime.timedelta(seconds=timeout))
+        if requeue:
+            queued.update(status=DownloadTask.PENDING, attempts=0, next_retry=None, claimed_by=None, claimed_at=None)
+        if priority_by:
+            changed = {}
+            for pk, priority, date_posted, ispublic in queued.exclude(status=DownloadTask.DONE).values_list(
+                    'pk', 'priority', 'photo__date_posted', 'photo__ispublic'):
+                new_priority = download_priority(date_posted, ispublic, priority_by)
+                if new_priority != priority:
+                    changed.setdefault(new_priority, []).append(pk)
+            for priority, ids in changed.items():
+                for chunk in chunked(ids, 500):
+                    self.filter(pk__in=chunk).update(priority=priority)
+        # #ids only, no cursor left open on the table being written to
+        new = list(photos.exclude(downloadtask__size=size).values_list('id', 'date_posted', 'ispublic'))
+        added = 0
+        for chunk in chunked(new, 500):
+            tasks = [self.model(photo_id=photo_id, size=size, priority=download_priority(date_posted, ispublic, priority_by))
+                     for photo_id, date_posted, ispublic in chunk]
+            try:
+                self.bulk_create(tasks)
+                added += len(tasks)
+            except IntegrityError:
+                # #queued by another process in the meantime, one at a time then
+                transaction.rollback_unless_managed()
+                for task in tasks:
+                    task, created = self.get_or_create(photo_id=task.photo_id, size=size, defaults={'priority': task.priority})
+                    added += created
+        return added
+
+    def ready(self, size=None, photos=None, when=None, timeout=None):
+        """Tasks to run: pending ones whose retry time has come, and the ones claimed more than
+        timeout seconds ago (FLICKR_DOWNLOAD_CLAIM_TIMEOUT) by a downloader which didn't finish them."""
+        when = when or now()
+        if timeout is None:
+            timeout = getattr(settings, 'FLICKR_DOWNLOAD_CLAIM_TIMEOUT', 3600)
+        tasks = self.filter(models.Q(status=DownloadTask.PENDING, next_retry=None) |
+                            models.Q(status=DownloadTask.PENDING, next_retry__lte=when) |
+                            models.Q(status=DownloadTask.CLAIMED, claimed_at__lt=when - datetime.timedelta(seconds=timeout)))
+        if size:
+            tasks = tasks.filter(size=size)
+        return tasks.filter(photo__in=photos) if photos is not None else tasks
+
+    def claim(self, worker, size=None, photos=None, limit=100, timeout=None, when=None):
+        """Up to limit tasks ready at when (now by default), the highest priority first, claimed by worker
+        (one more attempt each). The rows are locked while claimed (SELECT ... FOR UPDATE) and only the
+        ones still ready are updated, so several downloader processes never get the same task."""
+        when = when or now()
+        token = '%s %s' % (worker, uuid.uuid4().hex[:12])  # #this claim only, the worker may claim more
+        with transaction.commit_on_success():
+            ready = self.ready(size, photos, when, timeout)
+            ids = list(ready.select_for_update().order_by('-priority', 'pk').values_list('pk', flat=True)[:limit])
+            if ids:
+                ready.filter(pk__in=ids).update(status=DownloadTask.CLAIMED, claimed_by=token, claimed_at=now(),
+                                                attempts=models.F('attempts') + 1)
+        return list(self.filter(claimed_by=token, status=DownloadTask.CLAIMED).select_related('photo')
+                    .order_by('-priority', 'pk'))
+
+
+class DownloadTask(models.Model):
+    """A photo size waiting in the download queue of flickr_download. Failed downloads are
+    tried again later, the delay doubling each time (FLICKR_DOWNLOAD_RETRY_DELAY), until
+    FLICKR_DOWNLOAD_MAX_ATTEMPTS."""
+
+    PENDING, CLAIMED, DONE, FAILED = 'pending', 'claimed', 'done', 'failed'
+    STATUSES = ((PENDING, 'pending'), (CLAIMED, 'claimed'), (DONE, 'done'), (FAILED, 'failed'))
+
+    photo = models.ForeignKey(Photo)
+    size = models.CharField(max_length=11, choices=[(v['label'], k) for k, v in FLICKR_PHOTO_SIZES.iteritems()])
+    status = models.CharField(max_length=10, choices=STATUSES, default=PENDING, db_index=True)
+    priority = models.IntegerField(default=0, db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    next_retry = models.DateTimeField(null=True, blank=True)
+    claimed_by = models.CharField(max_length=100, null=True, blank=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(null=True, blank=True)
+    date_created = models.DateTimeField(default=now)
+    date_updated = models.DateTimeField(auto_now=True)
+
+    objects = DownloadTaskManager()
+
+    class Meta:
+        unique_together = (('photo', 'size'),)
+
+    def __unicode__(self):
+        return u'%s %s (%s)' % (self.photo_id, self.size, self.status)
+
+    def finish(self):
+        self.status, self.last_error, self.next_retry = DownloadTask.DONE, None, None
+        self.save()
+
+    def fail(self, error):
+        """Schedule the next attempt, or give up after the last one"""
+        self.last_error = error
+        if self.attempts >= getattr(settings, 'FLICKR_DOWNLOAD_MAX_ATTEMPTS', 5):
+            self.status, self.next_retry = DownloadTask.FAILED, None
+        else:
+            delay = getattr(settings, 'FLICKR_DOWNLOAD_RETRY_DELAY', 60) * 2 ** max(0, self.attempts - 1)
+            self.status, self.next_retry = DownloadTask.PENDING, now() + datetime.timedelta(seconds=delay)
+        self.save()
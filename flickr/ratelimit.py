@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Token bucket rate limiting for Flickr API calls.
+
+Flickr allows 3600 queries per hour per key. Instead of sleeping a fixed time
+between calls, every call takes a token from a bucket refilled at the allowed
+rate, so we only wait when we are actually going too fast. The limiter backs
+off when Flickr answers 429/503 and recovers gradually afterwards.
+"""
+from contextlib import contextmanager
+import json
+import threading
+import time
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600}
+
+
+def parse_rate(rate):
+    """'3600/h', '60/m', '1/s' or a number of calls per second -> (calls, period in seconds)"""
+    if isinstance(rate, basestring) and '/' in rate:
+        calls, unit = rate.split('/', 1)
+        unit = unit.strip().lower()
+        return float(calls), float(PERIODS[unit[:1]] if unit[:1] in PERIODS else unit)
+    return float(rate), 1.0
+
+
+class RateLimiter(object):
+    """Token bucket shared by all threads in the process.
+
+    @params calls, period: allowed rate, f.ex. calls=3600, period=3600
+    @params burst: how many calls can be made at once after idling (default: one second worth of calls)
+    """
+
+    def __init__(self, calls=1, period=1, burst=None):
+        self.max_rate = self.rate = float(calls) / period
+        self.min_rate = self.max_rate / 32
+        self.burst = float(burst or max(1, self.max_rate))
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.blocked_until = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _state(self):
+        """Guards (and in subclasses loads/stores) the bucket state."""
+        with self._lock:
+            yield
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + max(now - self.updated, 0) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """Take a token, sleeping until it's available. Returns the time slept."""
+        with self._state():
+            now = time.time()
+            self._refill(now)
+            self.tokens -= 1
+            wait = max(-self.tokens / self.rate, self.blocked_until - now, 0)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def throttled(self, retry_after=None):
+        """Flickr told us to slow down: halve the rate and pause for retry_after seconds."""
+        with self._state():
+            now = time.time()
+            self._refill(now)
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+            try:
+                pause = float(retry_after)
+            except (TypeError, ValueError):
+                pause = 1 / self.rate
+            self.blocked_until = max(self.blocked_until, now + pause)
+
+    def success(self):
+        """Call went through: recover the rate step by step after throttling."""
+        with self._state():
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class FileRateLimiter(RateLimiter):
+    """Token bucket kept in a file and guarded with flock(), so several processes
+    (f.ex. cron jobs for different users with the same API key) share one budget."""
+
+    def __init__(self, path, calls=1, period=1, burst=None):
+        super(FileRateLimiter, self).__init__(calls, period, burst)
+        self.path = path
+
+    @contextmanager
+    def _state(self):
+        import fcntl
+        with self._lock:
+            with open(self.path, 'a+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    try:
+                        state = json.loads(f.read())
+                        self.tokens, self.updated = state['tokens'], state['updated']
+                        self.rate, self.blocked_until = state['rate'], state['blocked_until']
+                    except (ValueError, KeyError):
+                        pass  # #new or broken file, start with a full bucket
+                    yield
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps({'tokens': self.tokens, 'updated': self.updated,
+                                        'rate': self.rate, 'blocked_until': self.blocked_until}))
+                    f.flush()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Retrying failed Flickr API calls.
+
+Timeouts, 5xx answers and some Flickr errors ('stat': 'fail' with a code
+telling the service is unavailable) go away when the call is made again a bit
+later. Calls failing that way are retried with an exponential backoff (with
+jitter, so parallel workers don't retry all at once) instead of being lost.
+Only calls that can safely be made twice (reading methods) are retried after
+the request may have reached Flickr.
+"""
+from collections import defaultdict
+from urllib2 import HTTPError, URLError
+import httplib
+import random
+import socket
+import threading
+import time
+
+
+# #f.ex. 105 'Service currently unavailable', 201 'Sorry, the Flickr API service is not currently available'
+TRANSIENT_STAT_CODES = (10, 105, 106, 201)
+TRANSIENT_STATUS_CODES = (429, 500, 502, 503, 504)
+IDEMPOTENT_PREFIXES = ('get', 'search', 'recently', 'check', 'find', 'lookup', 'echo', 'login')
+
+
+class RetryPolicy(object):
+    """When and how long to wait before calling again.
+
+    @params retries: how many times a call is made again at most
+    @params backoff: seconds to wait before the first retry, doubled for every next one
+    @params max_backoff: longest wait between two attempts
+    @params jitter: part of the wait randomly taken off (0 to 1)"""
+
+    def __init__(self, retries=3, backoff=0.5, max_backoff=30, jitter=0.5,
+                 status_codes=TRANSIENT_STATUS_CODES, stat_codes=TRANSIENT_STAT_CODES):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.status_codes = status_codes
+        self.stat_codes = [str(code) for code in stat_codes]
+        self.counts = defaultdict(int)  # #retries per method
+        self.failures = defaultdict(int)  # #calls still failing after all the retries, per method
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def is_idempotent(method):
+        """Reading methods can be called twice without side effects"""
+        return method.split('.')[-1].startswith(IDEMPOTENT_PREFIXES)
+
+    def is_transient(self, method, error=None, data=None):
+        if error is not None:
+            if isinstance(error, HTTPError):
+                # #429: Flickr didn't process the call, fine to make it again whatever the method
+                return error.code in self.status_codes and (error.code == 429 or self.is_idempotent(method))
+            if isinstance(error, (socket.error, httplib.HTTPException, URLError)):
+                return self.is_idempotent(method)
+            return False
+        return (isinstance(data, dict) and data.get('stat') == 'fail' and
+                str(data.get('code')) in self.stat_codes and self.is_idempotent(method))
+
+    @staticmethod
+    def normalize_method(method):
+        return method if method.startswith('flickr.') else 'flickr.%s' % method
+
+    def should_retry(self, method, attempt, error=None, data=None):
+        """Is it worth calling again after attempt (0 for the first call) failed with error or returned data"""
+        if not self.is_transient(method, error, data):
+            return False
+        if attempt >= self.retries:
+            with self._lock:
+                self.failures[self.normalize_method(method)] += 1
+            return False
+        return True
+
+    def delay(self, attempt):
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return delay * (1 - self.jitter * random.random())
+
+    def wait(self, method, attempt):
+        with self._lock:
+            self.counts[self.normalize_method(method)] += 1
+        time.sleep(self.delay(attempt))
+
+    def stats(self):
+        """{method: (retries, failures)}"""
+        with self._lock:
+            return dict((method, (self.counts[method], self.failures[method])) for method in set(self.counts) | set(self.failures))
@@ -1,14 +1,173 @@
 from bunch import bunchify
 from django.conf import settings
-from flickr.api import FlickrApi
+from django.utils.importlib import import_module
+from flickr.api import FlickrApi, AsyncFlickrApi
+from flickr.flickr_spec import FLICKR_URL_EXTRAS
 from flickr.models import FlickrUser
+from flickr.cache import ResponseCache
+from flickr.instrumentation import Instrumentation
+from flickr.retry import RetryPolicy
+from flickr.ratelimit import RateLimiter, FileRateLimiter, parse_rate
+from flickr.utils import WorkerPool
+from collections import namedtuple, deque
+import calendar
+import datetime
+import itertools
+import Queue
+import threading
 import time
 
 
 FLICKR_KEY = getattr(settings, 'FLICKR_KEY', None)
 FLICKR_SECRET = getattr(settings, 'FLICKR_SECRET', None)
 
-ALL_EXTRAS = 'description, license, date_upload, date_taken, owner_name, icon_server, original_format, last_update, geo, tags, machine_tags, o_dims, views, media, path_alias'
+FLICKR_API_ENDPOINT = getattr(settings, 'FLICKR_API_ENDPOINT', None)  # #f.ex. a local flickr_fake_server
+
+FLICKR_TRANSPORT = getattr(settings, 'FLICKR_TRANSPORT', 'flickr.transport.HttpTransport')
+FLICKR_TRANSPORT_POOL_SIZE = getattr(settings, 'FLICKR_TRANSPORT_POOL_SIZE', 4)
+FLICKR_TRANSPORT_TIMEOUT = getattr(settings, 'FLICKR_TRANSPORT_TIMEOUT', 30)
+
+FLICKR_RATE_LIMIT = getattr(settings, 'FLICKR_RATE_LIMIT', '3600/h')
+FLICKR_RATE_LIMIT_BURST = getattr(settings, 'FLICKR_RATE_LIMIT_BURST', None)
+FLICKR_RATE_LIMIT_FILE = getattr(settings, 'FLICKR_RATE_LIMIT_FILE', None)
+
+FLICKR_RETRIES = getattr(settings, 'FLICKR_RETRIES', 3)
+FLICKR_RETRY_BACKOFF = getattr(settings, 'FLICKR_RETRY_BACKOFF', 0.5)
+FLICKR_RETRY_MAX_BACKOFF = getattr(settings, 'FLICKR_RETRY_MAX_BACKOFF', 30)
+
+FLICKR_CACHE_BACKEND = getattr(settings, 'FLICKR_CACHE_BACKEND', None)
+FLICKR_CACHE_OPTIONS = getattr(settings, 'FLICKR_CACHE_OPTIONS', {})
+FLICKR_CACHE_TTLS = getattr(settings, 'FLICKR_CACHE_TTLS', {})
+
+# #f.ex. ['flickr.instrumentation.LoggingSink', ('flickr.instrumentation.StatsdSink', {'port': 8125})]
+FLICKR_INSTRUMENTATION_SINKS = getattr(settings, 'FLICKR_INSTRUMENTATION_SINKS', [])
+
+FLICKR_PAGE_WORKERS = getattr(settings, 'FLICKR_PAGE_WORKERS', 4)
+FLICKR_ASYNC_WORKERS = getattr(settings, 'FLICKR_ASYNC_WORKERS', 16)
+
+ALL_EXTRAS = 'description, license, date_upload, date_taken, owner_name, icon_server, original_format, last_update, geo, tags, machine_tags, o_dims, views, media, path_alias, ' + FLICKR_URL_EXTRAS
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def make_transport(pool_size=None):
+    """A new FLICKR_TRANSPORT, f.ex. with more connections per host for downloads."""
+    module, name = FLICKR_TRANSPORT.rsplit('.', 1)
+    transport_class = getattr(import_module(module), name)
+    return transport_class(pool_size=pool_size or FLICKR_TRANSPORT_POOL_SIZE, timeout=FLICKR_TRANSPORT_TIMEOUT)
+
+
+def get_transport():
+    """One connection pool per process, shared by all the shortcuts and commands."""
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            _transport = make_transport()
+    return _transport
+
+
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """One token bucket per process (or per FLICKR_RATE_LIMIT_FILE, shared between processes)."""
+    global _rate_limiter
+    with _rate_limiter_lock:
+        if _rate_limiter is None and FLICKR_RATE_LIMIT:
+            calls, period = parse_rate(FLICKR_RATE_LIMIT)
+            if FLICKR_RATE_LIMIT_FILE:
+                _rate_limiter = FileRateLimiter(FLICKR_RATE_LIMIT_FILE, calls, period, FLICKR_RATE_LIMIT_BURST)
+            else:
+                _rate_limiter = RateLimiter(calls, period, FLICKR_RATE_LIMIT_BURST)
+    return _rate_limiter
+
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """Cache of API responses shared in the process, None unless FLICKR_CACHE_BACKEND is set."""
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is None and FLICKR_CACHE_BACKEND:
+            module, name = FLICKR_CACHE_BACKEND.rsplit('.', 1)
+            backend = getattr(import_module(module), name)(**FLICKR_CACHE_OPTIONS)
+            _response_cache = ResponseCache(backend, FLICKR_CACHE_TTLS)
+    return _response_cache
+
+
+_retry_policy = None
+_retry_policy_lock = threading.Lock()
+
+
+def get_retry_policy():
+    """One retry policy (and retry counters) per process, None if FLICKR_RETRIES is 0."""
+    global _retry_policy
+    with _retry_policy_lock:
+        if _retry_policy is None and FLICKR_RETRIES:
+            _retry_policy = RetryPolicy(FLICKR_RETRIES, FLICKR_RETRY_BACKOFF, FLICKR_RETRY_MAX_BACKOFF)
+    return _retry_policy
+
+
+_instrumentation = None
+_instrumentation_lock = threading.Lock()
+
+
+def get_instrumentation():
+    """Sinks of the API call events in the process, the ones in FLICKR_INSTRUMENTATION_SINKS
+    plus the ones added at runtime (f.ex. the summary table of flickr_sync)."""
+    global _instrumentation
+    with _instrumentation_lock:
+        if _instrumentation is None:
+            sinks = []
+            for sink in FLICKR_INSTRUMENTATION_SINKS:
+                path, options = (sink, {}) if isinstance(sink, basestring) else sink
+                module, name = path.rsplit('.', 1)
+                sinks.append(getattr(import_module(module), name)(**options))
+            _instrumentation = Instrumentation(sinks)
+    return _instrumentation
+
+
+def set_rate_limiter(rate_limiter):
+    """Replace the process rate limiter, f.ex. with a per-user budget in flickr_sync_all workers."""
+    global _rate_limiter
+    with _rate_limiter_lock:
+        _rate_limiter = rate_limiter
+
+
+def get_api(token=None, **kwargs):
+    kwargs.setdefault('rate_limiter', get_rate_limiter())
+    kwargs.setdefault('cache', get_response_cache())
+    kwargs.setdefault('retry_policy', get_retry_policy())
+    kwargs.setdefault('instrumentation', get_instrumentation())
+    kwargs.setdefault('endpoint', FLICKR_API_ENDPOINT)
+    return FlickrApi(FLICKR_KEY, FLICKR_SECRET, token, transport=get_transport(), **kwargs)
+
+
+_async_pool = None
+_async_pool_lock = threading.Lock()
+
+
+def get_async_pool():
+    """Threads running the calls of AsyncFlickrApi and the *_async shortcuts (FLICKR_ASYNC_WORKERS of them)."""
+    global _async_pool
+    with _async_pool_lock:
+        if _async_pool is None:
+            _async_pool = WorkerPool(FLICKR_ASYNC_WORKERS)
+    return _async_pool
+
+
+def get_async_api(token=None, **kwargs):
+    kwargs.setdefault('rate_limiter', get_rate_limiter())
+    kwargs.setdefault('cache', get_response_cache())
+    kwargs.setdefault('retry_policy', get_retry_policy())
+    kwargs.setdefault('instrumentation', get_instrumentation())
+    kwargs.setdefault('endpoint', FLICKR_API_ENDPOINT)
+    return AsyncFlickrApi(FLICKR_KEY, FLICKR_SECRET, token, transport=get_transport(), pool=get_async_pool(), **kwargs)
+
 
 def get_token_for_user(user):
     try:
@@ -18,85 +177,296 @@ def get_token_for_user(user):
         return None
 
 
-def get_photos_json(nsid, token, page=1, per_page=500, min_upload_date=None, extras=None):
-    api = FlickrApi(FLICKR_KEY, FLICKR_SECRET, token)
-    return bunchify(api.get(method='people.getPhotos', user_id=nsid, page=page, per_page=per_page, min_upload_date=min_upload_date, extras=extras))
+def get_photos_json(nsid, token, page=1, per_page=500, min_upload_date=None, extras=None, max_upload_date=None):
+    api = get_api(token)
+    return bunchify(api.get(method='people.getPhotos', user_id=nsid, page=page, per_page=per_page, min_upload_date=min_upload_date,
+                            max_upload_date=max_upload_date, extras=extras))
+
+
+def get_recently_updated_json(token, min_date, page=1, per_page=500, extras=None):
+    """Photos of the token's owner created or modified since min_date (datetime, date or unix timestamp)"""
+    api = get_api(token)
+    return bunchify(api.get(method='photos.recentlyUpdated', min_date=to_timestamp(min_date), page=page, per_page=per_page, extras=extras))
+
 
+def to_timestamp(value):
+    """datetime/date -> unix timestamp, as expected by Flickr's min_date arguments"""
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            return calendar.timegm(value.utctimetuple())
+        return int(time.mktime(value.timetuple()))
+    if isinstance(value, datetime.date):
+        return int(time.mktime(value.timetuple()))
+    return value
 
-def get_all_photos(nsid, token, page=None, per_page=None, min_upload_date=None, extras=None):
-    data = get_photos_json(nsid, token, page, per_page, min_upload_date, extras)
-    user_photos = data.photos
-    #per_page = user_photos.perpage
-    #page = user_photos.page
-    pages = user_photos.pages
-    total = int(user_photos.total)
-    photos = user_photos.photo
-    if pages > 1 and not page:
-        for page in range(2, pages + 1):
-            time.sleep(1)
-            data = get_photos_json(nsid, token, page, per_page, extras=extras)
-            photos += data.photos.photo
-    if not page and len(photos) != total:
-        raise Exception, "Photos number don't match (%d != %d)" % (len(photos), total)
-    return photos
+
+class PhotoStream(object):
+    """All photos of the user (or one page of them if page is given), fetched page by page.
+
+    The first page is fetched right away to know total and pages. Iterating
+    yields photos while the following pages are prefetched by workers threads
+    (FLICKR_PAGE_WORKERS by default), so only a few pages are held in memory.
+    When the stream ends, the number of photos is checked against total.
+
+    To resume an interrupted listing, start_page skips the pages before it and
+    after skips the photos of start_page up to (and including) that photo id.
+    max_upload_date (the upload date of the last photo done) lists the rest
+    whatever was uploaded or deleted meanwhile, after then skips the photos
+    of that second already done."""
+
+    def __init__(self, nsid, token, page=None, per_page=None, min_upload_date=None, extras=None, workers=None,
+                 start_page=None, after=None, max_upload_date=None):
+        self.fetch = lambda page: get_photos_json(nsid, token, page, per_page, min_upload_date, extras, max_upload_date).photos
+        self._start(page, workers, start_page, after)
+
+    def _start(self, page, workers, start_page=None, after=None):
+        self.page = page
+        self.start_page = int(page or start_page or 1)
+        self.after = after
+        self.first = self.fetch(self.start_page)
+        self.pages = int(self.first.pages) if not page else self.start_page
+        self.total = int(self.first.total) if not page else len(self.first.photo)
+        self.per_page = int(self.first.get('perpage') or len(self.first.photo))
+        self.workers = workers or FLICKR_PAGE_WORKERS
+
+    def iter_pages(self):
+        first, self.first = self.first, None
+        if first is None:
+            raise Exception, 'PhotoStream can be iterated only once'
+        pool = WorkerPool(self.workers)
+        try:
+            following = pool.imap(self.fetch, range(self.start_page + 1, self.pages + 1))
+            yield first
+            del first
+            for data in following:
+                yield data
+        finally:
+            pool.shutdown()
+
+    def iter_with_pages(self):
+        """Yields (page number, photo)"""
+        count = 0
+        if not self.page:
+            count = (self.start_page - 1) * self.per_page
+        for data in self.iter_pages():
+            photos = data.photo
+            if self.after is not None:
+                ids = [str(photo.id) for photo in photos]
+                if str(self.after) in ids:
+                    skip = ids.index(str(self.after)) + 1
+                    count, photos = count + skip, photos[skip:]
+                self.after = None
+            for photo in photos:
+                count += 1
+                yield int(data.page), photo
+        if not self.page and count != self.total:
+            raise Exception, "Photos number don't match (%d != %d)" % (count, self.total)
+
+    def __iter__(self):
+        for page, photo in self.iter_with_pages():
+            yield photo
+
+
+class RecentlyUpdatedStream(PhotoStream):
+    """Same as PhotoStream, but lists only the photos created or modified
+    since min_date (flickr.photos.recentlyUpdated), so an incremental sync
+    costs a request per page of changes instead of per page of the library."""
+
+    def __init__(self, token, min_date, page=None, per_page=None, extras=None, workers=None, start_page=None, after=None):
+        self.fetch = lambda page: get_recently_updated_json(token, min_date, page, per_page, extras).photos
+        self._start(page, workers, start_page, after)
+
+
+def iter_recently_updated(token, min_date, page=None, per_page=None, extras=None, workers=None, start_page=None, after=None):
+    return RecentlyUpdatedStream(token, min_date, page, per_page, extras, workers, start_page, after)
+
+
+def iter_all_photos(nsid, token, page=None, per_page=None, min_upload_date=None, extras=None, workers=None,
+                    start_page=None, after=None, max_upload_date=None):
+    return PhotoStream(nsid, token, page, per_page, min_upload_date, extras, workers, start_page, after, max_upload_date)
+
+
+def get_all_photos(nsid, token, page=None, per_page=None, min_upload_date=None, extras=None, workers=None):
+    return list(iter_all_photos(nsid, token, page, per_page, min_upload_date, extras, workers))
 
 
 def get_photo_details_jsons(photo_id, token):
-    api = FlickrApi(FLICKR_KEY, FLICKR_SECRET, token)
-    info = api.get(method='photos.getInfo', photo_id=photo_id)
-    time.sleep(1)
-    sizes = api.get(method='photos.getSizes', photo_id=photo_id)
-    time.sleep(1)
-    exif = api.get(method='photos.getExif', photo_id=photo_id)
-    time.sleep(1)
-    geo = api.get(method='photos.geo.getLocation', photo_id=photo_id)
-    return info, sizes, exif, geo
+    """info, sizes, exif and geo of the photo, the 4 calls made at once"""
+    # #own threads, this can run in the shared pool itself (get_photo_details_jsons_async)
+    fetcher = PhotoDetailFetcher(token, workers=len(DETAIL_KINDS))
+    try:
+        details = fetcher.fetch(photo_id)
+    finally:
+        fetcher.close()
+    for kind in DETAIL_KINDS:
+        if kind in details.errors:
+            raise details.errors[kind]
+    return details.info, details.sizes, details.exif, details.geo
+
+
+DETAIL_KINDS = ('info', 'sizes', 'exif', 'geo')
+
+PhotoDetails = namedtuple('PhotoDetails', 'photo_id info sizes exif geo errors')
+
+
+class PhotoDetailFetcher(object):
+    """Fetches the per-photo data (getInfo, getSizes, getExif, geo.getLocation) of a stream of photos.
+
+    Every call is a separate task in a pool of threads, so the calls for several
+    photos are in flight at once over the pooled connections. A PhotoDetails
+    (photo_id, info, sizes, exif, geo, errors) is yielded as soon as all the
+    calls of a photo are done. A failing call doesn't drop the photo: its data
+    is None and the exception is in errors[kind].
+
+    @params kinds: which of DETAIL_KINDS to fetch
+    @params workers: calls at once, in a pool of the fetcher (close() it), by default the shared async pool
+    @params ordered: yield in the order of photo_ids, otherwise as soon as done
+    @params lookahead: photos in flight at once
+
+    photo_ids can also be (photo_id, kinds) to fetch less for some photos."""
+
+    def __init__(self, token, kinds=DETAIL_KINDS, workers=None, ordered=True, lookahead=None):
+        self.token = token
+        self.kinds = [kind for kind in DETAIL_KINDS if kind in kinds]
+        self.own_pool = workers is not None
+        self.pool = WorkerPool(workers) if self.own_pool else get_async_pool()
+        self.ordered = ordered
+        self.lookahead = lookahead or self.pool.workers * 2
+
+    def _call(self, kind, photo_id):
+        # #looked up on call, so the shortcuts can be replaced (f.ex. in tests)
+        return globals()['get_photo_%s_json' % kind](photo_id=photo_id, token=self.token)
+
+    def _submit(self, photo_id, callback=None):
+        kinds = self.kinds
+        if isinstance(photo_id, tuple):
+            photo_id, kinds = photo_id[0], [kind for kind in self.kinds if kind in photo_id[1]]
+        futures = [(kind, self.pool.submit(self._call, kind, photo_id)) for kind in kinds]
+        if callback is not None:
+            remaining = [len(futures)]
+            lock = threading.Lock()
+
+            def done(future):
+                with lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                if last:
+                    callback((photo_id, futures))
+            if futures:
+                for kind, future in futures:
+                    future.add_done_callback(done)
+            else:
+                callback((photo_id, futures))
+        return photo_id, futures
+
+    def _result(self, photo_id, futures):
+        data, errors = {}, {}
+        for kind, future in futures:
+            if future.exception() is not None:
+                errors[kind] = future.exception()
+            else:
+                data[kind] = future.result()
+        return PhotoDetails(photo_id, data.get('info'), data.get('sizes'), data.get('exif'), data.get('geo'), errors)
+
+    def fetch(self, photo_id):
+        """PhotoDetails of one photo, its calls are made at once"""
+        return self._result(*self._submit(photo_id))
+
+    def iter_details(self, photo_ids):
+        photo_ids = iter(photo_ids)
+        if self.ordered:
+            pending = deque(self._submit(photo_id) for photo_id in itertools.islice(photo_ids, self.lookahead))
+            while pending:
+                photo_id, futures = pending.popleft()
+                for next_id in itertools.islice(photo_ids, 1):
+                    pending.append(self._submit(next_id))
+                yield self._result(photo_id, futures)
+        else:
+            done = Queue.Queue()
+            in_flight = 0
+            for photo_id in itertools.islice(photo_ids, self.lookahead):
+                self._submit(photo_id, done.put)
+                in_flight += 1
+            while in_flight:
+                photo_id, futures = done.get()
+                in_flight -= 1
+                for next_id in itertools.islice(photo_ids, 1):
+                    self._submit(next_id, done.put)
+                    in_flight += 1
+                yield self._result(photo_id, futures)
+
+    def close(self):
+        if self.own_pool:
+            self.pool.shutdown()
 
 
 def get_photo_info_json(photo_id, token):
-    api = FlickrApi(FLICKR_KEY, FLICKR_SECRET, token)
+    api = get_api(token)
     info = api.get(method='photos.getInfo', photo_id=photo_id)
     return info
 
 
 def get_photo_exif_json(photo_id, token):
-    api = FlickrApi(FLICKR_KEY, FLICKR_SECRET, token)
+    api = get_api(token)
     exif = api.get(method='photos.getExif', photo_id=photo_id)
     return exif
 
 
 def get_photo_sizes_json(photo_id, token):
-    api = FlickrApi(FLICKR_KEY, FLICKR_SECRET, token)
+    api = get_api(token)
     sizes = api.get(method='photos.getSizes', photo_id=photo_id)
     return sizes
 
 def get_photo_geo_json(photo_id, token):
-    api = FlickrApi(FLICKR_KEY, FLICKR_SECRET, token)
+    api = get_api(token)
     geo = api.get(method='photos.geo.getLocation', photo_id=photo_id)
     return geo
 
 
 def get_photosets_json(nsid, token):
-    api = FlickrApi(FLICKR_KEY, FLICKR_SECRET, token)
+    api = get_api(token)
     return bunchify(api.get(method='flickr.photosets.getList', user_id=nsid, page=1, per_page=500))
 
 
 def get_photoset_photos_json(photoset_id, token):
-    api = FlickrApi(FLICKR_KEY, FLICKR_SECRET, token)
+    api = get_api(token)
     return bunchify(api.get(method='flickr.photosets.getPhotos', photoset_id=photoset_id))
 
 
 def get_user_json(nsid, token):
-    api = FlickrApi(FLICKR_KEY, FLICKR_SECRET, token)
+    api = get_api(token)
     return bunchify(api.get(method='flickr.people.getInfo', user_id=nsid))
 
 
 def get_collections_tree_json(nsid, token):
     """tree for user or tree for collection"""
-    api = FlickrApi(FLICKR_KEY, FLICKR_SECRET, token)
+    api = get_api(token)
     return bunchify(api.get(method='collections.getTree', user_id=nsid))
 
 
 def get_collection_info_json(collection_id, token):
-    api = FlickrApi(FLICKR_KEY, FLICKR_SECRET, token)
+    api = get_api(token)
     return bunchify(api.get(method='collections.getInfo', collection_id=collection_id))
+
+
+def _async(name):
+    """Non blocking version of the shortcut called name: same arguments, returns a flickr.utils.Future"""
+    def call(*args, **kwargs):
+        return get_async_pool().submit(globals()[name], *args, **kwargs)
+    call.__name__ = '%s_async' % name
+    call.__doc__ = 'Same as %s, but returns a Future' % name
+    return call
+
+
+get_photos_json_async = _async('get_photos_json')
+get_recently_updated_json_async = _async('get_recently_updated_json')
+get_photo_details_jsons_async = _async('get_photo_details_jsons')
+get_photo_info_json_async = _async('get_photo_info_json')
+get_photo_exif_json_async = _async('get_photo_exif_json')
+get_photo_sizes_json_async = _async('get_photo_sizes_json')
+get_photo_geo_json_async = _async('get_photo_geo_json')
+get_photosets_json_async = _async('get_photosets_json')
+get_photoset_photos_json_async = _async('get_photoset_photos_json')
+get_user_json_async = _async('get_user_json')
+get_collections_tree_json_async = _async('get_collections_tree_json')
+get_collection_info_json_async = _async('get_collection_info_json')
@@ -0,0 +1,5 @@
+from django.dispatch import Signal
+
+
+# #sent by flickr.instrumentation.SignalSink after every API call, event is a flickr.instrumentation.ApiCallEvent
+api_call = Signal(providing_args=['event'])
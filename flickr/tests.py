@@ -1,20 +1,103 @@
 #!/usr/bin/env python
 # encoding: utf-8
 from bunch import bunchify
-from datetime import datetime
+from datetime import datetime, timedelta
 from django.contrib.auth.models import User
+from django.core.files.storage import FileSystemStorage
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
 from django.template.base import TemplateDoesNotExist
 from django.test import TestCase
 from django.test.client import Client
 from django.test.utils import override_settings
-from flickr.flickr_spec import FLICKR_PHOTO_SIZES
-from flickr.models import FlickrUser, Photo, PhotoSet, Collection
+from django.utils.encoding import force_unicode
+from django.utils.timezone import now, utc
+from flickr.benchmark import Benchmark, SCENARIOS, table, using_server, quiet
+from flickr.cache import ResponseCache, MemoryCache, FileCache
+from flickr.fakeserver import FakeAccount, FakeFlickr, FakeFlickrServer
+from flickr.flickr_spec import FLICKR_PHOTO_SIZES, FLICKR_URL_EXTRAS
+from flickr.management.commands import flickr_sync_all
+from flickr.management.commands.flickr_download import Command as DownloadCommand
+from flickr.management.commands.flickr_fake_server import get_or_create_flickr_user
+from flickr.management.commands.flickr_sync_all import Command as SyncAllCommand, sync_user
+from flickr.instrumentation import Instrumentation, SummarySink, SignalSink, StatsdSink, PhaseTimer, QueryCounter, \
+    phase, peak_rss
+from flickr.ratelimit import RateLimiter, FileRateLimiter, parse_rate
+from flickr.retry import RetryPolicy
+from flickr.transport import HttpTransport
+from flickr.models import FlickrUser, Photo, PhotoSet, Collection, SyncCheckpoint, PhotoDownload, DownloadBlob, DownloadTask
+from flickr.signals import api_call
+from flickr.shortcuts import ALL_EXTRAS, get_rate_limiter, set_rate_limiter
 from flickr.tests_data import json_user, json_sizes, json_exif, json_geo, json_info, \
     json_photos_extras, json_photos, \
     json_set_info, json_set_photos, \
     json_collection_tree_user
-from flickr.utils import unslash
+from flickr.utils import unslash, WorkerPool, as_completed
+from taggit.models import Tag
+from urllib2 import HTTPError
+from urlparse import parse_qs, urlsplit
+import BaseHTTPServer
+import StringIO
+import SocketServer
+import hashlib
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+
+class EchoHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Keep-alive handler answering with the request path, counting connections."""
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        if self.path.startswith('/redirect'):
+            self.send_response(302)
+            self.send_header('Location', '/moved')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        status = 404 if self.path.startswith('/missing') else 200
+        body = json.dumps({'path': self.path, 'stat': 'ok'})
+        if self.path.startswith('/throttle'):
+            status = 429
+        if self.path.startswith('/flaky') and self.server.failures:
+            self.server.failures -= 1
+            status = 500
+        if self.path.startswith('/unavailable'):
+            body = json.dumps({'stat': 'fail', 'code': 105, 'message': 'Service currently unavailable'})
+        self.send_response(status)
+        if status == 429:
+            self.send_header('Retry-After', '0.2')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class EchoServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    connections = 0
+    failures = 0  # #how many calls to /flaky get an error before it works
+
+
+def start_server(handler=EchoHandler, server_class=EchoServer):
+    server = server_class(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d' % server.server_address[1]
 
 
 class FlickrModelTests(TestCase):
@@ -158,6 +241,88 @@ class FlickrModelTests(TestCase):
                 self.assertEqual(unslash(size.source), getattr(photo, FLICKR_PHOTO_SIZES[size.label]['label']).source)
                 self.assertEqual(unslash(size.url), getattr(photo, FLICKR_PHOTO_SIZES[size.label]['label']).url)
 
+    def test_photo_bulk_create(self):
+        FlickrUser.objects.update_from_json(self.flickr_user.id, json_user)
+        flickr_user = FlickrUser.objects.get(pk=self.flickr_user.pk)
+        photos = bunchify(json_photos_extras['photos']['photo'])
+        items = [(photos[0], json_info, json_sizes, json_exif, json_geo)] + photos[1:]
+        for name in ['test'] + [t['_content'] for t in json_info['photo']['tags']['tag']]:
+            Tag.objects.create(name=name)
+        # #photos, their pks, sizes, tags, tagged items
+        with self.assertNumQueries(5):
+            created = Photo.objects.bulk_create_from_json(flickr_user=flickr_user, photos=items, batch_size=10)
+        self.assertEqual(created, 4)
+        self.assertEqual(Photo.objects.filter(user=flickr_user).count(), 4)
+        photo = Photo.objects.get(flickr_id=json_info['photo']['id'])
+        self.assertEqual(photo.title, json_info['photo']['title']['_content'])
+        self.assertEqual(photo.exif_camera, json_exif['photo']['camera'])
+        self.assertEqual(photo.sizes.count(), len(json_sizes['sizes']['size']))
+        self.assertEqual(sorted(t.name for t in photo.tags.all()), sorted(force_unicode(t['_content']) for t in json_info['photo']['tags']['tag']))
+        other = Photo.objects.get(flickr_id=photos[1].id)
+        self.assertEqual([t.name for t in other.tags.all()], ['test'])
+        self.assertEqual(other.large.source, unslash(photos[1].url_l))
+
+    def test_photo_existing_map(self):
+        FlickrUser.objects.update_from_json(self.flickr_user.id, json_user)
+        flickr_user = FlickrUser.objects.get(pk=self.flickr_user.pk)
+        json_photo = bunchify(json_photos_extras['photos']['photo'][0])
+        photo = Photo.objects.create_from_json(flickr_user=flickr_user, photo=json_photo)
+        with self.assertNumQueries(1):
+            existing = Photo.objects.existing_map([json_photo.id, 'not-synced'])
+        self.assertEqual(existing.keys(), [json_photo.id])
+        pk, date_updated, last_sync, sync_hash = existing[json_photo.id]
+        self.assertEqual(pk, photo.pk)
+        self.assertEqual(date_updated, Photo.objects.date_updated_from_json(json_photo, flickr_user))
+        json_photo.lastupdate = str(int(json_photo.lastupdate) + 60)
+        self.assertNotEqual(date_updated, Photo.objects.date_updated_from_json(json_photo, flickr_user))
+
+    def test_photo_is_unchanged(self):
+        FlickrUser.objects.update_from_json(self.flickr_user.id, json_user)
+        flickr_user = FlickrUser.objects.get(pk=self.flickr_user.pk)
+        json_photo = bunchify(json_photos_extras['photos']['photo'][0])
+        Photo.objects.create_from_json(flickr_user=flickr_user, photo=json_photo, exif=json_exif)
+        stored = Photo.objects.existing_map([json_photo.id])[json_photo.id]
+        self.assertTrue(Photo.objects.is_unchanged(stored, flickr_user, json_photo))
+        self.assertTrue(Photo.objects.is_unchanged(stored, flickr_user, json_photo, exif=json_exif))
+        geo = {'photo': {'location': {'latitude': '51.75', 'longitude': '19.45', 'accuracy': '16'}}}
+        self.assertFalse(Photo.objects.is_unchanged(stored, flickr_user, json_photo, exif=json_exif, geo=geo))
+        json_photo.title = 'edited without lastupdate change'
+        self.assertFalse(Photo.objects.is_unchanged(stored, flickr_user, json_photo, exif=json_exif))
+        json_photo.lastupdate = str(int(json_photo.lastupdate) + 60)
+        self.assertFalse(Photo.objects.is_unchanged(stored, flickr_user, json_photo))
+
+    def test_photo_update_sizes(self):
+        json_photo = json_photos_extras['photos']['photo'][0]
+        photo = Photo.objects.create_from_json(flickr_user=self.flickr_user, photo=json_photo, sizes=json_sizes)
+        smaller = {'sizes': {'size': json_sizes['sizes']['size'][:2]}}
+        Photo.objects.update_from_json(self.flickr_user, flickr_id=photo.flickr_id, photo=json_photo, sizes=smaller, update_sizes=True)
+        self.assertEqual(photo.sizes.count(), 2)
+
+    def test_photo_sizes_from_extras(self):
+        json_photo = bunchify(json_photos_extras['photos']['photo'][0])
+        self.assertEqual(Photo.objects.details_in_extras(json_photo), set(['sizes', 'geo']))
+        self.assertEqual(Photo.objects.details_in_extras(bunchify({'id': '1'})), set())
+        for suffix in ('sq', 'q', 't', 's', 'n', 'm', 'z', 'c', 'l', 'h', 'k', 'o'):
+            self.assertTrue('url_%s' % suffix in FLICKR_URL_EXTRAS.split(', '))
+        photo = Photo.objects.create_from_json(flickr_user=self.flickr_user, photo=json_photo)
+        self.assertEqual(photo.sizes.count(), 10)
+        medium800 = photo.sizes.get(size='medium800')
+        self.assertEqual((medium800.width, medium800.height), (800, 443))
+        self.assertEqual(medium800.url, 'http://www.flickr.com/photos/zalew/6110054503/sizes/c/')
+
+    def test_sync_checkpoint(self):
+        self.assertEqual(SyncCheckpoint.objects.resumable(self.flickr_user), None)
+        checkpoint = SyncCheckpoint.objects.start(self.flickr_user, since=1335873600, per_page=20)
+        SyncCheckpoint.objects.start(self.flickr_user2)
+        checkpoint.save_progress('photos', 3, '5436', 47)
+        resumed = SyncCheckpoint.objects.resumable(self.flickr_user)
+        self.assertEqual(resumed.pk, checkpoint.pk)
+        self.assertEqual((resumed.phase, resumed.page, resumed.flickr_id, resumed.processed), ('photos', 3, '5436', 47))
+        self.assertEqual(resumed.get_params(), {'since': 1335873600, 'per_page': 20})
+        resumed.finish()
+        self.assertEqual(SyncCheckpoint.objects.resumable(self.flickr_user), None)
+        self.assertNotEqual(SyncCheckpoint.objects.resumable(self.flickr_user2), None)
+
     @override_settings(ROOT_URLCONF='flickr.urls')
     def test_views_index(self):
         response = self.client.get(reverse('flickr_index'))
@@ -196,7 +361,961 @@ class FlickrModelTests(TestCase):
         self.assertTrue(photoset.title in response.content)
         self.assertTrue(photo.description in response.content)
 
+    def test_view_api(self):
+        from flickr.views import get_view_api
+        api = get_view_api('token', fallback=False)
+        self.assertEqual((api.token, api.fallback, api.rate_limiter, api.retry_policy), ('token', False, None, None))
+
     def test_imports(self):
         import flickr.admin
         import flickr.management.commands.flickr_download
         import flickr.management.commands.flickr_sync
+
+
+class FlickrTransportTests(TestCase):
+
+    def setUp(self):
+        self.server, self.url = start_server()
+        self.transport = HttpTransport(pool_size=2, timeout=5)
+
+    def tearDown(self):
+        self.transport.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keep_alive(self):
+        for i in range(5):
+            data = json.loads(self.transport.request('%s/call/%d' % (self.url, i)))
+            self.assertEqual(data['path'], '/call/%d' % i)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_redirect_and_errors(self):
+        response = self.transport.open('%s/redirect' % self.url)
+        self.assertEqual(response.url, '%s/moved' % self.url)
+        self.assertEqual(json.loads(response.read())['path'], '/moved')
+        with self.assertRaises(HTTPError) as exc_info:
+            self.transport.request('%s/missing' % self.url)
+        self.assertEqual(exc_info.exception.code, 404)
+        self.transport.request('%s/after-error' % self.url)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_api_uses_transport(self):
+        from flickr.api import FlickrApi
+        api = FlickrApi('key', 'secret', transport=self.transport)
+        api.ENDPOINT = '%s/services/rest/' % self.url
+        data = api.get('people.getInfo', auth=False, user_id='123')
+        self.assertEqual(data['stat'], 'ok')
+        self.assertTrue('method=flickr.people.getInfo' in data['path'])
+        # #by default the pool configured by the FLICKR_TRANSPORT settings, shared with the shortcuts
+        from flickr.shortcuts import get_transport
+        self.assertTrue(FlickrApi('key', 'secret').transport is get_transport())
+
+    def test_async_api(self):
+        from flickr.api import AsyncFlickrApi
+        api = AsyncFlickrApi('key', 'secret', transport=self.transport, workers=4)
+        api.ENDPOINT = '%s/services/rest/' % self.url
+        futures = [api.get('people.getInfo', auth=False, user_id=str(i)) for i in range(8)]
+        paths = [future.result()['path'] for future in as_completed(futures)]
+        self.assertEqual(len(paths), 8)
+        for i, future in enumerate(futures):
+            params = parse_qs(urlsplit(future.result()['path']).query)
+            self.assertEqual(params['user_id'], [str(i)])
+            self.assertTrue('oauth_signature' in params)
+        self.assertEqual(api.get_sync('people.getInfo', auth=False)['stat'], 'ok')
+        api.close()
+        self.assertEqual(api.pool._threads, [])  # #shut down
+        # #by default the pool shared by the process, left running
+        from flickr.shortcuts import get_async_pool
+        with AsyncFlickrApi('key', 'secret', transport=self.transport) as shared_api:
+            self.assertTrue(shared_api.pool is get_async_pool())
+        self.assertEqual(get_async_pool().submit(lambda: 1).result(), 1)
+
+    def test_api_cache(self):
+        from flickr.api import FlickrApi
+        api = FlickrApi('key', 'secret', transport=self.transport, cache=ResponseCache(MemoryCache()))
+        api.ENDPOINT = '%s/services/rest/' % self.url
+        first = api.get('people.getInfo', auth=False, user_id='123')
+        # #same call, the nonce (so the echoed path) would be different if it went to the server
+        self.assertEqual(api.get('flickr.people.getInfo', auth=False, user_id='123'), first)
+        self.assertNotEqual(api.get('people.getInfo', auth=False, user_id='456'), first)
+        self.assertNotEqual(api.get('auth.oauth.checkToken', auth=False), api.get('auth.oauth.checkToken', auth=False))
+
+
+class FlickrUtilsTests(TestCase):
+
+    def test_worker_pool_imap(self):
+        pool = WorkerPool(4)
+        running = []
+        peak = []
+
+        def work(i):
+            running.append(i)
+            peak.append(len(running))
+            time.sleep(0.01 * (i % 3))
+            running.remove(i)
+            return i * 2
+        self.assertEqual(list(pool.imap(work, range(20))), [i * 2 for i in range(20)])
+        self.assertTrue(1 < max(peak) <= 4)
+        pool.shutdown()
+
+    def test_worker_pool_errors(self):
+        for workers in (1, 3):
+            pool = WorkerPool(workers)
+            future = pool.submit(int, 'not a number')
+            self.assertTrue(isinstance(future.exception(), ValueError))
+            self.assertEqual(pool.submit(int, '42').result(), 42)
+            pool.shutdown()
+
+    def test_as_completed(self):
+        pool = WorkerPool(3)
+        futures = [pool.submit(time.sleep, delay) for delay in (0.1, 0.05, 0)]
+        self.assertEqual([futures.index(future) for future in as_completed(futures)], [2, 1, 0])
+        pool.shutdown()
+
+    def test_worker_pool_imap_unordered(self):
+        for workers in (1, 3):
+            pool = WorkerPool(workers)
+            results = list(pool.imap_unordered(lambda delay: time.sleep(delay) or 1 / delay, (0.1, 0.05, 0, 0.02)))
+            self.assertEqual(sorted(item for item, future in results), [0, 0.02, 0.05, 0.1])
+            self.assertEqual(dict(results)[0.05].result(), 20)
+            self.assertTrue(isinstance(dict(results)[0].exception(), ZeroDivisionError))
+            if workers > 1:
+                self.assertEqual([item for item, future in results][:2], [0, 0.02])
+            pool.shutdown()
+
+
+class FlickrCacheTests(TestCase):
+
+    def test_memory_cache_lru(self):
+        cache = MemoryCache(max_entries=2)
+        cache.set('a', {'v': 1}, 60)
+        cache.set('b', {'v': 2}, 60)
+        self.assertEqual(cache.get('a'), {'v': 1})
+        cache.set('c', {'v': 3}, 60)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), {'v': 1})
+        cache.get('a')['v'] = 5
+        self.assertEqual(cache.get('a'), {'v': 1})
+        cache.set('d', {'v': 4}, -1)
+        self.assertEqual(cache.get('d'), None)
+
+    def test_file_cache(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path, True)
+        cache = FileCache(path)
+        self.assertEqual(cache.get('a'), None)
+        cache.set('a', {'v': [1, 2]}, 60)
+        self.assertEqual(cache.get('a'), {'v': [1, 2]})
+        cache.set('b', {'v': 2}, -1)
+        self.assertEqual(cache.get('b'), None)
+        cache.clear()
+        self.assertEqual(cache.get('a'), None)
+
+    def test_response_cache_key(self):
+        cache = ResponseCache(MemoryCache(), ttls={'flickr.photos.getSizes': 0})
+        key = cache.key('people.getInfo', {'user_id': '1', 'oauth_nonce': 'x', 'oauth_timestamp': 1}, 'token')
+        self.assertEqual(key, cache.key('flickr.people.getInfo', {'user_id': 1, 'extras': None}, 'token'))
+        self.assertNotEqual(key, cache.key('people.getInfo', {'user_id': '1'}, 'other token'))
+        self.assertFalse('token' in key)
+        cache.set('people.getInfo', {'user_id': '1'}, {'stat': 'ok'}, 'token')
+        cache.set('people.getInfo', {'user_id': '2'}, {'stat': 'fail'}, 'token')
+        cache.set('photos.getSizes', {'photo_id': '1'}, {'stat': 'ok'}, 'token')
+        self.assertEqual(cache.get('people.getInfo', {'user_id': '1'}, 'token'), {'stat': 'ok'})
+        self.assertEqual(cache.get('people.getInfo', {'user_id': '2'}, 'token'), None)
+        self.assertEqual(cache.get('photos.getSizes', {'photo_id': '1'}, 'token'), None)
+
+
+class FlickrRateLimitTests(TestCase):
+
+    def test_parse_rate(self):
+        self.assertEqual(parse_rate('3600/h'), (3600, 3600))
+        self.assertEqual(parse_rate('60/min'), (60, 60))
+        self.assertEqual(parse_rate(2), (2, 1))
+
+    def test_token_bucket(self):
+        limiter = RateLimiter(50, 1, burst=5)
+        t1 = time.time()
+        waits = [limiter.acquire() for i in range(10)]
+        self.assertEqual(waits[:5], [0] * 5)
+        self.assertTrue(time.time() - t1 >= 0.09)
+
+    def test_throttled(self):
+        limiter = RateLimiter(100, 1)
+        limiter.throttled(retry_after='0.05')
+        self.assertEqual(limiter.rate, 50)
+        self.assertTrue(limiter.acquire() >= 0.04)
+        for i in range(10):
+            limiter.success()
+        self.assertEqual(limiter.rate, 100)
+
+    def test_file_limiter_shared(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            first, second = FileRateLimiter(path, 20, 1, burst=1), FileRateLimiter(path, 20, 1, burst=1)
+            self.assertEqual(first.acquire(), 0)
+            self.assertTrue(second.acquire() > 0.02)
+            first.throttled()
+            for i in range(20):
+                second.success()
+            with first._state():
+                self.assertEqual(first.rate, 20)
+        finally:
+            os.unlink(path)
+
+    def test_api_throttled(self):
+        server, url = start_server()
+        try:
+            from flickr.api import FlickrApi, FlickrAuthApi
+            for api_class in (FlickrApi, FlickrAuthApi):
+                limiter = RateLimiter(100, 1)
+                api = api_class('key', 'secret', transport=HttpTransport(), rate_limiter=limiter)
+                api.ENDPOINT = '%s/throttle/' % url
+                with self.assertRaises(HTTPError):
+                    api.get('people.getInfo', auth=False)
+                self.assertEqual(limiter.rate, 50)
+                self.assertTrue(limiter.blocked_until > time.time() + 0.1)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class FlickrRetryTests(TestCase):
+
+    def setUp(self):
+        self.server, self.url = start_server()
+        self.policy = RetryPolicy(retries=3, backoff=0.01)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_api(self, path):
+        from flickr.api import FlickrApi
+        api = FlickrApi('key', 'secret', transport=HttpTransport(), retry_policy=self.policy)
+        api.ENDPOINT = '%s/%s/' % (self.url, path)
+        return api
+
+    def test_policy(self):
+        self.assertTrue(RetryPolicy.is_idempotent('flickr.photos.getInfo'))
+        self.assertTrue(RetryPolicy.is_idempotent('flickr.photos.recentlyUpdated'))
+        self.assertFalse(RetryPolicy.is_idempotent('flickr.photos.addTags'))
+        self.assertTrue(self.policy.should_retry('flickr.photos.getInfo', 0, error=socket.timeout()))
+        self.assertFalse(self.policy.should_retry('flickr.photos.addTags', 0, error=socket.timeout()))
+        self.assertFalse(self.policy.should_retry('flickr.photos.getInfo', 0, error=ValueError()))
+        self.assertTrue(self.policy.should_retry('flickr.photos.getInfo', 0, data={'stat': 'fail', 'code': 105}))
+        self.assertFalse(self.policy.should_retry('flickr.photos.getInfo', 0, data={'stat': 'fail', 'code': 1}))
+        self.assertFalse(self.policy.should_retry('flickr.photos.getInfo', 3, data={'stat': 'fail', 'code': 105}))
+        self.assertEqual(self.policy.stats(), {'flickr.photos.getInfo': (0, 1)})
+        delays = [RetryPolicy(backoff=1, max_backoff=4, jitter=0.5).delay(attempt) for attempt in range(5)]
+        self.assertTrue(0.5 <= delays[0] <= 1 and 1 <= delays[1] <= 2 and all(2 <= delay <= 4 for delay in delays[3:]))
+
+    def test_api_retries(self):
+        self.server.failures = 2
+        data = self.get_api('flaky').get('people.getInfo', auth=False)
+        self.assertEqual(data['stat'], 'ok')
+        self.assertEqual(self.policy.stats(), {'flickr.people.getInfo': (2, 0)})
+        self.server.failures = 5
+        with self.assertRaises(HTTPError):
+            self.get_api('flaky').get('people.getInfo', auth=False)
+        self.assertEqual(self.policy.stats(), {'flickr.people.getInfo': (5, 1)})
+        self.server.failures = 1
+        with self.assertRaises(HTTPError):
+            self.get_api('flaky').get('photos.addTags', auth=False)
+
+    def test_api_stat_fail(self):
+        data = self.get_api('unavailable').get('photos.getInfo', auth=False)
+        self.assertEqual(data, {'stat': 'fail', 'code': 105, 'message': 'Service currently unavailable'})
+        self.assertEqual(self.policy.stats(), {'flickr.photos.getInfo': (3, 1)})
+
+
+class ListSink(object):
+
+    def __init__(self):
+        self.events = []
+
+    def emit(self, event):
+        self.events.append(event)
+
+
+class FlickrInstrumentationTests(TestCase):
+
+    def setUp(self):
+        self.server, self.url = start_server()
+        self.sink, self.summary = ListSink(), SummarySink()
+        self.instrumentation = Instrumentation([self.sink, self.summary])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_api(self, path, **kwargs):
+        from flickr.api import FlickrApi
+        api = FlickrApi('key', 'secret', transport=HttpTransport(), instrumentation=self.instrumentation, **kwargs)
+        api.ENDPOINT = '%s/%s/' % (self.url, path)
+        return api
+
+    def test_events(self):
+        api = self.get_api('flaky', retry_policy=RetryPolicy(backoff=0.01), cache=ResponseCache(MemoryCache()))
+        self.server.failures = 1
+        api.get('people.getInfo', auth=False, user_id='1')
+        api.get('people.getInfo', auth=False, user_id='1')
+        with self.assertRaises(HTTPError):
+            self.get_api('missing').get('photos.getInfo', auth=False)
+        first, cached, missing = self.sink.events
+        self.assertEqual((first.method, first.status, first.stat, first.retries, first.cached, first.error),
+                         ('flickr.people.getInfo', 200, 'ok', 1, False, None))
+        self.assertTrue(first.bytes > 0 and first.time >= first.parse_time > 0)
+        self.assertEqual((cached.cached, cached.bytes, cached.stat), (True, 0, 'ok'))
+        self.assertEqual((missing.method, missing.status, missing.error), ('flickr.photos.getInfo', 404, 'HTTPError'))
+        totals = self.summary.totals()
+        self.assertEqual((totals['calls'], totals['errors'], totals['retries'], totals['cached']), (3, 1, 1, 1))
+        table = self.summary.table()
+        self.assertEqual(len(table), 4)
+        self.assertTrue(table[-1].startswith('TOTAL'))
+
+    def test_signal_and_statsd(self):
+        received = []
+
+        def receiver(sender, event, **kwargs):
+            received.append(event)
+        api_call.connect(receiver)
+        listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.settimeout(5)
+        try:
+            self.instrumentation.add_sink(SignalSink())
+            self.instrumentation.add_sink(StatsdSink(port=listener.getsockname()[1]))
+            self.get_api('unavailable').get('photos.getInfo', auth=False)
+            self.assertEqual(received[0].stat, 'fail')
+            lines = listener.recv(4096).split('\n')
+            self.assertTrue('flickr.photos.getInfo.calls:1|c' in lines)
+            self.assertTrue('flickr.photos.getInfo.errors:1|c' in lines)
+        finally:
+            api_call.disconnect(receiver)
+            listener.close()
+
+    def test_phase_timer(self):
+        timer = PhaseTimer()
+        timer.activate()
+        try:
+            with timer.phase('db'):
+                time.sleep(0.02)
+                with phase('tags'):
+                    time.sleep(0.03)
+            items = list(timer.iterate('listing', (time.sleep(0.01) or i for i in range(3))))
+        finally:
+            timer.deactivate()
+        with phase('tags'):
+            pass  # #not active anymore, not counted
+        self.assertEqual(items, [0, 1, 2])
+        self.assertEqual(dict(timer.counts), {'db': 1, 'tags': 1, 'listing': 4})
+        self.assertTrue(0.02 <= timer.times['db'])
+        self.assertTrue(0.03 <= timer.times['tags'])
+        self.assertTrue(0.03 <= timer.times['listing'])
+
+    def test_query_counter(self):
+        with QueryCounter() as counter:
+            list(FlickrUser.objects.all())
+            User.objects.create(username='counted')
+        list(FlickrUser.objects.all())
+        self.assertTrue(counter.queries >= 2)
+        queries = counter.queries
+        list(FlickrUser.objects.all())
+        self.assertEqual(counter.queries, queries)
+        self.assertTrue(peak_rss() > 1)
+        # #nested, f.ex. around call_command('flickr_sync') which has its own
+        with QueryCounter() as outer:
+            with QueryCounter() as inner:
+                list(FlickrUser.objects.all())
+            list(FlickrUser.objects.all())
+        list(FlickrUser.objects.all())
+        self.assertEqual((outer.queries, inner.queries), (2, 1))
+
+    def test_broken_sink(self):
+        class BrokenSink(object):
+            def emit(self, event):
+                raise ValueError
+        self.instrumentation.sinks.insert(0, BrokenSink())
+        self.assertEqual(self.get_api('call').get('people.getInfo', auth=False)['stat'], 'ok')
+        self.assertEqual(len(self.sink.events), 1)
+
+
+class FlickrFakeServerTests(TestCase):
+
+    def setUp(self):
+        self.account = FakeAccount(0, photos=25, sets=3, collections=3)
+        self.fake = FakeFlickr([self.account, FakeAccount(1, photos=5)], image_size=10000)
+        self.server = FakeFlickrServer(self.fake).start()
+        self.transport = HttpTransport()
+
+    def tearDown(self):
+        self.transport.close()
+        self.server.stop()
+
+    def get_api(self, token=None):
+        from flickr.api import FlickrApi
+        return FlickrApi('key', 'secret', token=token or self.account.token, transport=self.transport, endpoint=self.server.endpoint)
+
+    def test_photos_list(self):
+        api = self.get_api()
+        first = api.get('people.getPhotos', user_id=self.account.nsid, per_page=10, extras=ALL_EXTRAS)
+        last = api.get('people.getPhotos', user_id=self.account.nsid, per_page=10, page=3, extras=ALL_EXTRAS)
+        self.assertEqual((first['photos']['total'], first['photos']['pages']), ('25', 3))
+        self.assertEqual([photo['id'] for photo in first['photos']['photo']][:2], [self.account.photo_id(24), self.account.photo_id(23)])
+        self.assertEqual(len(last['photos']['photo']), 5)
+        self.assertEqual(Photo.objects.details_in_extras(bunchify(first['photos']['photo'][0])), set(['sizes', 'geo']))
+        since = api.get('people.getPhotos', user_id=self.account.nsid, min_upload_date=str(self.account.uploaded(20)))
+        self.assertEqual(since['photos']['total'], '5')
+        self.assertEqual(api.get('people.getPhotos', user_id='nobody')['code'], 1)
+
+        self.account.touch([3])
+        self.account.add_photos(2)
+        updated = api.get('photos.recentlyUpdated', min_date=int(time.time()) - 5, extras='last_update')
+        self.assertEqual(sorted(photo['id'] for photo in updated['photos']['photo']),
+                         sorted(self.account.photo_id(i) for i in (3, 25, 26)))
+        self.assertEqual(self.get_api(self.fake.accounts[1].token).get('photos.recentlyUpdated', min_date=0)['photos']['total'], 5)
+
+    def test_photo_details_and_images(self):
+        api = self.get_api()
+        photo_id = self.account.photo_id(3)
+        info, sizes, exif, geo = [api.get(method, photo_id=photo_id) for method in
+                                  ('photos.getInfo', 'photos.getSizes', 'photos.getExif', 'photos.geo.getLocation')]
+        flickr_user = FlickrUser.objects.create(user=User.objects.create(username='fake'))
+        photo = Photo.objects.create_from_json(flickr_user, None, info=info, sizes=sizes, exif=exif, geo=geo)
+        self.assertEqual((photo.flickr_id, photo.exif_camera, photo.tags.count()), (photo_id, 'Fake Camera 0', 2))
+        self.assertEqual(photo.sizes.count(), len(sizes['sizes']['size']))
+        self.assertEqual(api.get('photos.geo.getLocation', photo_id=self.account.photo_id(4))['code'], 2)
+
+        original = [size['source'] for size in sizes['sizes']['size'] if size['label'] == 'Original'][0]
+        response = self.transport.open(original)
+        self.assertEqual(response.headers['content-type'], 'image/jpeg')
+        body = response.read()
+        self.assertEqual((len(body), body[:2], body[-2:]), (10000, '\xff\xd8', '\xff\xd9'))
+        with self.assertRaises(HTTPError):
+            self.transport.open(original.replace(self.account.secret(3, True), self.account.secret(3)))
+
+        sets = api.get('photosets.getList', user_id=self.account.nsid)['photosets']['photoset']
+        self.assertEqual(len(sets), 3)
+        self.assertEqual(api.get('photosets.getPhotos', photoset_id=sets[1]['id'])['photoset']['total'], 8)
+        tree = api.get('collections.getTree', user_id=self.account.nsid)['collections']['collection']
+        self.assertEqual([len(child['set']) for child in tree[0]['collection']], [2, 1])
+
+    def test_errors_and_rate_limit(self):
+        self.fake.fail_rate = 1
+        self.assertEqual(self.get_api().get('people.getInfo', user_id=self.account.nsid)['code'], 105)
+        self.fake.fail_rate, self.fake.error_rate = 0, 1
+        with self.assertRaises(HTTPError) as exc_info:
+            self.get_api().get('people.getInfo', user_id=self.account.nsid)
+        self.assertEqual(exc_info.exception.code, 500)
+        self.fake.error_rate, self.fake.bucket = 0, FakeFlickr([], rate_limit='1/h').bucket
+        self.assertEqual(self.get_api().get('people.getInfo', user_id=self.account.nsid)['stat'], 'ok')
+        with self.assertRaises(HTTPError) as exc_info:
+            self.get_api().get('people.getInfo', user_id=self.account.nsid)
+        self.assertEqual(exc_info.exception.code, 429)
+        self.assertEqual(self.fake.calls['flickr.people.getInfo'], 4)
+
+    def test_sync_resume(self):
+        flickr_user = get_or_create_flickr_user(self.account)
+        with using_server(self.server):
+            with quiet():
+                # #interrupted after the 10 last uploaded photos
+                call_command('flickr_sync', user_id=flickr_user.user_id, initial=True, ils=True, page=1, per_page=10, verbosity=0)
+                SyncCheckpoint.objects.all().delete()
+                checkpoint = SyncCheckpoint.objects.start(flickr_user, since=None, page=None, per_page=10, incremental=False)
+                checkpoint.save_progress('photos', 1, self.account.photo_id(15), 10, str(self.account.uploaded(15)))
+                # #uploads and deletions move the pages, photos are neither skipped nor synced twice
+                self.account.add_photos(3)
+                call_command('flickr_sync', user_id=flickr_user.user_id, resume=True, initial=True, ils=True, verbosity=0)
+        self.assertEqual(sorted(Photo.objects.values_list('flickr_id', flat=True)), sorted(self.account.photo_id(i) for i in range(25)))
+        self.assertEqual(SyncCheckpoint.objects.get(pk=checkpoint.pk).processed, 25)
+        # #a new run drops the runs left unfinished
+        SyncCheckpoint.objects.start(flickr_user)
+        last = SyncCheckpoint.objects.start(flickr_user)
+        self.assertEqual(SyncCheckpoint.objects.filter(finished=None).count(), 1)
+        # #and only the last finished run is kept
+        last.finish()
+        SyncCheckpoint.objects.start(flickr_user).finish()
+        self.assertEqual(SyncCheckpoint.objects.count(), 1)
+        self.assertNotEqual(SyncCheckpoint.objects.get().pk, last.pk)
+
+    def test_sync_skips_unchanged(self):
+        flickr_user = get_or_create_flickr_user(self.account)
+        with using_server(self.server):
+            with quiet():
+                call_command('flickr_sync', user_id=flickr_user.user_id, initial=True, ils=True, info=True, verbosity=0)
+                self.assertEqual(self.fake.calls['flickr.photos.getInfo'], 25)
+                # #only the photo modified since gets its details fetched (and written)
+                self.account.touch([3])
+                call_command('flickr_sync', user_id=flickr_user.user_id, ils=True, info=True, verbosity=0)
+                self.assertEqual(self.fake.calls['flickr.photos.getInfo'], 26)
+                # #--update-tags updates them all
+                call_command('flickr_sync', user_id=flickr_user.user_id, ils=True, info=True, update_tags=True, verbosity=0)
+                self.assertEqual(self.fake.calls['flickr.photos.getInfo'], 51)
+
+    def test_sync_refetches_failed_details(self):
+        from flickr import shortcuts
+        get_exif, failing = shortcuts.get_photo_exif_json, self.account.photo_id(3)
+
+        def flaky_exif(photo_id, token):
+            if photo_id == failing:
+                raise ValueError('no exif')
+            return get_exif(photo_id=photo_id, token=token)
+        flickr_user = get_or_create_flickr_user(self.account)
+        with using_server(self.server):
+            with quiet():
+                shortcuts.get_photo_exif_json = flaky_exif
+                try:
+                    call_command('flickr_sync', user_id=flickr_user.user_id, initial=True, ils=True, exif=True, verbosity=0)
+                finally:
+                    shortcuts.get_photo_exif_json = get_exif
+                self.assertEqual(Photo.objects.get(flickr_id=failing).exif_camera, None)
+                # #written without its exif, the photo isn't taken as unchanged
+                calls = self.fake.calls['flickr.photos.getExif']
+                call_command('flickr_sync', user_id=flickr_user.user_id, ils=True, exif=True, verbosity=0)
+        self.assertEqual(self.fake.calls['flickr.photos.getExif'], calls + 1)
+        self.assertEqual(Photo.objects.get(flickr_id=failing).exif_camera, 'Fake Camera 0')
+
+    def test_update_photos_skips_unchanged(self):
+        flickr_user = get_or_create_flickr_user(self.account)
+        with using_server(self.server):
+            with quiet():
+                call_command('flickr_sync', user_id=flickr_user.user_id, initial=True, ils=True, info=True, exif=True, verbosity=0)
+                Photo.objects.update(last_sync=datetime(2012, 1, 1, tzinfo=utc))  # #details up to date, not fetched again
+                hashes = dict(Photo.objects.values_list('flickr_id', 'sync_hash'))
+                call_command('flickr_sync', user_id=flickr_user.user_id, no_photos=True, update_photos=True, verbosity=0)
+                self.assertEqual(dict(Photo.objects.values_list('flickr_id', 'sync_hash')), hashes)
+                # #the photo modified since is updated, with its details
+                self.account.touch([3])
+                calls = self.fake.calls['flickr.photos.getInfo']
+                call_command('flickr_sync', user_id=flickr_user.user_id, no_photos=True, update_photos=True, verbosity=0)
+        self.assertEqual(self.fake.calls['flickr.photos.getInfo'], calls + 1)
+        changed = dict(Photo.objects.values_list('flickr_id', 'sync_hash'))
+        self.assertNotEqual(changed.pop(self.account.photo_id(3)), None)
+        self.assertEqual(changed, dict((key, value) for key, value in hashes.items() if key != self.account.photo_id(3)))
+
+
+class FlickrSyncAllTests(TestCase):
+
+    def setUp(self):
+        self.accounts = [FakeAccount(0, photos=5), FakeAccount(1, photos=3)]
+        self.server = FakeFlickrServer(FakeFlickr(self.accounts)).start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_get_users(self):
+        users = [FlickrUser.objects.create(user=User.objects.create(username='user%d' % i), token='token%d' % i,
+                                           last_sync=datetime(2012, 1, 10 - i, tzinfo=utc)) for i in range(3)]
+        FlickrUser.objects.filter(pk=users[1].pk).update(last_sync=None)
+        FlickrUser.objects.create(user=User.objects.create(username='no_token'))
+        with self.settings(FLICKR_KEY='key', FLICKR_SECRET='secret'):
+            command = SyncAllCommand()
+        self.assertEqual([flickr_user.pk for flickr_user in command.get_users()], [users[1].pk, users[2].pk, users[0].pk])
+
+    def test_default_rate(self):
+        with self.settings(FLICKR_KEY='key', FLICKR_SECRET='secret'):
+            command = SyncAllCommand()
+        rate_limit = flickr_sync_all.FLICKR_RATE_LIMIT
+        try:
+            flickr_sync_all.FLICKR_RATE_LIMIT = '3600/h'
+            self.assertEqual(command.default_rate(4), '900/3600')
+            flickr_sync_all.FLICKR_RATE_LIMIT = None
+            self.assertEqual(command.default_rate(4), None)
+        finally:
+            flickr_sync_all.FLICKR_RATE_LIMIT = rate_limit
+
+    def test_init_worker(self):
+        shared = FileRateLimiter(os.path.join(tempfile.gettempdir(), 'flickr-test-ratelimit'), 10, 1)
+        saved = get_rate_limiter(), flickr_sync_all.FLICKR_RATE_LIMIT_FILE
+        try:
+            set_rate_limiter(shared)
+            flickr_sync_all.FLICKR_RATE_LIMIT_FILE = shared.path
+            flickr_sync_all.init_worker('5/1', None)
+            self.assertTrue(get_rate_limiter() is shared)
+            flickr_sync_all.FLICKR_RATE_LIMIT_FILE = None
+            flickr_sync_all.init_worker('5/1', None)
+            self.assertEqual(get_rate_limiter().__class__, RateLimiter)
+        finally:
+            set_rate_limiter(saved[0])
+            flickr_sync_all.FLICKR_RATE_LIMIT_FILE = saved[1]
+
+    def test_sync_all(self):
+        users = [get_or_create_flickr_user(account) for account in self.accounts]
+        # #a token Flickr doesn't know, the sync of that user fails
+        broken = FlickrUser.objects.create(user=User.objects.create(username='broken'), nsid='1@N00', token='nope')
+        FlickrUser.objects.filter(pk=users[1].pk).update(last_sync=datetime(2012, 1, 1, tzinfo=utc))
+        stdout = StringIO.StringIO()
+        with using_server(self.server):
+            with quiet():
+                user_id, summary, error = sync_user((broken.user_id, {'verbosity': 0}))
+            self.assertEqual(user_id, broken.user_id)
+            self.assertTrue("KeyError: 'person'" in error)
+            saved, sys.stdout = sys.stdout, stdout
+            try:
+                call_command('flickr_sync_all', processes=1, ils=True, verbosity=0)
+            finally:
+                sys.stdout = saved
+        self.assertEqual(Photo.objects.filter(user=users[0]).count(), 5)
+        self.assertEqual(Photo.objects.filter(user=users[1]).count(), 3)
+        lines = stdout.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('Syncing 3 users, 1 at once'))
+        # #the user failing doesn't stop the others, the never synced come first
+        self.assertEqual([line.split()[0] for line in lines if line.endswith(('ok', 'FAILED'))], ['fake0', 'broken', 'fake1'])
+        total = [line.split() for line in lines if line.startswith('TOTAL')][0]
+        self.assertEqual(total[3:7] + total[8:], ['8', '0', '0', '0', '1', 'failed'])
+
+    def test_print_summary(self):
+        users = [FlickrUser.objects.create(user=User.objects.create(username='user%d' % i), token='t') for i in range(3)]
+        results = {users[0].user_id: ({'new': 2, 'updated': 1, 'unchanged': 4, 'errors': 1, 'time': 3}, None),
+                   users[1].user_id: ({'new': 5, 'unchanged': 1, 'time': 2}, 'Traceback...')}
+        with self.settings(FLICKR_KEY='key', FLICKR_SECRET='secret'):
+            command = SyncAllCommand()
+        command.verbosity = 0
+        stdout = StringIO.StringIO()
+        saved, sys.stdout = sys.stdout, stdout
+        try:
+            command.print_summary(users, results, 12)
+        finally:
+            sys.stdout = saved
+        lines = stdout.getvalue().splitlines()[1:]
+        self.assertEqual(lines[1].split(), ['user0', '2', '1', '4', '1', '3s', 'ok'])
+        self.assertEqual(lines[2].split()[-1], 'FAILED')
+        self.assertEqual(lines[3].split(), ['user2', '0', '0', '0', '0', '0s', 'FAILED'])  # #not run
+        self.assertEqual(lines[4].split(), ['TOTAL', '(3', 'users)', '7', '1', '5', '1', '12s', '2', 'failed'])
+
+
+class FlickrDownloadTests(TestCase):
+
+    def setUp(self):
+        self.account = FakeAccount(0, photos=12, geo_every=1)
+        self.fake = FakeFlickr([self.account], image_size=5000)
+        self.server = FakeFlickrServer(self.fake).start()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, True)
+        self.fields = [PhotoDownload._meta.get_field('image_file'), DownloadBlob._meta.get_field('file')]
+        self.storages = [field.storage for field in self.fields]
+        for field in self.fields:
+            field.storage = FileSystemStorage(self.media_root)
+        self.flickr_user = FlickrUser.objects.create(user=User.objects.create(username='fake'), nsid=self.account.nsid, ispro=True)
+        from flickr.api import FlickrApi
+        api = FlickrApi('key', 'secret', token=self.account.token, endpoint=self.server.endpoint)
+        for i in range(12):
+            photo_id = self.account.photo_id(i)
+            Photo.objects.create_from_json(self.flickr_user, None, info=api.get('photos.getInfo', photo_id=photo_id),
+                                           sizes=api.get('photos.getSizes', photo_id=photo_id),
+                                           geo=api.get('photos.geo.getLocation', photo_id=photo_id))
+
+    def tearDown(self):
+        for field, storage in zip(self.fields, self.storages):
+            field.storage = storage
+        self.server.stop()
+
+    def test_concurrent_download(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir, True)
+        broken = Photo.objects.get(flickr_id=self.account.photo_id(5))
+        broken.sizes.filter(size='ori').update(source=self.account.source(5, 'o').replace(self.account.secret(5, True), 'deadbeef00'))
+        with self.settings(FLICKR_KEY='key', FLICKR_SECRET='secret', FILE_UPLOAD_TEMP_DIR=temp_dir):
+            call_command('flickr_download', user_id=self.flickr_user.user_id, concurrency=4, verbosity=0)
+        self.assertEqual(PhotoDownload.objects.count(), 12)
+        self.assertEqual(list(PhotoDownload.objects.exclude(errors=None).values_list('photo', flat=True)), [broken.id])
+        for download in PhotoDownload.objects.filter(errors=None):
+            self.assertEqual((download.size, download.image_file.size), ('ori', 5000))
+            self.assertTrue(download.image_file.name.startswith('flickr/2010/2010-01/%s_' % download.photo.flickr_id))
+        # #streamed to a temporary file, then moved in place
+        self.assertEqual(os.listdir(temp_dir), [])
+        download = PhotoDownload.objects.get(photo__flickr_id=self.account.photo_id(3))
+        self.assertEqual(download.image_file.read(), self.fake.image(urlsplit(self.account.source(3, 'o')).path))
+
+        with self.settings(FLICKR_KEY='key', FLICKR_SECRET='secret'):
+            call_command('flickr_download', user_id=self.flickr_user.user_id, concurrency=4, verbosity=0)
+            self.assertEqual(PhotoDownload.objects.count(), 12)
+            call_command('flickr_download', user_id=self.flickr_user.user_id, size='medium', all=True, verbosity=0)
+        self.assertEqual(PhotoDownload.objects.filter(size='medium', errors=None).count(), 12)
+
+    def test_resume(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir, True)
+        self.fake.cut_rate = 1
+        with self.settings(FLICKR_KEY='key', FLICKR_SECRET='secret', FLICKR_DOWNLOAD_PARTIAL_DIR=temp_dir,
+                           FLICKR_DOWNLOAD_RETRY_DELAY=0):
+            call_command('flickr_download', user_id=self.flickr_user.user_id, concurrency=3, verbosity=0)
+            self.assertEqual(PhotoDownload.objects.filter(complete=False, bytes_received=2500, content_length=5000).count(), 12)
+            self.assertEqual(len(os.listdir(temp_dir)), 12)
+            self.assertEqual(PhotoDownload.objects.get(photo__flickr_id=self.account.photo_id(0)).errors, 'Got 2500 of 5000 bytes')
+
+            # #bytes of another file, the server answers 416 and it's downloaded from scratch
+            first = PhotoDownload.objects.get(photo__flickr_id=self.account.photo_id(0))
+            with open(first.partial_path, 'ab') as f:
+                f.write('x' * 3000)
+            self.fake.cut_rate = 0
+            call_command('flickr_download', user_id=self.flickr_user.user_id, concurrency=3, verbosity=0)
+        self.assertEqual(PhotoDownload.objects.filter(complete=True, errors=None, partial_path=None, bytes_received=5000).count(), 12)
+        self.assertEqual(os.listdir(temp_dir), [])
+        for i in (0, 7):
+            download = PhotoDownload.objects.get(photo__flickr_id=self.account.photo_id(i))
+            self.assertEqual(download.image_file.read(), self.fake.image(urlsplit(self.account.source(i, 'o')).path))
+
+    def test_dedup(self):
+        # #photo 1 is a copy of photo 0 (f.ex. uploaded by another account)
+        copy = Photo.objects.get(flickr_id=self.account.photo_id(1))
+        copy.sizes.filter(size='ori').update(source=self.account.source(0, 'o'))
+        with self.settings(FLICKR_KEY='key', FLICKR_SECRET='secret', FLICKR_DOWNLOAD_DEDUP=True):
+            call_command('flickr_download', user_id=self.flickr_user.user_id, concurrency=3, verbosity=0)
+            self.assertEqual(PhotoDownload.objects.filter(complete=True).exclude(blob=None).count(), 12)
+            self.assertEqual(DownloadBlob.objects.count(), 11)
+            blob = DownloadBlob.objects.get(photodownload__photo=copy)
+            self.assertEqual((blob.refcount, blob.size, len(blob.digest)), (2, 5000, 64))
+            self.assertEqual(blob.etag, '"%s"' % hashlib.md5(self.fake.image(urlsplit(self.account.source(0, 'o')).path)).hexdigest())
+            self.assertEqual(set(PhotoDownload.objects.filter(blob=blob).values_list('image_file', flat=True)), set([blob.file.name]))
+            self.assertTrue(blob.file.name.startswith('flickr/blobs/%s/%s/%s' % (blob.digest[:2], blob.digest[2:4], blob.digest)))
+            self.assertEqual(hashlib.sha256(blob.file.read()).hexdigest(), blob.digest)
+            self.assertEqual(len(os.listdir(os.path.join(self.media_root, 'flickr', 'blobs'))), 11)  # #no date directories
+            self.assertEqual(self.fake.image_requests, {'GET': 12})
+
+            # #downloaded again: HEAD requests tell nothing changed
+            call_command('flickr_download', user_id=self.flickr_user.user_id, all=True, concurrency=3, verbosity=0)
+            self.assertEqual(self.fake.image_requests, {'GET': 12, 'HEAD': 12})
+            self.assertEqual(PhotoDownload.objects.filter(complete=True, bytes_received=5000).count(), 12)
+            self.assertEqual(DownloadBlob.objects.get(pk=blob.pk).refcount, 2)
+
+            # #the copy is replaced by another image
+            copy.sizes.filter(size='ori').update(source=self.account.source(1, 'o'))
+            call_command('flickr_download', user_id=self.flickr_user.user_id, all=True, verbosity=0)
+            self.assertEqual(DownloadBlob.objects.get(pk=blob.pk).refcount, 1)
+            self.assertEqual(DownloadBlob.objects.get(photodownload__photo=copy).refcount, 1)
+            self.assertEqual(self.fake.image_requests['GET'], 13)
+
+            # #a new photo (f.ex. of another account) with a file we have, referenced without downloading it
+            other = PhotoDownload.objects.get(photo=copy).blob
+            PhotoDownload.objects.filter(photo=copy).delete()
+            self.assertEqual(DownloadBlob.objects.get(pk=other.pk).refcount, 0)
+            copy.sizes.filter(size='ori').update(source=self.account.source(0, 'o'))
+            DownloadTask.objects.filter(photo=copy).delete()
+            call_command('flickr_download', user_id=self.flickr_user.user_id, verbosity=0)
+            self.assertEqual(self.fake.image_requests, {'GET': 13, 'HEAD': 25})
+            download = PhotoDownload.objects.get(photo=copy)
+            self.assertEqual((download.complete, download.blob_id, download.image_file.name), (True, blob.pk, blob.file.name))
+            self.assertEqual(DownloadBlob.objects.get(pk=blob.pk).refcount, 2)
+
+            # #deleted with its photo, the download doesn't reference its blob any more
+            Photo.objects.filter(flickr_id=self.account.photo_id(2)).delete()
+            self.assertEqual(DownloadBlob.objects.filter(refcount=0).count(), 2)
+            call_command('flickr_download', user_id=self.flickr_user.user_id, prune=True, verbosity=0)
+            self.assertEqual(DownloadBlob.objects.filter(refcount=0).count(), 0)
+            self.assertEqual(DownloadBlob.objects.count(), 10)
+            self.assertFalse(os.path.exists(os.path.join(self.media_root, other.file.name)))
+
+    def test_queue(self):
+        self.assertEqual(DownloadTask.objects.enqueue(Photo.objects.all(), 'ori', priority_by='recent'), 12)
+        self.assertEqual(DownloadTask.objects.enqueue(Photo.objects.all(), 'ori'), 0)
+        newest = list(Photo.objects.order_by('-date_posted', 'pk').values_list('pk', flat=True))
+        first = DownloadTask.objects.claim('one', size='ori', limit=5)
+        second = DownloadTask.objects.claim('two', size='ori', limit=5)
+        self.assertEqual([task.photo_id for task in first + second], newest[:10])
+        self.assertEqual(set((task.status, task.attempts) for task in first + second), set([('claimed', 1)]))
+        self.assertEqual(len(DownloadTask.objects.claim('three', size='ori')), 2)
+        self.assertEqual(DownloadTask.objects.claim('three', size='ori'), [])
+        # #claims of a downloader gone for more than FLICKR_DOWNLOAD_CLAIM_TIMEOUT are taken over
+        later = now() + timedelta(hours=2)
+        self.assertEqual(len(DownloadTask.objects.claim('four', size='ori', limit=20, when=later)), 12)
+
+        # #queued again, the ones a downloader is working on excepted, in the order asked for
+        public = newest[-1]
+        Photo.objects.filter(pk=public).update(ispublic=True)
+        Photo.objects.exclude(pk=public).update(ispublic=False)
+        DownloadTask.objects.exclude(photo__in=newest[:3]).update(claimed_at=now() - timedelta(hours=2))
+        DownloadTask.objects.enqueue(Photo.objects.all(), 'ori', priority_by='public', requeue=True)
+        self.assertEqual(DownloadTask.objects.filter(status='claimed').count(), 3)
+        self.assertEqual(DownloadTask.objects.filter(status='pending', attempts=0).count(), 9)
+        self.assertEqual(DownloadTask.objects.claim('five', size='ori', limit=1)[0].photo_id, public)
+        self.assertTrue(all(priority > 1 for priority in  # #still the 'recent' ones
+                            DownloadTask.objects.filter(photo__in=newest[:3]).values_list('priority', flat=True)))
+
+        task = DownloadTask.objects.get(pk=first[0].pk)
+        with self.settings(FLICKR_DOWNLOAD_MAX_ATTEMPTS=3, FLICKR_DOWNLOAD_RETRY_DELAY=60):
+            task.fail('broken')
+            self.assertEqual((task.status, task.attempts, task.last_error), ('pending', 2, 'broken'))
+            self.assertFalse(DownloadTask.objects.ready().filter(pk=task.pk).exists())
+            self.assertTrue(DownloadTask.objects.ready(when=now() + timedelta(seconds=121)).filter(pk=task.pk).exists())
+            task.attempts += 1
+            task.fail('still broken')
+        self.assertEqual((task.status, task.next_retry), ('failed', None))
+
+    def test_retry(self):
+        broken = Photo.objects.get(flickr_id=self.account.photo_id(5))
+        source = broken.sizes.get(size='ori').source
+        broken.sizes.filter(size='ori').update(source=source.replace(self.account.secret(5, True), 'deadbeef00'))
+        with self.settings(FLICKR_KEY='key', FLICKR_SECRET='secret', FLICKR_DOWNLOAD_RETRY_DELAY=0,
+                           FLICKR_DOWNLOAD_MAX_ATTEMPTS=2):
+            call_command('flickr_download', user_id=self.flickr_user.user_id, public=True, priority='public',
+                         concurrency=2, batch_size=5, verbosity=0)
+            self.assertEqual(DownloadTask.objects.filter(status='done').count(), 11)
+            task = DownloadTask.objects.get(photo=broken)
+            self.assertEqual((task.status, task.attempts), ('pending', 1))
+            self.assertTrue(task.last_error.startswith('HTTP Error 404'))
+            call_command('flickr_download', user_id=self.flickr_user.user_id, verbosity=0)
+            self.assertEqual(DownloadTask.objects.get(photo=broken).status, 'failed')
+            # #given up, until asked for
+            broken.sizes.filter(size='ori').update(source=source)
+            stdout = StringIO.StringIO()
+            saved, sys.stdout = sys.stdout, stdout
+            try:
+                call_command('flickr_download', user_id=self.flickr_user.user_id, verbosity=1)
+                # #the queue can be filled by other downloaders after the run counted it
+                command = DownloadCommand()
+                command.verbosity = 1
+                command.loader(3, 0, '')
+            finally:
+                sys.stdout = saved
+            self.assertEqual(DownloadTask.objects.get(photo=broken).status, 'failed')
+            output = stdout.getvalue()
+            self.assertTrue('nothing to download' in output and '1 given up' in output)
+            self.assertTrue('100% [3/0]' in output)
+            call_command('flickr_download', user_id=self.flickr_user.user_id, retry_failed=True, verbosity=0)
+        task = DownloadTask.objects.get(photo=broken)
+        self.assertEqual((task.status, task.attempts, task.last_error), ('done', 1, None))
+        self.assertTrue(PhotoDownload.objects.get(photo=broken).complete)
+        self.assertEqual(PhotoDownload.objects.filter(complete=True).count(), 12)
+
+
+class FlickrBenchmarkTests(TestCase):
+
+    def test_benchmark(self):
+        benchmark = Benchmark(sizes=(30,), verbosity=0, per_page=10, workers=2)
+        results = benchmark.run()
+        self.assertEqual(results['db_vendor'], 'sqlite')
+        runs = dict((run['scenario'], run) for run in results['runs'])
+        self.assertEqual([run['scenario'] for run in results['runs']], list(SCENARIOS))
+        self.assertEqual((runs['initial']['photos'], runs['initial']['new'], runs['initial']['api_calls']), (30, 30, 4))
+        self.assertEqual((runs['incremental']['new'], runs['incremental']['updated']), (1, 1))
+        self.assertEqual(Photo.objects.filter(user__user__username='fake0').count(), 31)
+        self.assertEqual(PhotoSet.objects.count(), 10)
+        self.assertEqual(Collection.objects.count(), 3)
+        self.assertTrue(all(run['db_queries'] > 0 and run['server_calls'] >= run['api_calls'] for run in results['runs']))
+
+        lines = table(results, baseline=json.loads(json.dumps(results)))
+        self.assertEqual(len(lines), 6)
+        self.assertTrue(lines[1].startswith('30       initial') and lines[1].endswith('+0.0%'))
+
+    def test_scenarios(self):
+        with self.assertRaises(ValueError):
+            Benchmark(sizes=(10,), scenarios=('initial', 'nope'))
+        results = Benchmark(sizes=(10,), scenarios=('photosets',), verbosity=0).run()
+        self.assertEqual([run['scenario'] for run in results['runs']], ['photosets'])
+        self.assertEqual(Photo.objects.count(), 10)
+
+
+class FlickrShortcutsTests(TestCase):
+
+    def setUp(self):
+        import flickr.shortcuts
+        self.shortcuts = flickr.shortcuts
+        self.get_photos_json = flickr.shortcuts.get_photos_json
+        self.calls = []
+        self.total = '13'
+
+        def get_photos_json(nsid, token, page=1, per_page=500, min_upload_date=None, extras=None, max_upload_date=None):
+            page = page or 1
+            self.calls.append((page, min_upload_date))
+            time.sleep(0.01 * ((7 - page) % 3))
+            photos = [{'id': str(page * 10 + i)} for i in range(3 if page < 5 else 1)]
+            return bunchify({'photos': {'page': page, 'pages': 5, 'perpage': 3, 'total': self.total, 'photo': photos}})
+        flickr.shortcuts.get_photos_json = get_photos_json
+
+    def tearDown(self):
+        self.shortcuts.get_photos_json = self.get_photos_json
+
+    def test_get_all_photos_parallel(self):
+        photos = self.shortcuts.get_all_photos('nsid', 'token', per_page=3, min_upload_date='1234', workers=3)
+        self.assertEqual([p.id for p in photos], [str(page * 10 + i) for page in range(1, 5) for i in range(3)] + ['50'])
+        self.assertEqual(sorted(self.calls), [(page, '1234') for page in range(1, 6)])
+
+    def test_get_all_photos_single_page(self):
+        photos = self.shortcuts.get_all_photos('nsid', 'token', page=2, per_page=3)
+        self.assertEqual([p.id for p in photos], ['20', '21', '22'])
+        self.assertEqual(self.calls, [(2, None)])
+
+    def test_iter_all_photos_streaming(self):
+        stream = self.shortcuts.iter_all_photos('nsid', 'token', per_page=3, workers=1)
+        self.assertEqual((stream.total, stream.pages), (13, 5))
+        self.assertEqual(len(self.calls), 1)
+        photos = iter(stream)
+        self.assertEqual(next(photos).id, '10')
+        self.assertTrue(len(self.calls) < 5)  # #bounded prefetch
+        self.assertEqual(len(list(photos)), 12)
+
+    def test_iter_all_photos_count_check(self):
+        self.total = '14'
+        photos = []
+        with self.assertRaises(Exception) as exc_info:
+            for photo in self.shortcuts.iter_all_photos('nsid', 'token', per_page=3):
+                photos.append(photo)
+        self.assertEqual(len(photos), 13)
+        self.assertTrue('13 != 14' in str(exc_info.exception))
+
+    def test_iter_all_photos_resume(self):
+        stream = self.shortcuts.iter_all_photos('nsid', 'token', per_page=3, start_page=3, after='31')
+        self.assertEqual([(page, p.id) for page, p in stream.iter_with_pages()], [(3, '32'), (4, '40'), (4, '41'), (4, '42'), (5, '50')])
+        self.assertEqual(sorted(page for page, date in self.calls), [3, 4, 5])
+
+    def _patch_details(self):
+        originals = dict((kind, getattr(self.shortcuts, 'get_photo_%s_json' % kind)) for kind in ('info', 'sizes', 'exif', 'geo'))
+
+        def restore():
+            for kind, func in originals.items():
+                setattr(self.shortcuts, 'get_photo_%s_json' % kind, func)
+        self.addCleanup(restore)
+        for kind in originals:
+            def call(photo_id, token, kind=kind):
+                time.sleep(0.1 if photo_id == '1' else 0)
+                if kind == 'exif' and photo_id == '2':
+                    raise ValueError('no exif')
+                return {'kind': kind, 'id': photo_id}
+            setattr(self.shortcuts, 'get_photo_%s_json' % kind, call)
+
+    def test_photo_detail_fetcher(self):
+        self._patch_details()
+        fetcher = self.shortcuts.PhotoDetailFetcher('token', kinds=('exif', 'info'), workers=4)
+        results = list(fetcher.iter_details(['1', '2', '3']))
+        self.assertEqual([details.photo_id for details in results], ['1', '2', '3'])
+        self.assertEqual(results[0].info, {'kind': 'info', 'id': '1'})
+        self.assertEqual((results[0].sizes, results[0].geo, results[0].errors), (None, None, {}))
+        # #failing exif doesn't drop the photo
+        self.assertEqual(results[1].info, {'kind': 'info', 'id': '2'})
+        self.assertEqual(results[1].exif, None)
+        self.assertTrue(isinstance(results[1].errors['exif'], ValueError))
+        # #only the kinds asked for that photo
+        details = list(fetcher.iter_details([('3', ['info', 'sizes'])]))[0]
+        self.assertEqual((details.info, details.exif), ({'kind': 'info', 'id': '3'}, None))
+        fetcher.close()
+
+    def test_photo_detail_fetcher_unordered(self):
+        self._patch_details()
+        fetcher = self.shortcuts.PhotoDetailFetcher('token', workers=8, ordered=False)
+        results = list(fetcher.iter_details(['1', '2', '3']))
+        self.assertEqual(sorted(details.photo_id for details in results), ['1', '2', '3'])
+        self.assertEqual(results[-1].photo_id, '1')  # #slowest
+        fetcher.close()
+        self.assertEqual(self.shortcuts.get_photo_details_jsons('3', 'token')[3], {'kind': 'geo', 'id': '3'})
+        with self.assertRaises(ValueError):
+            self.shortcuts.get_photo_details_jsons('2', 'token')
+
+    def test_iter_recently_updated(self):
+        calls = []
+
+        def get_recently_updated_json(token, min_date, page=1, per_page=500, extras=None):
+            calls.append((page, self.shortcuts.to_timestamp(min_date)))
+            photos = [{'id': str(page * 10 + i)} for i in range(2 if page < 2 else 1)]
+            return bunchify({'photos': {'page': page, 'pages': 2, 'perpage': 2, 'total': '3', 'photo': photos}})
+        original, self.shortcuts.get_recently_updated_json = self.shortcuts.get_recently_updated_json, get_recently_updated_json
+        try:
+            since = datetime(2012, 5, 1, 12, 0, tzinfo=utc)
+            stream = self.shortcuts.iter_recently_updated('token', since, per_page=2)
+            self.assertEqual(stream.total, 3)
+            self.assertEqual([p.id for p in stream], ['10', '11', '20'])
+        finally:
+            self.shortcuts.get_recently_updated_json = original
+        self.assertEqual(sorted(calls), [(1, 1335873600), (2, 1335873600)])
+        self.assertEqual(self.calls, [])
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+HTTP transport used by the Flickr API clients.
+
+Instead of opening a new connection for every call (urllib2.urlopen) the
+transport keeps a small pool of keep-alive connections per host, so a long
+sync pays the TCP (and TLS) handshake once per connection, not once per call.
+One transport can (and should) be shared between threads and API instances.
+"""
+from urllib2 import HTTPError
+from urlparse import urlsplit, urljoin
+import httplib
+import socket
+import threading
+import Queue
+
+
+class TransportResponse(object):
+    """Response read from a pooled connection.
+
+    Behaves like the file-like object returned by urllib2.urlopen (read(),
+    readlines(), headers, url, getcode()), but gives its connection back to
+    the pool once the body has been read or the response is closed."""
+
+    def __init__(self, transport, key, conn, response, url):
+        self._transport = transport
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = dict(response.getheaders())
+        self._released = False
+
+    def getcode(self):
+        return self.status
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def read(self, amt=None):
+        try:
+            data = self._response.read(amt) if amt is not None else self._response.read()
+        except (httplib.HTTPException, socket.error):
+            self._release(reuse=False)
+            raise
+        if amt is None or not data:
+            self._release()
+        return data
+
+    def readlines(self):
+        return self.read().splitlines(True)
+
+    def close(self):
+        """Drop the response. An unread body means the connection is unusable."""
+        self._release(reuse=self._response.isclosed())
+
+    def _release(self, reuse=True):
+        if not self._released:
+            self._released = True
+            reuse = reuse and not self._response.will_close
+            self._transport._put_connection(self._key, self._conn, reuse=reuse)
+
+    def __del__(self):
+        self.close()
+
+
+class HttpTransport(object):
+    """Keep-alive connection pool, one pool per (scheme, host, port).
+
+    @params pool_size: connections kept open per host (more can be opened
+                       concurrently, those above the limit are closed after use)
+    @params timeout: socket timeout in seconds for connect and read
+    @params max_redirects: how many redirects are followed before giving up"""
+
+    connection_classes = {'http': httplib.HTTPConnection, 'https': httplib.HTTPSConnection}
+    retry_exceptions = (httplib.BadStatusLine, httplib.CannotSendRequest, socket.error)
+
+    def __init__(self, pool_size=4, timeout=30, max_redirects=5):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def _get_pool(self, key):
+        with self._lock:
+            if key not in self._pools:
+                self._pools[key] = Queue.LifoQueue(self.pool_size)
+            return self._pools[key]
+
+    def _get_connection(self, key):
+        try:
+            return self._get_pool(key).get_nowait(), True
+        except Queue.Empty:
+            scheme, host, port = key
+            return self.connection_classes[scheme](host, port, timeout=self.timeout), False
+
+    def _put_connection(self, key, conn, reuse=True):
+        if reuse:
+            try:
+                self._get_pool(key).put_nowait(conn)
+                return
+            except Queue.Full:
+                pass
+        conn.close()
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            pools, self._pools = self._pools.values(), {}
+        for pool in pools:
+            while True:
+                try:
+                    pool.get_nowait().close()
+                except Queue.Empty:
+                    break
+
+    def _split(self, url):
+        parts = urlsplit(url)
+        if parts.scheme not in self.connection_classes:
+            raise ValueError('Unsupported url scheme: %s' % url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path = '%s?%s' % (path, parts.query)
+        return key, path
+
+    def _send(self, method, url, body=None, headers=None):
+        key, path = self._split(url)
+        headers = dict(headers or {})
+        headers.setdefault('Connection', 'keep-alive')
+        while True:
+            conn, reused = self._get_connection(key)
+            try:
+                conn.request(method, path, body, headers)
+                return key, conn, conn.getresponse()
+            except self.retry_exceptions:
+                conn.close()
+                # #idle keep-alive connection dropped by the server, try once more with a new one
+                if not reused:
+                    raise
+
+    def open(self, url, method='GET', body=None, headers=None):
+        """Send a request and return a TransportResponse without reading the body.
+        Redirects are followed, HTTP errors (>= 400) raise urllib2.HTTPError."""
+        for i in range(self.max_redirects + 1):
+            key, conn, response = self._send(method, url, body, headers)
+            result = TransportResponse(self, key, conn, response, url)
+            if response.status in (301, 302, 303, 307) and response.getheader('location'):
+                result.read()
+                url = urljoin(url, response.getheader('location'))
+                if response.status == 303:
+                    method, body = 'GET', None
+                continue
+            if response.status >= 400:
+                fp = _BodyFile(result.read())
+                raise HTTPError(url, response.status, response.reason, response.msg, fp)
+            return result
+        raise HTTPError(url, response.status, 'Too many redirects', response.msg, None)
+
+    def request(self, url, method='GET', body=None, headers=None):
+        """Send a request and return the whole response body."""
+        return self.open(url, method, body, headers).read()
+
+
+class _BodyFile(object):
+    """Minimal file-like wrapper so HTTPError.read() still works."""
+
+    def __init__(self, data):
+        self.data = data
+
+    def read(self, amt=None):
+        data, self.data = (self.data, '') if amt is None else (self.data[:amt], self.data[amt:])
+        return data
+
+    def readline(self):
+        return self.read()
+
+    def close(self):
+        pass
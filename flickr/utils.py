@@ -1,4 +1,8 @@
 from datetime import datetime
+import collections
+import itertools
+import threading
+import Queue
 
 
 def ts_to_dt(timestamp, offset=''):
@@ -9,3 +13,144 @@ def ts_to_dt(timestamp, offset=''):
 
 def unslash(url):
     return url.replace('\\/', '/')
+
+
+def chunked(iterable, size):
+    """Split iterable into lists of size items (the last one can be shorter)."""
+    items = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            break
+        yield chunk
+
+
+class Future(object):
+    """Result of a call run by WorkerPool."""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = self._exception = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise RuntimeError('Timed out waiting for result')
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        self._done.wait(timeout)
+        return self._exception
+
+    def add_done_callback(self, callback):
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def set_result(self, result=None, exception=None):
+        with self._lock:
+            self._result, self._exception = result, exception
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+def as_completed(futures, timeout=None):
+    """Yields the futures as they are done, whatever the order they were submitted in."""
+    done = Queue.Queue()
+    futures = list(futures)
+    for future in futures:
+        future.add_done_callback(done.put)
+    for i in range(len(futures)):
+        try:
+            yield done.get(timeout=timeout)
+        except Queue.Empty:
+            raise RuntimeError('Timed out waiting for results')
+
+
+class WorkerPool(object):
+    """Fixed size pool of daemon threads. With workers <= 1 calls are run inline,
+    so the single worker mode behaves exactly like a plain loop."""
+
+    def __init__(self, workers=1):
+        self.workers = max(int(workers or 1), 1)
+        self._tasks = Queue.Queue()
+        self._threads = []
+        if self.workers > 1:
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                break
+            future, func, args, kwargs = task
+            self._run(future, func, args, kwargs)
+
+    @staticmethod
+    def _run(future, func, args, kwargs):
+        try:
+            future.set_result(func(*args, **kwargs))
+        except Exception as e:
+            future.set_result(exception=e)
+
+    def submit(self, func, *args, **kwargs):
+        future = Future()
+        if self._threads:
+            self._tasks.put((future, func, args, kwargs))
+        else:
+            self._run(future, func, args, kwargs)
+        return future
+
+    def imap(self, func, iterable, lookahead=None):
+        """Like itertools.imap, but runs func in the pool. Results come back in
+        the order of iterable, with at most lookahead calls in flight. The first
+        calls are submitted right away, before the results are asked for."""
+        lookahead = lookahead or self.workers * 2
+        items = iter(iterable)
+        pending = collections.deque(self.submit(func, item) for item in itertools.islice(items, lookahead))
+        return self._results(func, items, pending)
+
+    def _results(self, func, items, pending):
+        while pending:
+            future = pending.popleft()
+            for item in itertools.islice(items, 1):
+                pending.append(self.submit(func, item))
+            yield future.result()
+
+    def imap_unordered(self, func, iterable, lookahead=None):
+        """(item, future) of every item of iterable as soon as func(item) is done,
+        with at most lookahead calls in flight, so a slow call doesn't hold the
+        others back. Items are taken from iterable in the calling thread."""
+        lookahead = lookahead or self.workers * 2
+        items = iter(iterable)
+        done = Queue.Queue()
+        in_flight = 0
+        for item in itertools.islice(items, lookahead):
+            self.submit(func, item).add_done_callback(lambda future, item=item: done.put((item, future)))
+            in_flight += 1
+        while in_flight:
+            item, future = done.get()
+            in_flight -= 1
+            for next_item in itertools.islice(items, 1):
+                self.submit(func, next_item).add_done_callback(lambda future, item=next_item: done.put((item, future)))
+                in_flight += 1
+            yield item, future
+
+    def shutdown(self):
+        for thread in self._threads:
+            self._tasks.put(None)
+        self._threads = []
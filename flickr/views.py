@@ -7,9 +7,8 @@ from django.shortcuts import render_to_response, get_object_or_404
 from django.template.context import RequestContext
 from django.utils import simplejson
 from django.views.generic.list_detail import object_list
-from flickr.api import FlickrApi
 from flickr.models import FlickrUser, Photo, PhotoSet
-from flickr.shortcuts import get_token_for_user
+from flickr.shortcuts import get_api, get_token_for_user, get_transport
 
 
 FLICKR_KEY = getattr(settings, 'FLICKR_KEY', None)
@@ -17,15 +16,20 @@ FLICKR_SECRET = getattr(settings, 'FLICKR_SECRET', None)
 PERMS = getattr(settings, 'FLICKR_PERMS', None)
 
 
+def get_view_api(token=None, **kwargs):
+    """API for a web request: fails fast, no waiting on the rate limiter of the sync commands nor on retries"""
+    return get_api(token, rate_limiter=None, retry_policy=None, **kwargs)
+
+
 @login_required
 def oauth(request):
     token = get_token_for_user(request.user)
     if not token:
-        api = FlickrApi(FLICKR_KEY, FLICKR_SECRET)
+        api = get_view_api()
         url = api.auth_url(request, perms=PERMS, callback=request.build_absolute_uri(reverse('flickr_complete')))
         return HttpResponseRedirect(url)
     else:
-        api = FlickrApi(FLICKR_KEY, FLICKR_SECRET, token, fallback=False)
+        api = get_view_api(token, fallback=False)
         try:
             data = api.get('flickr.test.login')
         except:  # # FlickrUnauthorizedCall:
@@ -39,7 +43,7 @@ def oauth(request):
 
 @login_required
 def oauth_access(request):
-    api = FlickrApi(FLICKR_KEY, FLICKR_SECRET)
+    api = get_view_api()
     data = api.access_token(request)
     if data:
         data = bunchify(data)
@@ -57,7 +61,7 @@ def oauth_access(request):
 @login_required
 def auth(request):
     from flickr.api import FlickrAuthApi
-    api = FlickrAuthApi(FLICKR_KEY, FLICKR_SECRET)
+    api = FlickrAuthApi(FLICKR_KEY, FLICKR_SECRET, transport=get_transport())
     token = get_token_for_user(request.user)
     if not token:
         frob = request.GET.get('frob', None)
@@ -116,7 +120,7 @@ def photoset(request, flickr_id):
 
 
 def method_call(request, method):
-    api = FlickrApi(FLICKR_KEY, FLICKR_SECRET)
+    api = get_view_api()
     if request.user.is_authenticated():
         api.token = get_token_for_user(request.user)
         auth = True